@@ -0,0 +1,113 @@
+# admission.py
+# کنترل پذیرش برای flowهای گران (LLM + چند نوشتن Mongo). در main.py به‌صورت TypeHandler
+# در گروه -1 یعنی قبل از همهٔ ConversationHandlerها ثبت می‌شود.
+from __future__ import annotations
+import logging, time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import ApplicationHandlerStop, ContextTypes
+
+from config import (
+    ADMISSION_ENABLED, ADMISSION_SHARED,
+    ADMISSION_USER_PER_MIN, ADMISSION_USER_BURST, ADMISSION_GLOBAL_PER_SEC, ADMISSION_GLOBAL_BURST,
+)
+from ratelimit import TokenBucket
+from services import take_shared_token
+
+logger = logging.getLogger(__name__)
+
+MAX_TRACKED_USERS = 50_000   # سطل‌های کاربر در حافظه (LRU)
+NOTICE_COOLDOWN = 10.0       # به کاربرِ محدودشده حداکثر هر ۱۰ ثانیه یک بار پیام می‌دهیم
+
+@dataclass(frozen=True)
+class Flow:
+    name: str
+    cost: float  # توکن هر شروع؛ تعیین سطح چند فراخوانی LLM دارد
+
+FLOWS: Dict[str, Flow] = {
+    "📚 شروع درس": Flow("lesson", 1),
+    "❓ پرسش‌وپاسخ": Flow("qa", 1),
+    "🧪 تعیین سطح": Flow("placement", 2),
+    "/placement": Flow("placement", 2),
+}
+
+class AdmissionControl:
+    """
+    دو token bucket برای هر flow: یکی برای هر کاربر (در حافظه؛ چون آپدیت‌های هر کاربر همیشه
+    به یک پروسه می‌رسند — polling یا webhook.py) و یکی سراسری که با ADMISSION_SHARED روی Mongo
+    بین workerها مشترک می‌شود. رد شدن → یک جواب محلی سریع و توقف پردازش آپدیت.
+    """
+
+    def __init__(self, enabled: bool = ADMISSION_ENABLED, shared: bool = ADMISSION_SHARED):
+        self.enabled = enabled
+        self.shared = shared
+        self._user_buckets: "OrderedDict[Tuple[str, int], TokenBucket]" = OrderedDict()
+        self._global: Dict[str, TokenBucket] = {}
+        self._noticed: Dict[int, float] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _user_bucket(self, flow: str, user_id: int) -> TokenBucket:
+        key = (flow, user_id)
+        bucket = self._user_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate=ADMISSION_USER_PER_MIN / 60, capacity=ADMISSION_USER_BURST)
+            self._user_buckets[key] = bucket
+            if len(self._user_buckets) > MAX_TRACKED_USERS:
+                self._user_buckets.popitem(last=False)  # قدیمی‌ترین، به احتمال زیاد دوباره پر شده
+        else:
+            self._user_buckets.move_to_end(key)
+        return bucket
+
+    async def _take_global(self, flow: Flow) -> bool:
+        if self.shared:
+            try:
+                return await take_shared_token(f"admission:{flow.name}", ADMISSION_GLOBAL_PER_SEC,
+                                               ADMISSION_GLOBAL_BURST, flow.cost)
+            except Exception:
+                logger.warning("Shared admission bucket unavailable; admitting %s", flow.name, exc_info=True)
+                return True
+        bucket = self._global.get(flow.name)
+        if bucket is None:
+            bucket = self._global[flow.name] = TokenBucket(rate=ADMISSION_GLOBAL_PER_SEC, capacity=ADMISSION_GLOBAL_BURST)
+        return bucket.try_acquire(flow.cost)
+
+    async def admit(self, flow: Flow, user_id: int) -> Tuple[bool, Optional[str], float]:
+        """(پذیرفته؟, کدام سطل رد کرد, ثانیه تا نوبت بعدی کاربر)."""
+        st = self.stats.setdefault(flow.name, {"admitted": 0, "user_throttled": 0, "global_throttled": 0})
+        user_bucket = self._user_bucket(flow.name, user_id)
+        if not user_bucket.try_acquire(flow.cost):
+            st["user_throttled"] += 1
+            return False, "user", user_bucket.wait_time(flow.cost)
+        if not await self._take_global(flow):
+            user_bucket.refund(flow.cost)  # تقصیر کاربر نبود
+            st["global_throttled"] += 1
+            return False, "global", 0.0
+        st["admitted"] += 1
+        return True, None, 0.0
+
+    async def check(self, update: Update, _context: ContextTypes.DEFAULT_TYPE) -> None:
+        if not self.enabled or not update.message or not update.effective_user:
+            return
+        flow = FLOWS.get((update.message.text or "").strip().split("@", 1)[0])
+        if flow is None:
+            return
+        ok, reason, wait = await self.admit(flow, update.effective_user.id)
+        if ok:
+            return
+        uid = update.effective_user.id
+        now = time.monotonic()
+        if now - self._noticed.get(uid, 0.0) >= NOTICE_COOLDOWN:
+            self._noticed[uid] = now
+            if len(self._noticed) > MAX_TRACKED_USERS:
+                self._noticed.clear()
+            if reason == "user":
+                txt = f"⏳ کمی آهسته‌تر! حدود {max(1, round(wait))} ثانیه دیگر دوباره امتحان کن."
+            else:
+                txt = "⏳ الان سرمان خیلی شلوغ است؛ چند لحظه دیگر دوباره امتحان کن."
+            await update.message.reply_text(txt)
+        raise ApplicationHandlerStop
+
+admission = AdmissionControl()
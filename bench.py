@@ -0,0 +1,190 @@
+# bench.py
+# میکروبنچمارک مسیرهای قدیم/جدید دیتابیس روی یک DB جدا (<DB_NAME>_bench که اول و آخر پاک می‌شود).
+# از manage.py اجرا می‌شود:
+#   python manage.py bench-reviews --docs 1000000
+#   python manage.py bench-progress --events 1000000
+from __future__ import annotations
+import random, statistics, time
+from datetime import datetime, timedelta, UTC
+from typing import Awaitable, Callable, Dict, List
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+
+from config import DB_NAME
+from services import (
+    mongo_client, DEFAULT_EASE, MIN_EASE, _sm2_pipeline, _progress_rollup_pipeline, review_item_id,
+)
+
+BENCH_DB = f"{DB_NAME}_bench"
+SEED_BATCH = 10_000
+
+def _bench_db():
+    return mongo_client[BENCH_DB]
+
+async def _timed(ops: int, fn: Callable[[int], Awaitable[None]]) -> Dict[str, float]:
+    latencies: List[float] = []
+    for i in range(ops):
+        t0 = time.perf_counter()
+        await fn(i)
+        latencies.append(time.perf_counter() - t0)
+    latencies.sort()
+    return {
+        "mean_ms": 1000 * statistics.fmean(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+    }
+
+def _docs_examined(explain: dict) -> int:
+    stats = explain.get("executionStats") or {}
+    return stats.get("totalDocsExamined", -1)
+
+def _line(label: str, r: Dict[str, float], examined: int) -> str:
+    return (f"  {label:<28} mean={r['mean_ms']:.2f}ms p50={r['p50_ms']:.2f}ms p99={r['p99_ms']:.2f}ms "
+            f"docs examined/lookup={examined}")
+
+# ---------- SM-2 review updates ----------
+def _legacy_sm2_next(interval: int, ease: float, was_correct: bool):
+    if was_correct:
+        ease = max(MIN_EASE, ease + 0.1)
+        interval = 1 if interval == 0 else int(round(interval * ease))
+    else:
+        ease = max(MIN_EASE, ease - 0.2)
+        interval = 1
+    return interval, ease
+
+async def bench_reviews(docs: int = 1_000_000, per_user: int = 50, ops: int = 2_000) -> str:
+    """
+    مسیر قدیم: find_one روی (user_id, item_id) با تنها ایندکس (user_id, next_due) + update_one.
+    مسیر جدید: یک find_one_and_update با _sm2_pipeline روی ایندکس unique (user_id, item_id).
+    """
+    db = _bench_db()
+    await mongo_client.drop_database(BENCH_DB)
+    col = db["reviews"]
+    now = datetime.now(UTC)
+    users = max(1, docs // per_user)
+    batch = []
+    for n in range(docs):
+        uid, k = divmod(n, per_user)
+        batch.append({
+            "user_id": uid, "item_id": review_item_id(f"exercise {uid}-{k}"), "exercise": f"exercise {uid}-{k}",
+            "interval": random.choice([0, 1, 3, 7]), "ease": DEFAULT_EASE,
+            "next_due": now + timedelta(days=random.randint(-5, 30)), "stats": {"correct": 0, "wrong": 0},
+        })
+        if len(batch) >= SEED_BATCH:
+            await col.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        await col.insert_many(batch, ordered=False)
+    await col.create_index([("user_id", ASCENDING), ("next_due", ASCENDING)])
+
+    rnd = random.Random(1)
+    picks = [(u, review_item_id(f"exercise {u}-{rnd.randrange(per_user)}"), rnd.random() < 0.7)
+             for u in (rnd.randrange(users) for _ in range(ops))]
+
+    async def legacy(i: int) -> None:
+        uid, item_id, ok = picks[i]
+        doc = await col.find_one({"user_id": uid, "item_id": item_id})
+        interval, ease = _legacy_sm2_next(doc.get("interval", 0), doc.get("ease", DEFAULT_EASE), ok)
+        await col.update_one({"_id": doc["_id"]}, {
+            "$set": {"interval": interval, "ease": ease, "next_due": datetime.now(UTC) + timedelta(days=interval),
+                     "updated_at": datetime.now(UTC)},
+            "$inc": {"stats.correct" if ok else "stats.wrong": 1},
+        })
+
+    async def atomic(i: int) -> None:
+        uid, item_id, ok = picks[i]
+        await col.find_one_and_update(
+            {"user_id": uid, "item_id": item_id}, _sm2_pipeline(ok, datetime.now(UTC)),
+            projection={"_id": 0, "interval": 1, "ease": 1, "next_due": 1}, return_document=ReturnDocument.AFTER,
+        )
+
+    probe = {"user_id": picks[0][0], "item_id": picks[0][1]}
+    old = await _timed(ops, legacy)
+    old_examined = _docs_examined(await col.find(probe).explain())
+    await col.create_index([("user_id", ASCENDING), ("item_id", ASCENDING)], unique=True)
+    new = await _timed(ops, atomic)
+    new_examined = _docs_examined(await col.find(probe).explain())
+    await mongo_client.drop_database(BENCH_DB)
+    return "\n".join([
+        f"reviews: {docs} docs, {users} users, {ops} answers per path",
+        _line("find_one + update_one", old, old_examined),
+        _line("find_one_and_update pipeline", new, new_examined),
+    ])
+
+# ---------- /progress summary ----------
+async def bench_progress(events: int = 1_000_000, users: int = 1_000, days: int = 365, ops: int = 500) -> str:
+    """
+    مسیر قدیم: count_documents روی lessons + aggregation هفت‌روزهٔ events + استریک از کل تاریخچه.
+    مسیر جدید: یک find_one روی progress که همان _progress_rollup_pipeline نوشتن رویدادها ساخته است.
+    """
+    db = _bench_db()
+    await mongo_client.drop_database(BENCH_DB)
+    events_col, lessons_col, progress_col = db["events"], db["lessons"], db["progress"]
+    await events_col.create_index([("user_id", ASCENDING), ("ts", ASCENDING)])
+    await lessons_col.create_index([("user_id", ASCENDING), ("created_at", ASCENDING)])
+    await progress_col.create_index([("user_id", ASCENDING)], unique=True)
+
+    names = ["lesson_started", "review_answered_correct", "review_answered_wrong", "qa_asked"]
+    start = datetime.now(UTC).replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=days - 1)
+    per_day = max(1, events // (users * days))
+    rnd = random.Random(1)
+    batch, rollups, lessons = [], [], []
+    # روز به روز تا استریک در rollup همان ترتیب واقعی را ببیند
+    for d in range(days):
+        ts = start + timedelta(days=d)
+        day = ts.date().isoformat()
+        for uid in range(users):
+            counts: Dict[str, int] = {}
+            for _ in range(per_day):
+                name = rnd.choice(names)
+                counts[name] = counts.get(name, 0) + 1
+                batch.append({"user_id": uid, "name": name, "data": {}, "ts": ts})
+            rollups.append(UpdateOne({"user_id": uid}, _progress_rollup_pipeline(day, counts), upsert=True))
+            if counts.get("lesson_started"):
+                lessons.append({"user_id": uid, "content": "", "exercise": "", "created_at": ts})
+        if len(batch) >= SEED_BATCH or d == days - 1:
+            await events_col.insert_many(batch, ordered=False)
+            await progress_col.bulk_write(rollups, ordered=True)
+            if lessons:
+                await lessons_col.insert_many(lessons, ordered=False)
+            batch, rollups, lessons = [], [], []
+    lesson_counts = {r["_id"]: r["n"] async for r in lessons_col.aggregate(
+        [{"$group": {"_id": "$user_id", "n": {"$sum": 1}}}]
+    )}
+    await progress_col.bulk_write([UpdateOne({"user_id": u}, {"$set": {"lessons_done": n}})
+                                   for u, n in lesson_counts.items()])
+
+    picks = [rnd.randrange(users) for _ in range(ops)]
+
+    async def legacy(i: int) -> None:
+        uid = picks[i]
+        await lessons_col.count_documents({"user_id": uid})
+        since = datetime.now(UTC) - timedelta(days=7)
+        await events_col.aggregate([
+            {"$match": {"user_id": uid, "ts": {"$gte": since}}},
+            {"$group": {"_id": "$name", "cnt": {"$sum": 1}}},
+        ]).to_list(length=None)
+        active = [r["_id"] async for r in events_col.aggregate([
+            {"$match": {"user_id": uid}},
+            {"$project": {"d": {"$dateToString": {"format": "%Y-%m-%d", "date": "$ts"}}}},
+            {"$group": {"_id": "$d"}},
+            {"$sort": {"_id": -1}},
+        ])]
+        today, streak = datetime.now(UTC).date(), 0
+        while (today - timedelta(days=streak)).isoformat() in active:
+            streak += 1
+
+    async def rollup(i: int) -> None:
+        await progress_col.find_one({"user_id": picks[i]})
+
+    old = await _timed(ops, legacy)
+    old_examined = _docs_examined(await events_col.find({"user_id": picks[0]}).explain())
+    new = await _timed(ops, rollup)
+    new_examined = _docs_examined(await progress_col.find({"user_id": picks[0]}).explain())
+    total = await events_col.estimated_document_count()
+    await mongo_client.drop_database(BENCH_DB)
+    return "\n".join([
+        f"progress: {total} events, {users} users, {days} days, {ops} /progress reads per path",
+        _line("lessons + 7d agg + streak scan", old, old_examined),
+        _line("progress rollup find_one", new, new_examined),
+    ])
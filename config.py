@@ -10,3 +10,112 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 PROXY_URL = os.getenv("PROXY_URL", "")        # مثلا: socks5://127.0.0.1:1080 یا http://127.0.0.1:8080
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "40"))  # تایم‌اوت کلی ثانیه
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))  # سقف کانکشن‌های همزمان Motor
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))    # آپدیت‌های همزمان (کاربران مختلف)؛ 1 = ترتیبی مثل قبل
+
+# ---- LLM ----
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()   # gemini | fake (آفلاین برای تست/بنچمارک)
+LLM_MODEL = os.getenv("LLM_MODEL", "gemini-1.5-flash")
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # سقف درخواست‌های همزمان به LLM
+LLM_FAKE_LATENCY = float(os.getenv("LLM_FAKE_LATENCY", "0"))      # تأخیر ساختگی بک‌اند fake (ثانیه)
+
+# ---- Lesson bank ----
+LESSON_BANK_PER_BUCKET = int(os.getenv("LESSON_BANK_PER_BUCKET", "5"))          # درس در هر باکت (level, goal, tag)
+LESSON_BANK_TTL_DAYS = int(os.getenv("LESSON_BANK_TTL_DAYS", "14"))             # عمر هر درس در بانک
+LESSON_BANK_MAX_BUCKETS = int(os.getenv("LESSON_BANK_MAX_BUCKETS", "50"))       # فقط پرتقاضاترین باکت‌ها پر می‌شوند
+LESSON_BANK_REFRESH_MINUTES = int(os.getenv("LESSON_BANK_REFRESH_MINUTES", "60"))
+LESSON_SEEN_MAX = int(os.getenv("LESSON_SEEN_MAX", "500"))                      # سقف تاریخچه درس‌های دیده‌شده هر کاربر
+
+# ---- Next-lesson prefetch ----
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))            # تعداد worker پس‌زمینه
+PREFETCH_QUEUE_SIZE = int(os.getenv("PREFETCH_QUEUE_SIZE", "200"))    # صف پر باشد → درخواست دور ریخته می‌شود
+PREFETCH_TTL_HOURS = int(os.getenv("PREFETCH_TTL_HOURS", "24"))       # عمر درس آماده
+
+# ---- Progress rollups ----
+PROGRESS_KEEP_DAYS = int(os.getenv("PROGRESS_KEEP_DAYS", "14"))  # شمارنده‌های روزانهٔ نگه‌داشته‌شده روی سند progress
+
+# ---- Event buffer (write-behind) ----
+EVENT_BUFFER_MAX = int(os.getenv("EVENT_BUFFER_MAX", "10000"))        # سقف صف رویدادها در حافظه
+EVENT_BATCH_SIZE = int(os.getenv("EVENT_BATCH_SIZE", "200"))          # flush با رسیدن به این اندازه
+EVENT_FLUSH_SECONDS = float(os.getenv("EVENT_FLUSH_SECONDS", "2"))    # ... یا بعد از این مدت
+EVENT_BUFFER_POLICY = os.getenv("EVENT_BUFFER_POLICY", "drop")       # drop | block وقتی صف پر است
+
+# ---- Review session ----
+REVIEW_SESSION_SIZE = int(os.getenv("REVIEW_SESSION_SIZE", "20"))           # آیتم موعددار در هر جلسهٔ مرور
+REVIEW_SESSION_TIMEOUT = int(os.getenv("REVIEW_SESSION_TIMEOUT", "900"))    # ثانیه؛ بعدش نتایج ثبت و جلسه بسته می‌شود
+
+# ---- User profile cache ----
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))     # 0 = غیرفعال
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))       # ثانیه
+USER_CACHE_CHANGE_STREAM = os.getenv("USER_CACHE_CHANGE_STREAM", "0") == "1"  # invalidation بین چند worker (replica set)
+
+# ---- Reminders ----
+DEFAULT_TIMEZONE = os.getenv("DEFAULT_TIMEZONE", "UTC")  # منطقهٔ زمانی یادآور وقتی کاربر چیزی نگفته
+
+# ---- Broadcast fan-out ----
+FANOUT_RATE = float(os.getenv("FANOUT_RATE", "25"))               # پیام در ثانیه (سقف تلگرام ~30)
+FANOUT_BATCH_SIZE = int(os.getenv("FANOUT_BATCH_SIZE", "500"))    # گیرنده در هر دسته از cursor
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "20"))   # درخواست‌های همزمان به API تلگرام
+FANOUT_MAX_RETRIES = int(os.getenv("FANOUT_MAX_RETRIES", "3"))    # تلاش مجدد بعد از RetryAfter
+
+# ---- Due-review push ----
+REVIEW_SWEEP_MINUTES = int(os.getenv("REVIEW_SWEEP_MINUTES", "15"))  # فاصلهٔ sweep آیتم‌های تازه‌موعددار
+
+# ---- Conversation persistence ----
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "10"))  # هر چند ثانیه وضعیت‌ها جمع‌آوری شوند
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", "0.5"))        # صبر برای یک‌کاسه کردن یک دور در یک bulk_write
+
+# ---- Webhook / multi-worker ----
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")  # برای تست آفلاین: آدرس fake_telegram.py
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")              # آدرس عمومی، مثلا https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")        # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", str(os.cpu_count() or 2)))
+
+# ---- Q&A answer cache ----
+QA_CACHE_SIZE = int(os.getenv("QA_CACHE_SIZE", "5000"))                # پاسخ‌های نگه‌داشته در حافظه؛ 0 = غیرفعال
+QA_CACHE_THRESHOLD = float(os.getenv("QA_CACHE_THRESHOLD", "0.7"))     # حداقل شباهت Jaccard برای سرو از کش
+QA_CACHE_MIN_TOKENS = int(os.getenv("QA_CACHE_MIN_TOKENS", "3"))       # سؤال کوتاه‌تر (بعد از نرمال‌سازی) نه کش می‌شود نه از کش جواب می‌گیرد
+QA_CACHE_TTL_DAYS = int(os.getenv("QA_CACHE_TTL_DAYS", "30"))
+QA_CACHE_WARM_TOP = int(os.getenv("QA_CACHE_WARM_TOP", "200"))         # چند سؤال پرتکرار events در warm-qa-cache
+
+# ---- Placement item bank ----
+PLACEMENT_TEST_SIZE = int(os.getenv("PLACEMENT_TEST_SIZE", "8"))
+PLACEMENT_BANK_TARGET = int(os.getenv("PLACEMENT_BANK_TARGET", "60"))       # آیتم در هر band؛ کمتر → تولید با LLM
+PLACEMENT_MIN_PER_TYPE = int(os.getenv("PLACEMENT_MIN_PER_TYPE", "5"))      # حداقل هر نوع (mcq/fill/dialog/listening/reading)
+PLACEMENT_MIN_RESPONSES = int(os.getenv("PLACEMENT_MIN_RESPONSES", "30"))   # بعد از این تعداد پاسخ، آمار آیتم معتبر است
+PLACEMENT_MIN_DISCRIMINATION = float(os.getenv("PLACEMENT_MIN_DISCRIMINATION", "0.1"))  # point-biserial کمتر → کنار گذاشته می‌شود
+
+# ---- Streaming replies ----
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # ثانیه بین دو edit یک پیام (سقف تلگرام ~۱ در ثانیه در هر چت)
+
+# ---- Batched LLM grading ----
+GRADER_WINDOW_MS = float(os.getenv("GRADER_WINDOW_MS", "100"))   # پنجرهٔ جمع‌آوری جواب‌ها؛ 0 = بدون batch
+GRADER_MAX_BATCH = int(os.getenv("GRADER_MAX_BATCH", "20"))      # دسته زودتر از پایان پنجره فرستاده می‌شود
+
+# ---- LLM scheduling / load shedding ----
+LLM_INTERACTIVE_CONCURRENCY = int(os.getenv("LLM_INTERACTIVE_CONCURRENCY", "0"))  # 0 = تا سقف کل
+LLM_BACKGROUND_CONCURRENCY = int(os.getenv("LLM_BACKGROUND_CONCURRENCY", "2"))    # prefetch، بانک درس، warm
+LLM_INTERACTIVE_DEADLINE = float(os.getenv("LLM_INTERACTIVE_DEADLINE", "20"))     # ثانیه؛ بعدش کاربر fallback می‌گیرد (0 = بدون deadline)
+LLM_RETRY_MAX = int(os.getenv("LLM_RETRY_MAX", "3"))                  # تلاش مجدد روی 429
+LLM_RETRY_BASE = float(os.getenv("LLM_RETRY_BASE", "1.0"))            # backoff نمایی با jitter (ثانیه)
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.1"))  # هر درخواست موفق اجازهٔ ۰.۱ retry
+LLM_RETRY_BUDGET_CAP = float(os.getenv("LLM_RETRY_BUDGET_CAP", "10"))       # سقف retryهای پس‌انداز‌شده (انفجار مجاز)
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))  # شکست پشت‌سرهم تا باز شدن مدارشکن
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30")) # ثانیه
+LLM_FAKE_429_RATE = float(os.getenv("LLM_FAKE_429_RATE", "0"))        # fake: احتمال خطای 429 ساختگی
+
+# ---- Admission control (expensive flows) ----
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_USER_PER_MIN = float(os.getenv("ADMISSION_USER_PER_MIN", "4"))    # توکن در دقیقه برای هر کاربر در هر flow
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "3"))
+ADMISSION_GLOBAL_PER_SEC = float(os.getenv("ADMISSION_GLOBAL_PER_SEC", "10"))  # سقف کل هر flow (همهٔ کاربران)
+ADMISSION_GLOBAL_BURST = float(os.getenv("ADMISSION_GLOBAL_BURST", "30"))
+ADMISSION_SHARED = os.getenv("ADMISSION_SHARED", "0") == "1"   # سطل‌های سراسری روی Mongo، مشترک بین workerها
+
+# ---- Telegram media file_id cache ----
+MEDIA_CACHE_SIZE = int(os.getenv("MEDIA_CACHE_SIZE", "5000"))            # ورودی در حافظه (LRU)
+MEDIA_CACHE_TTL_DAYS = int(os.getenv("MEDIA_CACHE_TTL_DAYS", "60"))      # بلااستفاده بیشتر از این → حذف از Mongo
+MEDIA_PREWARM_MINUTES = int(os.getenv("MEDIA_PREWARM_MINUTES", "60"))    # 0 = بدون prewarm
+MEDIA_WARM_CHAT_ID = int(os.getenv("MEDIA_WARM_CHAT_ID", str(ADMIN_CHAT_ID)))  # چتی که آپلود اولیه آنجا انجام و پاک می‌شود
@@ -0,0 +1,156 @@
+# fake_telegram.py
+# جایگزین محلی Bot API برای تست بار حالت webhook (بدون تلگرام واقعی).
+#   ترمینال ۱:  python fake_telegram.py serve --port 8081
+#   ترمینال ۲:  TELEGRAM_API_URL=http://127.0.0.1:8081 python webhook.py --workers 4 --no-set-webhook
+#   ترمینال ۳:  python fake_telegram.py load --url http://127.0.0.1:8443/telegram --updates 5000
+# throughput واقعی (end-to-end) همان نرخ sendMessage است که serve هر چند ثانیه چاپ می‌کند.
+from __future__ import annotations
+import argparse, itertools, json, random, threading, time, urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Optional
+from urllib.parse import parse_qs
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeCoach", "username": "fake_coach_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+LOAD_TEXTS = ["/start", "📊 پیشرفت", "📖 مشاهده اطلاعات", "/stats"]
+
+# ---------- serve ----------
+class _FakeApi(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive مثل API واقعی؛ وگرنه هر فراخوانی یک اتصال تازه
+    disable_nagle_algorithm = True  # header و body جدا نوشته می‌شوند؛ با Nagle هر پاسخ ~۴۰ms صبر می‌کند
+    calls: Counter = Counter()
+    lock = threading.Lock()
+    message_ids = itertools.count(1)
+    on_call: Optional[Callable[[str, dict], None]] = None  # loadtest.py: (method, params) برای هر فراخوانی
+
+    def do_POST(self):
+        method = self.path.rstrip("/").rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        params = self._params(body)
+        with self.lock:
+            self.calls[method] += 1
+        self._reply(self._result(method, params))
+        if _FakeApi.on_call is not None:
+            _FakeApi.on_call(method, params)
+
+    do_GET = do_POST
+
+    def _params(self, body: bytes) -> dict:
+        ctype = self.headers.get("Content-Type", "")
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if ctype.startswith("application/x-www-form-urlencoded"):
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        return {}  # multipart (فایل) — محتوا مهم نیست
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method.startswith("send") or method.startswith("edit"):
+            chat_id = int(params.get("chat_id") or 0)
+            msg = {
+                "message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+            if method == "sendAudio":
+                audio = params.get("audio") or ""
+                # URL/آپلود → file_id تازه؛ file_id → همان
+                file_id = audio if audio and not audio.startswith("http") else f"fake-audio-{msg['message_id']}"
+                msg["audio"] = {"file_id": file_id, "file_unique_id": file_id[-16:], "duration": 1}
+            return msg
+        return True
+
+    def _reply(self, result) -> None:
+        data = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def _report(interval: float) -> None:
+    last = 0
+    while True:
+        time.sleep(interval)
+        with _FakeApi.lock:
+            sent = _FakeApi.calls["sendMessage"]
+            total = sum(_FakeApi.calls.values())
+        print(f"sendMessage={sent} (+{(sent - last) / interval:.1f}/s) total_calls={total}", flush=True)
+        last = sent
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # backlog پیش‌فرض ۵ زیر بار اتصال‌ها را reset می‌کند
+
+def make_server(listen: str, port: int) -> ThreadingHTTPServer:
+    return _Server((listen, port), _FakeApi)
+
+def serve(args) -> None:
+    server = make_server(args.listen, args.port)
+    threading.Thread(target=_report, args=(args.report_every,), daemon=True).start()
+    print(f"🧪 Fake Bot API on http://{args.listen}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(dict(_FakeApi.calls))
+
+# ---------- load ----------
+def make_update(update_id: int, user_id: int, text: Optional[str] = None) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"load{user_id}"}
+    text = text if text is not None else random.choice(LOAD_TEXTS)
+    message = {
+        "message_id": update_id, "date": int(time.time()), "from": user,
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+        "text": text,
+    }
+    if text.startswith("/"):
+        # CommandHandler فقط پیام‌هایی با entity از نوع bot_command را می‌بیند
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def load(args) -> None:
+    headers = {"Content-Type": "application/json"}
+    if args.secret:
+        headers["X-Telegram-Bot-Api-Secret-Token"] = args.secret
+
+    def post(i: int) -> float:
+        body = json.dumps(make_update(i, 10_000 + i % args.users)).encode()
+        t0 = time.perf_counter()
+        urllib.request.urlopen(urllib.request.Request(args.url, body, headers), timeout=30).read()
+        return time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = sorted(pool.map(post, range(1, args.updates + 1)))
+    elapsed = time.perf_counter() - t0
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    print(f"{args.updates} updates in {elapsed:.2f}s → {args.updates / elapsed:.0f} upd/s "
+          f"(p50={p(0.5):.1f}ms p99={p(0.99):.1f}ms)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Telegram Bot API stand-in and webhook load generator")
+    sub = parser.add_subparsers(dest="command", required=True)
+    s = sub.add_parser("serve", help="answer Bot API calls locally")
+    s.add_argument("--listen", default="127.0.0.1")
+    s.add_argument("--port", type=int, default=8081)
+    s.add_argument("--report-every", type=float, default=5.0)
+    s.set_defaults(fn=serve)
+    l = sub.add_parser("load", help="POST synthetic updates to the webhook")
+    l.add_argument("--url", default="http://127.0.0.1:8443/telegram")
+    l.add_argument("--secret", default="")
+    l.add_argument("--users", type=int, default=500)
+    l.add_argument("--updates", type=int, default=5000)
+    l.add_argument("--concurrency", type=int, default=64)
+    l.set_defaults(fn=load)
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
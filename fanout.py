@@ -0,0 +1,67 @@
+# fanout.py
+from __future__ import annotations
+import asyncio, logging, time
+from typing import AsyncIterable, Callable, Dict, List, Union
+
+from telegram import Bot
+from telegram.error import Forbidden, RetryAfter, TelegramError
+
+from config import FANOUT_RATE, FANOUT_CONCURRENCY, FANOUT_MAX_RETRIES
+from ratelimit import TokenBucket
+from services import mark_users_blocked
+
+logger = logging.getLogger(__name__)
+
+# سقف سراسری ارسال ربات (~۳۰ پیام در ثانیه طبق مستندات تلگرام)؛ بین همهٔ fan-outها مشترک است
+telegram_limiter = TokenBucket(rate=FANOUT_RATE, capacity=FANOUT_RATE)
+
+async def fan_out(bot: Bot, batches: AsyncIterable[List[int]], text: Union[str, Callable[[int], str]],
+                  label: str = "broadcast",
+                  limiter: TokenBucket = telegram_limiter, concurrency: int = FANOUT_CONCURRENCY) -> Dict[str, float]:
+    """
+    ارسال یک پیام به گیرنده‌هایی که دسته‌دسته از cursor می‌آیند، با token bucket زیر سقف تلگرام.
+    text می‌تواند تابعی از chat_id باشد (پیام شخصی‌سازی‌شده).
+    RetryAfter کل سطل را متوقف و پیام را دوباره تلاش می‌کند؛ کاربرانی که ربات را بلاک کرده‌اند
+    (Forbidden) blocked علامت می‌خورند و تا /start بعدی از یادآور و اعلان مرور خارج‌اند. آمار هر دسته لاگ و آمار کل برگردانده می‌شود.
+    """
+    sem = asyncio.Semaphore(concurrency)
+    total = {"batches": 0, "sent": 0, "failed": 0, "blocked": 0, "retries": 0, "seconds": 0.0}
+    started = time.monotonic()
+
+    async def send(chat_id: int, stats: Dict[str, int], blocked: List[int]) -> None:
+        async with sem:
+            for _attempt in range(FANOUT_MAX_RETRIES + 1):
+                await limiter.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text(chat_id) if callable(text) else text)
+                    stats["sent"] += 1
+                    return
+                except RetryAfter as e:
+                    limiter.pause(float(e.retry_after))
+                    stats["retries"] += 1
+                except Forbidden:
+                    blocked.append(chat_id)
+                    stats["blocked"] += 1
+                    return
+                except TelegramError:
+                    logger.warning("%s: send to %s failed", label, chat_id, exc_info=True)
+                    break
+            stats["failed"] += 1
+
+    async for batch in batches:
+        t0 = time.monotonic()
+        stats = {"sent": 0, "failed": 0, "blocked": 0, "retries": 0}
+        blocked: List[int] = []
+        await asyncio.gather(*(send(uid, stats, blocked) for uid in batch))
+        if blocked:
+            await mark_users_blocked(blocked)
+        elapsed = time.monotonic() - t0
+        logger.info("%s batch %d: %d recipients in %.2fs (%.1f msg/s) sent=%d failed=%d blocked=%d retries=%d",
+                    label, total["batches"] + 1, len(batch), elapsed, stats["sent"] / elapsed if elapsed else 0.0,
+                    stats["sent"], stats["failed"], stats["blocked"], stats["retries"])
+        total["batches"] += 1
+        for k, v in stats.items():
+            total[k] += v
+
+    total["seconds"] = time.monotonic() - started
+    return total
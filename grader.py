@@ -0,0 +1,138 @@
+# grader.py
+from __future__ import annotations
+import asyncio, json, logging, time
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import GRADER_WINDOW_MS, GRADER_MAX_BATCH
+from services import ask_gemini, parse_llm_verdict
+
+logger = logging.getLogger(__name__)
+
+GRADER_SYSTEM = "You are an English teacher grading short open-ended answers. Be fair to small typos."
+
+# (درست؟, فیدبک)؛ درست؟=None یعنی LLM در دسترس نبود و جواب نمره نگرفت
+Verdict = Tuple[Optional[bool], str]
+UNAVAILABLE: Verdict = (None, "")
+
+def _single_prompt(exercise: str, answer: str, hints: str) -> str:
+    prompt = (
+        f"You are an English teacher.\n"
+        f"Exercise: {exercise}\n"
+        f"Student's answer: {answer}\n"
+    )
+    if hints:
+        prompt += f"Weakness hints: {hints}\n"
+    return prompt + "Return one word: CORRECT or WRONG. Then a short reason (<=15 words) + a tiny tip."
+
+def _batch_prompt(items: List[Tuple[str, str, str]]) -> str:
+    lines = []
+    for i, (exercise, answer, hints) in enumerate(items):
+        lines.append(f"#{i} Exercise: {exercise}\n    Student's answer: {answer}"
+                     + (f"\n    Weakness hints: {hints}" if hints else ""))
+    # قالب همهٔ idها را دارد تا مدل (و FakeBackend) برای هر کدام دقیقاً یک نتیجه برگرداند
+    template = ",".join(
+        f'{{"id":{i},"verdict":"CORRECT|WRONG","feedback":"short reason (<=15 words) + a tiny tip"}}'
+        for i in range(len(items))
+    )
+    return (
+        "Grade each numbered answer independently.\n\n" + "\n".join(lines) + "\n\n"
+        f'Return STRICT JSON: {{"results":[{template}]}}'
+    )
+
+class BatchGrader:
+    """
+    Micro-batching برای نمره‌دهی LLM: درخواست‌هایی که در یک پنجرهٔ کوتاه (window) از کاربران
+    مختلف می‌رسند با یک prompt JSON یکجا فرستاده می‌شوند و هر handler جواب خودش را می‌گیرد.
+    پنجره فقط وقتی باز می‌شود که نمره‌دهی دیگری در جریان است؛ درخواست تنها بی‌معطلی با همان
+    prompt قدیمی تکی می‌رود.
+    """
+
+    def __init__(self, window: float = GRADER_WINDOW_MS / 1000, max_batch: int = GRADER_MAX_BATCH):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Tuple[Tuple[str, str, str], float, asyncio.Future]] = []
+        self._timer: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()  # ارجاع به دسته‌های در جریان تا GC نشوند
+        self.stats: Dict[str, float] = {"requests": 0, "batches": 0, "max_batch": 0, "wait_seconds": 0.0, "fallbacks": 0}
+
+    def avg_batch(self) -> float:
+        return self.stats["requests"] / self.stats["batches"] if self.stats["batches"] else 0.0
+
+    def avg_wait_ms(self) -> float:
+        return 1000 * self.stats["wait_seconds"] / self.stats["requests"] if self.stats["requests"] else 0.0
+
+    async def grade(self, exercise: str, answer: str, hints: str = "") -> Verdict:
+        """(is_correct, feedback)؛ اگر LLM در دسترس نبود UNAVAILABLE."""
+        if self.window <= 0:
+            return await self._grade_one((exercise, answer, hints))
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append(((exercise, answer, hints), time.monotonic(), fut))
+        if len(self._pending) >= self.max_batch or not self._running:
+            # چیزی در جریان نیست → کسی هم برای هم‌دسته شدن در راه نیست
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await fut
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        now = time.monotonic()
+        self.stats["requests"] += len(batch)
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        self.stats["wait_seconds"] += sum(now - queued for _item, queued, _fut in batch)
+        task = asyncio.create_task(self._run(batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch) -> None:
+        items = [item for item, _queued, _fut in batch]
+        try:
+            if len(items) == 1:
+                verdicts = [await self._grade_one(items[0])]
+            else:
+                verdicts = await self._grade_batch(items)
+        except Exception:
+            logger.exception("Batch grading failed")
+            verdicts = None
+        for i, (_item, _queued, fut) in enumerate(batch):
+            if not fut.done():
+                fut.set_result(verdicts[i] if verdicts else UNAVAILABLE)
+
+    async def _grade_one(self, item: Tuple[str, str, str]) -> Verdict:
+        feedback = await ask_gemini(_single_prompt(*item))
+        if feedback is None:
+            return UNAVAILABLE
+        return parse_llm_verdict(feedback), feedback
+
+    async def _grade_batch(self, items: List[Tuple[str, str, str]]) -> List[Verdict]:
+        raw = await ask_gemini(_batch_prompt(items), system=GRADER_SYSTEM, json_mode=True)
+        if raw is None:
+            return [UNAVAILABLE] * len(items)
+        by_id: Dict[int, Verdict] = {}
+        try:
+            for r in (json.loads(raw) or {}).get("results") or []:
+                verdict = str(r.get("verdict", "")).upper()
+                by_id[int(r["id"])] = (verdict == "CORRECT", f"{verdict}. {r.get('feedback', '')}".strip())
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.warning("Unparseable batch grading response for %d items", len(items))
+            by_id = {}
+        # جاافتاده‌ها (یا JSON خراب) → نمره‌دهی تکی، همزمان
+        missing = [i for i in range(len(items)) if i not in by_id]
+        if missing:
+            self.stats["fallbacks"] += len(missing)
+            for i, v in zip(missing, await asyncio.gather(*(self._grade_one(items[i]) for i in missing))):
+                by_id[i] = v
+        return [by_id[i] for i in range(len(items))]
+
+grader = BatchGrader()
@@ -1,18 +1,30 @@
 # handlers.py
 from __future__ import annotations
-import re
-import logging
-from datetime import time as dtime
+import logging, time
+from zoneinfo import ZoneInfo
 from telegram import Update, ReplyKeyboardMarkup
 from telegram.constants import ChatAction
 from telegram.ext import ConversationHandler, CallbackContext, ContextTypes
 
 from services import (
     get_user, save_user, update_user_field,
-    save_lesson, ask_gemini, log_event,
+    save_lesson, log_event,
     seed_review_item, get_due_reviews, update_review_result, progress_summary,
-    generate_micro_lesson_json, generate_placement_questions, score_to_cefr
+    generate_placement_questions, score_to_cefr,
+    micro_lesson_prompt, parse_micro_lesson, fallback_micro_lesson, stream_gemini,
+    pick_bank_lesson, has_unseen_bank_lesson, refill_lesson_bank,
+    grade_answer, select_option, event_buffer, review_item_id,
+    apply_review_results, user_cache, UserPatch, unmark_user_blocked, record_placement_results, bank_media_urls,
+    normalize_reminder_time,
 )
+from prefetch import prefetcher
+from grader import grader
+from admission import admission
+from media_cache import media_cache
+from qa_cache import qa_cache, QA_PROMPT
+from streaming import ThrottledEditor, stream_stats
+import llm
+from config import ADMIN_CHAT_ID, REVIEW_SESSION_SIZE, DEFAULT_TIMEZONE, MEDIA_WARM_CHAT_ID
 
 logger = logging.getLogger(__name__)
 
@@ -105,8 +117,11 @@ def _intro_text():
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     is_registered = bool(u)
+    if u and u.get("blocked"):
+        # آنبلاک در تلگرام با /start برمی‌گردد؛ یادآور و اعلان مرور دوباره فعال می‌شوند
+        await unmark_user_blocked(update.effective_user.id)
     await update.message.reply_text(_intro_text(), reply_markup=_quick_actions_menu(is_registered))
     if not is_registered:
         await update.message.reply_text("اول «📋 ثبت‌نام»، بعد «🧪 تعیین سطح»، سپس «📚 شروع درس».")
@@ -136,7 +151,7 @@ async def register_age(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def register_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["email"] = update.message.text
-    save_user(update.effective_user.id, {
+    await save_user(update.effective_user.id, {
         "name": context.user_data.get("name"),
         "age": context.user_data.get("age"),
         "email": context.user_data.get("email"),
@@ -154,8 +169,11 @@ async def register_set_level(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def register_set_goal(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["goal"] = update.message.text
-    save_user(update.effective_user.id, context.user_data)
-    log_event(update.effective_user.id, "register_completed", {})
+    # بعد از ری‌استارت یا جریان نیمه‌کاره ممکن است بعضی کلیدها در user_data نباشند؛ None روی مقدار موجود نوشته نشود
+    async with UserPatch(update.effective_user.id) as p:
+        p.update({k: context.user_data[k] for k in ("name", "age", "email", "level", "goal")
+                  if context.user_data.get(k) is not None})
+    await log_event(update.effective_user.id, "register_completed", {})
     await update.message.reply_text("✅ ثبت‌نام انجام شد!", reply_markup=main_menu(True))
     return ConversationHandler.END
 
@@ -173,13 +191,13 @@ async def edit_field(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def edit_value(update: Update, context: ContextTypes.DEFAULT_TYPE):
     field = context.user_data["field"]
     value = update.message.text
-    update_user_field(update.effective_user.id, field, value)
+    await update_user_field(update.effective_user.id, field, value)
     await update.message.reply_text("✅ بروزرسانی انجام شد!", reply_markup=main_menu(True))
     return ConversationHandler.END
 
 # ---- View Info ----
 async def view_info(update: Update, _context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return
@@ -200,17 +218,59 @@ async def qa_start(update: Update, _context: ContextTypes.DEFAULT_TYPE):
 
 async def qa_answer(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     question = update.message.text
-    log_event(update.effective_user.id, "qa_asked", {"q": question})
-    answer = ask_gemini(f"Answer this English learning question in simple terms: {question}") or "Sorry, try again later."
-    await update.message.reply_text(f"💡 پاسخ: {answer}", reply_markup=main_menu(True))
+    await log_event(update.effective_user.id, "qa_asked", {"q": question})
+    cached = qa_cache.cached(question)
+    if cached is not None:
+        await update.message.reply_text(f"💡 پاسخ: {cached}", reply_markup=main_menu(True))
+        return ConversationHandler.END
+
+    # کیبورد اصلی همین‌جا برمی‌گردد؛ edit فقط متن را عوض می‌کند
+    msg = await update.message.reply_text("💡 ...", reply_markup=main_menu(True))
+    editor = ThrottledEditor(msg)
+    started = time.perf_counter()
+    answer = ""
+    try:
+        async for answer in stream_gemini(QA_PROMPT.format(question=question)):
+            await editor.update(f"💡 پاسخ: {answer}")
+    except llm.StreamInterrupted as e:
+        # جواب ناقص نشان داده می‌شود ولی هرگز کش نمی‌شود
+        await editor.finish(f"💡 پاسخ: {e.text}\n\n⚠️ پاسخ ناقص ماند؛ دوباره بپرس." if e.text
+                            else "💡 پاسخ: Sorry, try again later.")
+        return ConversationHandler.END
+    if answer:
+        await qa_cache.remember(question, answer, time.perf_counter() - started)
+    await editor.finish(f"💡 پاسخ: {answer or 'Sorry, try again later.'}")
     return ConversationHandler.END
 
 # ---- Lesson ----
+def _render_vocab_line(v: dict) -> str:
+    return f"- {v.get('word')} /{v.get('ipa','')}/ = {v.get('meaning_fa','')}\n  e.g. {v.get('example','')}"
+
+async def _stream_micro_lesson(update: Update, level: str, goal: str, weaknesses: list) -> tuple[dict, ThrottledEditor]:
+    """
+    تولید زندهٔ درس با استریم: واژه‌ها به محض کامل شدن (پیش از تمرین‌ها) روی همان پیام
+    placeholder نشان داده می‌شوند. خروجی نامعتبر → درس fallback.
+    """
+    header = "📖 در حال ساخت درس شخصی‌سازی‌شده..."
+    msg = await update.message.reply_text(header)
+    editor = ThrottledEditor(msg)
+    vocab = llm.JSONArrayStream("vocab")
+    sys, prompt = micro_lesson_prompt(level, goal, weaknesses)
+    raw = ""
+    try:
+        async for raw in stream_gemini(prompt, system=sys):
+            if vocab.feed(raw):
+                lines = [_render_vocab_line(v) for v in vocab.items[:3] if isinstance(v, dict)]
+                await editor.update(header + "\n\n📌 واژگان:\n\n" + "\n".join(lines))
+    except llm.StreamInterrupted:
+        raw = ""  # JSON ناقص → درس fallback
+    j = parse_micro_lesson(raw) or fallback_micro_lesson(level, goal, weaknesses)
+    return j, editor
+
 def _render_lesson_from_json(j: dict) -> tuple[str, str]:
     parts = ["📌 واژگان:\n"]
     for v in (j.get("vocab") or [])[:3]:
-        line = f"- {v.get('word')} /{v.get('ipa','')}/ = {v.get('meaning_fa','')}\n  e.g. {v.get('example','')}"
-        parts.append(line)
+        parts.append(_render_vocab_line(v))
     parts.append("\n🧩 جمله‌ها:\n")
     for s in (j.get("sentences") or []):
         parts.append(f"- {s}")
@@ -229,108 +289,198 @@ def _render_lesson_from_json(j: dict) -> tuple[str, str]:
         exercise_text = "Exercise: " + (first.get("prompt") or "")
     return content, exercise_text
 
+def _local_feedback(ex: dict, is_correct: bool) -> str:
+    if is_correct:
+        return "CORRECT ✅"
+    options = ex.get("options") or []
+    idx = ex.get("answer_index")
+    if options and idx is not None and 0 <= idx < len(options):
+        return f"WRONG ❌ پاسخ درست: {chr(65 + idx)}) {options[idx]}"
+    return f"WRONG ❌ پاسخ درست: {ex.get('answer_text', '')}"
+
+def _grading_unavailable(ex: dict | None) -> str:
+    # LLM شلوغ/قطع است (shed یا مدارشکن)؛ به‌جای جواب خالی دست‌کم پاسخ نمونه
+    sample = (ex or {}).get("answer_text")
+    txt = "⏳ تصحیح خودکار الان در دسترس نیست."
+    return f"{txt} پاسخ نمونه: {sample}" if sample else txt
+
 async def lesson_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return ConversationHandler.END
 
-    await update.message.reply_text("📖 در حال ساخت درس شخصی‌سازی‌شده...")
     level = u.get("cefr") or u.get("level") or "A1"
     goal = u.get("goal", "General")
     weaknesses = u.get("weaknesses", [])
 
-    j = generate_micro_lesson_json(level, goal, weaknesses)
+    editor = None
+    j = await prefetcher.take(u)
+    if j is None:
+        j, bank_left = await pick_bank_lesson(u, level, goal)
+    else:
+        bank_left = await has_unseen_bank_lesson(u, level, goal)
+    if j is None:
+        j, editor = await _stream_micro_lesson(update, level, goal, weaknesses)
     content, exercise = _render_lesson_from_json(j)
-    save_lesson(u["user_id"], content, exercise, json_payload=j)
+    await save_lesson(u["user_id"], content, exercise, json_payload=j)
 
+    ex0 = (j.get("exercises") or [None])[0] or {}
     context.user_data["exercise"] = exercise
-    seed_review_item(u["user_id"], exercise)
-    log_event(u["user_id"], "lesson_started", {"cefr": level})
+    context.user_data["exercise_json"] = ex0
+    await seed_review_item(u["user_id"], exercise, payload=ex0 or None)
+    await log_event(u["user_id"], "lesson_started", {"cefr": level})
 
-    await update.message.reply_text(f"✨ درس امروز:\n\n{content}")
-    ex0 = (j.get("exercises") or [None])[0] or {}
+    if editor is not None:
+        await editor.finish(f"✨ درس امروز:\n\n{content}")
+    else:
+        await update.message.reply_text(f"✨ درس امروز:\n\n{content}")
     if (ex0.get("type") == "listening") and ex0.get("media_url"):
-        try:
-            await update.message.reply_audio(audio=ex0["media_url"])
-        except Exception:
-            pass
+        await media_cache.send_audio(context.bot, update.effective_chat.id, ex0["media_url"])
     await update.message.reply_text(f"📝 {exercise}")
+    # تا کاربر جواب می‌دهد، درس بعدی‌اش در پس‌زمینه ساخته می‌شود؛ ولی فقط وقتی بانک برای
+    # این کاربر/سطح درس دیده‌نشده‌ای ندارد (وگرنه درس بعدی مجانی از بانک می‌آید)
+    if not bank_left:
+        prefetcher.schedule(u)
     return ASK_EXERCISE
 
 async def lesson_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text
     exercise = context.user_data.get("exercise", "")
-    u = get_user(update.effective_user.id)
-    weaknesses = u.get("weaknesses", []) if u else []
-
-    prompt = (
-        f"You are an English teacher.\n"
-        f"Exercise: {exercise}\n"
-        f"Student's answer: {answer}\n"
-        f"Weakness hints: {', '.join(weaknesses)}\n"
-        "Return one word: CORRECT or WRONG. Then a short reason (<=15 words) + a tiny tip."
-    )
-    feedback = ask_gemini(prompt) or ""
-    item_id = f"ex_{abs(hash(exercise))}"
-    is_correct = "correct" in feedback.lower()
+    ex = context.user_data.get("exercise_json")
 
-    stats = update_review_result(update.effective_user.id, item_id, is_correct)
-    log_event(update.effective_user.id, "review_answered_correct" if is_correct else "review_answered_wrong", {})
+    is_correct = grade_answer(ex, answer)
+    if is_correct is not None:
+        feedback = _local_feedback(ex, is_correct)
+    else:
+        u = await get_user(update.effective_user.id)
+        weaknesses = u.get("weaknesses", []) if u else []
+        is_correct, feedback = await grader.grade(exercise, answer, ", ".join(weaknesses))
+        feedback = feedback or _grading_unavailable(ex)
+
+    stats = None
+    if is_correct is not None:
+        # قطعی LLM نباید برنامهٔ مرور یا آمار پیشرفت را خراب کند؛ فقط جواب نمره‌گرفته ثبت می‌شود
+        stats = await update_review_result(update.effective_user.id, review_item_id(exercise), is_correct)
+        await log_event(update.effective_user.id,
+                        "review_answered_correct" if is_correct else "review_answered_wrong", {})
 
     await update.message.reply_text(f"✅ جواب دریافت شد:\n\n{answer}")
     extra = f"\n(نوبت بعدی مرور: {stats.get('interval', 1)} روز دیگر)" if stats else ""
     await update.message.reply_text(f"🔎 فیدبک: {feedback}{extra}", reply_markup=main_menu(True))
     return ConversationHandler.END
 
+async def prewarm_media_job(context: CallbackContext):
+    if not MEDIA_WARM_CHAT_ID:
+        return
+    warmed = await media_cache.prewarm(context.bot, MEDIA_WARM_CHAT_ID, await bank_media_urls())
+    if warmed:
+        logger.info("Media cache prewarmed %d files", warmed)
+
+async def refresh_lesson_bank_job(_context: CallbackContext):
+    with llm.background():
+        created = await refill_lesson_bank()
+    if created:
+        logger.info("Lesson bank refilled with %d lessons", created)
+
 # ---- Review (SRS) ----
+# یک جلسهٔ مرور: N آیتم موعددار با یک کوئری بارگذاری و در user_data نگه داشته می‌شوند؛
+# نتیجه‌ها در پایان جلسه (یا لغو/تایم‌اوت) با یک bulk_write ثبت می‌شوند.
 async def review_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return ConversationHandler.END
 
-    due = get_due_reviews(u["user_id"], limit=1)
+    due = await get_due_reviews(u["user_id"], limit=REVIEW_SESSION_SIZE)
     if not due:
         await update.message.reply_text("🎉 فعلاً آیتم موعددار نداری. بعداً برگرد!", reply_markup=main_menu(True))
         return ConversationHandler.END
 
-    item = due[0]
-    context.user_data["review_item_id"] = item["item_id"]
-    context.user_data["review_exercise"] = item["exercise"]
+    context.user_data["review_queue"] = [
+        {"item_id": d["item_id"], "exercise": d["exercise"], "payload": d.get("payload")} for d in due
+    ]
+    context.user_data["review_results"] = []
+    context.user_data["review_ungraded"] = 0
+    return await _send_review_item(update, context)
+
+def _review_pos(context: ContextTypes.DEFAULT_TYPE) -> int:
+    # آیتم‌هایی که به‌خاطر قطعی LLM نمره نگرفتند در results نیستند ولی از آن‌ها رد شده‌ایم
+    return len(context.user_data.get("review_results") or []) + context.user_data.get("review_ungraded", 0)
 
-    await update.message.reply_text(f"🔁 مرور:\n\n{item['exercise']}", reply_markup=cancel_button())
+async def _send_review_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    queue = context.user_data["review_queue"]
+    idx = _review_pos(context)
+    await update.message.reply_text(
+        f"🔁 مرور {idx + 1}/{len(queue)}:\n\n{queue[idx]['exercise']}", reply_markup=cancel_button()
+    )
     return REVIEW_ITEM
 
+async def _finish_review_session(update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple[int, int]:
+    results = context.user_data.pop("review_results", None) or []
+    context.user_data.pop("review_queue", None)
+    context.user_data.pop("review_ungraded", None)
+    if results:
+        await apply_review_results(update.effective_user.id, results)
+    correct = sum(1 for _, ok in results if ok)
+    return correct, len(results) - correct
+
 async def review_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     answer = update.message.text
-    exercise = context.user_data.get("review_exercise")
-    item_id = context.user_data.get("review_item_id")
-
-    prompt = (
-        f"You are an English teacher.\n"
-        f"Exercise: {exercise}\n"
-        f"Student's answer: {answer}\n"
-        "Return one word: CORRECT or WRONG. Then a short reason (<=15 words)."
-    )
-    feedback = ask_gemini(prompt) or ""
-    is_correct = "correct" in feedback.lower()
+    queue = context.user_data.get("review_queue") or []
+    results = context.user_data.get("review_results")
+    if results is None or _review_pos(context) >= len(queue):
+        await update.message.reply_text("پایان مرور.", reply_markup=main_menu(True))
+        return ConversationHandler.END
+    item = queue[_review_pos(context)]
+    payload = item.get("payload")
 
-    stats = update_review_result(update.effective_user.id, item_id, is_correct)
-    log_event(update.effective_user.id, "review_answered_correct" if is_correct else "review_answered_wrong", {})
+    is_correct = grade_answer(payload, answer)
+    if is_correct is not None:
+        feedback = _local_feedback(payload, is_correct)
+    else:
+        is_correct, feedback = await grader.grade(item["exercise"], answer)
+        feedback = feedback or _grading_unavailable(payload)
 
-    result = "✅ درست" if is_correct else "❌ غلط"
-    extra = f"\n(نوبت بعدی: {stats.get('interval', 1)} روز دیگر)" if stats else ""
-    await update.message.reply_text(f"{result}\n{feedback}{extra}", reply_markup=main_menu(True))
+    if is_correct is None:
+        # بدون نمره: آیتم موعددار می‌ماند و در جلسهٔ بعد دوباره می‌آید
+        context.user_data["review_ungraded"] = context.user_data.get("review_ungraded", 0) + 1
+        result = "⏸ بدون نمره"
+    else:
+        results.append((item["item_id"], is_correct))
+        await log_event(update.effective_user.id,
+                        "review_answered_correct" if is_correct else "review_answered_wrong", {})
+        result = "✅ درست" if is_correct else "❌ غلط"
+    await update.message.reply_text(f"{result}\n{feedback}")
+    if _review_pos(context) < len(queue):
+        return await _send_review_item(update, context)
+
+    correct, wrong = await _finish_review_session(update, context)
+    await update.message.reply_text(
+        f"🏁 پایان مرور! ✅ {correct} درست، ❌ {wrong} غلط", reply_markup=main_menu(True)
+    )
     return ConversationHandler.END
 
+async def review_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _finish_review_session(update, context)
+    return await cancel(update, context)
+
+async def review_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    correct, wrong = await _finish_review_session(update, context)
+    if correct or wrong:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=f"⏳ جلسهٔ مرور بسته شد. ✅ {correct} درست، ❌ {wrong} غلط ثبت شد.",
+            reply_markup=main_menu(True),
+        )
+
 # ---- Progress ----
 async def progress(update: Update, _context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return
-    summary = progress_summary(u["user_id"])
+    summary = await progress_summary(u["user_id"])
     txt = (
         f"📊 پیشرفت شما\n"
         f"• درس‌های انجام‌شده: {summary['lessons_done']}\n"
@@ -342,7 +492,7 @@ async def progress(update: Update, _context: ContextTypes.DEFAULT_TYPE):
 
 # ---- Settings + Reminder ----
 async def settings(update: Update, _context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return ConversationHandler.END
@@ -350,6 +500,7 @@ async def settings(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "⚙️ تنظیمات:\n"
         "برای فعال‌سازی یادآور روزانه، ساعت را به صورت HH:MM بفرست (مثلاً 20:30)\n"
+        f"منطقهٔ زمانی پیش‌فرض {DEFAULT_TIMEZONE} است؛ برای تغییر: 20:30 Asia/Tehran\n"
         "برای خاموش: OFF",
         reply_markup=cancel_button()
     )
@@ -360,50 +511,40 @@ async def settings_handle(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
 
     if text.upper() == "OFF":
-        update_user_field(uid, "reminder_enabled", False)
-        update_user_field(uid, "reminder_time", None)
+        await UserPatch(uid).set("reminder_enabled", False).set("reminder_time", None).commit()
         await update.message.reply_text("⏰ یادآور خاموش شد.", reply_markup=main_menu(True))
         return ConversationHandler.END
 
     try:
-        hh, mm = map(int, text.split(":"))
-        assert 0 <= hh < 24 and 0 <= mm < 60
+        clock, *rest = text.split()
+        reminder_time = normalize_reminder_time(clock)
+        if reminder_time is None or len(rest) > 1:
+            raise ValueError(text)
+        tz = rest[0] if rest else DEFAULT_TIMEZONE
+        ZoneInfo(tz)
     except Exception:
-        await update.message.reply_text("⛔️ فرمت ساعت نادرست است. نمونه: 20:30", reply_markup=cancel_button())
+        await update.message.reply_text("⛔️ فرمت نادرست است. نمونه: 20:30 یا 20:30 Asia/Tehran",
+                                        reply_markup=cancel_button())
         return SETTINGS_FIELD
 
-    update_user_field(uid, "reminder_time", text)
-    update_user_field(uid, "reminder_enabled", True)
-
-    for old in context.job_queue.get_jobs_by_name(f"reminder_{uid}"):
-        old.schedule_removal()
-
-    context.job_queue.run_daily(
-        callback=send_daily_reminder,
-        time=dtime(hour=hh, minute=mm),  # به وقت سرور/UTC
-        chat_id=uid,
-        name=f"reminder_{uid}",
-    )
+    # زمان‌بندی از روی همین فیلدها (reminders.reminder_tick) انجام می‌شود و با ری‌استارت از بین نمی‌رود
+    await UserPatch(uid).set("reminder_time", reminder_time).set("tz", tz).set("reminder_enabled", True).commit()
 
     await update.message.reply_text(
-        f"✅ یادآور روزانه روی {text} تنظیم شد.",
+        f"✅ یادآور روزانه روی {reminder_time} ({tz}) تنظیم شد.",
         reply_markup=main_menu(True)
     )
     return ConversationHandler.END
 
-async def send_daily_reminder(context: CallbackContext):
-    chat_id = context.job.chat_id
-    await context.bot.send_message(chat_id=chat_id, text="🕒 وقت درسه! روی /lesson بزن 😊")
-
 # ---- Placement (Dynamic) ----
 async def placement_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    u = get_user(update.effective_user.id)
+    u = await get_user(update.effective_user.id)
     if not u:
         await update.message.reply_text("⚠️ ابتدا ثبت‌نام کنید.", reply_markup=main_menu(False))
         return ConversationHandler.END
 
     level_hint = u.get("level") or u.get("cefr") or "Beginner"
-    qs = generate_placement_questions(level_hint)
+    qs = await generate_placement_questions(level_hint)
     if not qs:
         await update.message.reply_text("⛔️ فعلاً نتوانستم سؤال‌های تعیین‌سطح بسازم. بعداً دوباره تلاش کن.")
         return ConversationHandler.END
@@ -412,15 +553,13 @@ async def placement_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["pl_idx"] = 0
     context.user_data["pl_score"] = 0
     context.user_data["pl_wrong_tags"] = {}
+    context.user_data["pl_results"] = []
 
     item = qs[0]
     kb = _placement_keyboard(item.get("options"))
     await update.message.reply_text("🧪 تعیین‌سطح شروع شد. لطفاً پاسخ بده.")
     if item.get("type") == "listening" and item.get("media_url"):
-        try:
-            await update.message.reply_audio(audio=item["media_url"])
-        except Exception:
-            pass
+        await media_cache.send_audio(context.bot, update.effective_chat.id, item["media_url"])
     await update.message.reply_text(_render_question_dyn(item, 0, len(qs)), reply_markup=kb)
     return PLACEMENT_Q
 
@@ -444,16 +583,7 @@ async def placement_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     correct = False
 
     if options:
-        selected = None
-        if len(text) >= 1 and text[0].upper() in "ABCDEFGHIJKLMNOPQRSTUVWXYZ":
-            pos = ord(text[0].upper()) - 65
-            if 0 <= pos < len(options):
-                selected = pos
-        if selected is None:
-            for i, opt in enumerate(options):
-                if text.lower() == (opt or "").lower():
-                    selected = i
-                    break
+        selected = select_option(text, options)
         if selected is None:
             await update.message.reply_text("⛔️ لطفاً یکی از گزینه‌ها را انتخاب کنید.")
             kb = _placement_keyboard(options)
@@ -461,11 +591,10 @@ async def placement_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return PLACEMENT_Q
         correct = (selected == item.get("answer_index"))
     else:
-        ans = (item.get("answer_text") or "").strip().lower()
-        user_ans = text.strip().lower()
-        norm = lambda s: re.sub(r"[^a-z0-9 ']", "", s)
-        correct = norm(user_ans) == norm(ans)
+        correct = bool(grade_answer(item, text))
 
+    if item.get("item_id"):
+        context.user_data.setdefault("pl_results", []).append([item["item_id"], correct])
     if correct:
         score += 1
         await update.message.reply_text("✅ درست!")
@@ -487,28 +616,28 @@ async def placement_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         nxt = qs[idx]
         kb = _placement_keyboard(nxt.get("options"))
         if nxt.get("type") == "listening" and nxt.get("media_url"):
-            try:
-                await update.message.reply_audio(audio=nxt["media_url"])
-            except Exception:
-                pass
+            await media_cache.send_audio(context.bot, update.effective_chat.id, nxt["media_url"])
         await update.message.reply_text(_render_question_dyn(nxt, idx, len(qs)), reply_markup=kb)
         return PLACEMENT_Q
 
     # پایان آزمون
     cefr = score_to_cefr(score, len(qs))
-    update_user_field(update.effective_user.id, "cefr", cefr)
-    update_user_field(update.effective_user.id, "level", cefr)
-
     sorted_weak = sorted(wrong_tags.items(), key=lambda kv: kv[1], reverse=True)
     top3 = [t for t, c in sorted_weak[:3]]
-    if top3:
-        update_user_field(update.effective_user.id, "weaknesses", top3)
+    async with UserPatch(update.effective_user.id) as p:
+        p.set("cefr", cefr).set("level", cefr)
+        if top3:
+            p.set("weaknesses", top3)
 
     try:
-        log_event(update.effective_user.id, "placement_completed",
+        await log_event(update.effective_user.id, "placement_completed",
                   {"score": score, "total": len(qs), "cefr": cefr, "weak": top3})
     except Exception:
         pass
+    try:
+        await record_placement_results([tuple(r) for r in context.user_data.pop("pl_results", [])])
+    except Exception:
+        logger.exception("Recording placement item stats failed")
 
     weak_txt = ("ضعف‌ها: " + ", ".join(top3)) if top3 else "ضعف خاصی ثبت نشد."
     await update.message.reply_text(
@@ -521,6 +650,74 @@ async def placement_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     return ConversationHandler.END
 
+# ---- Admin stats ----
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not ADMIN_CHAT_ID or update.effective_user.id != ADMIN_CHAT_ID:
+        return
+    p = prefetcher.stats
+    e = event_buffer.stats
+    c = user_cache.stats
+    txt = (
+        "📈 آمار داخلی\n"
+        f"• prefetch: hit={p['hit']} miss={p['miss']} stale={p['stale']} "
+        f"(hit rate {prefetcher.hit_rate():.0%})\n"
+        f"  scheduled={p['scheduled']} generated={p['generated']} failed={p['failed']} dropped={p['dropped']}\n"
+        f"• events: written={e['events']} flushes={e['flushes']} avg_batch={event_buffer.avg_batch():.1f} "
+        f"max_batch={e['max_batch']} dropped={e['dropped']} errors={e['errors']}\n"
+        f"• user cache: hit rate {user_cache.hit_rate():.0%} hits={c['hits']} misses={c['misses']} "
+        f"evictions={c['evictions']} invalidations={c['invalidations']}\n"
+    )
+    q = qa_cache.stats
+    txt += (
+        f"• qa cache: hit rate {qa_cache.hit_rate():.0%} hits={q['hits']} misses={q['misses']} "
+        f"size={len(qa_cache)} saved≈{q['saved_seconds']:.0f}s\n"
+    )
+    for flow, a in admission.stats.items():
+        txt += (
+            f"• admission {flow}: admitted={a['admitted']} "
+            f"user_throttled={a['user_throttled']} global_throttled={a['global_throttled']}\n"
+        )
+    m = media_cache.stats
+    txt += (
+        f"• media: file_id sends={m['cached_sends']} avg {media_cache.avg_ms('cached'):.0f}ms, "
+        f"url sends={m['url_sends']} avg {media_cache.avg_ms('url'):.0f}ms, "
+        f"failed={m['failed']} stale={m['stale_ids']} prewarmed={m['prewarmed']}\n"
+    )
+    g = grader.stats
+    txt += (
+        f"• grader: requests={g['requests']} batches={g['batches']} avg_batch={grader.avg_batch():.1f} "
+        f"max_batch={g['max_batch']} added_wait={grader.avg_wait_ms():.0f}ms fallbacks={g['fallbacks']}\n"
+    )
+    client = llm.get_client()
+    ls = client.stats
+    txt += (
+        f"• llm: calls={ls['calls']} coalesced={ls['coalesced']} streams={ls['streams']} "
+        f"429={ls['rate_limited']} retries={ls['retries']} failed={ls['failed']}\n"
+        f"  breaker={client.breaker.state} (opened {client.breaker.opened}x) "
+        f"short_circuited={ls['short_circuited']} shed={ls['deadline_shed']}\n"
+    )
+    for cls, q in client.queue_stats().items():
+        txt += (
+            f"  {cls}: depth={q['depth']} active={q['active']} avg_wait={q['avg_wait']:.2f}s "
+            f"max_wait={q['max_wait']:.2f}s shed={q['shed']}\n"
+        )
+    n = stream_stats["streams"]
+    if n:
+        txt += (
+            f"• streaming: avg first content {stream_stats['first_visible_seconds'] / n:.1f}s "
+            f"vs full {stream_stats['total_seconds'] / n:.1f}s, edits/reply={stream_stats['edits'] / n:.1f}\n"
+        )
+    us = getattr(context.application.update_processor, "stats", None)
+    if us:
+        txt += (
+            f"• updates: processed={us['processed']} active={context.application.update_processor.active} "
+            f"max_active={us['max_active']} waited_for_user={us['waited_for_user']}\n"
+        )
+    ps = getattr(context.application.persistence, "stats", None)
+    if ps:
+        txt += f"• persistence: flushes={ps['flushes']} writes={ps['writes']} errors={ps['errors']}\n"
+    await update.message.reply_text(txt)
+
 # ---- Cancel ----
 async def cancel(update: Update, _context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ عملیات لغو شد.", reply_markup=main_menu(True))
@@ -0,0 +1,467 @@
+# llm.py
+from __future__ import annotations
+import os, re, asyncio, hashlib, json, logging, random, time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional
+
+from config import (
+    GEMINI_API_KEY, PROXY_URL, REQUEST_TIMEOUT,
+    LLM_BACKEND, LLM_MODEL, LLM_MAX_CONCURRENCY, LLM_FAKE_LATENCY, LLM_FAKE_429_RATE,
+    LLM_INTERACTIVE_CONCURRENCY, LLM_BACKGROUND_CONCURRENCY, LLM_INTERACTIVE_DEADLINE,
+    LLM_RETRY_MAX, LLM_RETRY_BASE, LLM_RETRY_BUDGET_RATIO, LLM_RETRY_BUDGET_CAP,
+    LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN,
+)
+
+logger = logging.getLogger(__name__)
+
+_JSON_RE = re.compile(r"(\{.*\}|\[.*\])", re.S)
+
+def extract_json(text: str) -> str:
+    m = _JSON_RE.search(text)
+    return m.group(1) if m else text
+
+class JSONArrayStream:
+    """
+    پارسر افزایشی برای خروجی در حال استریم: عناصر کامل‌شدهٔ آرایهٔ key (مثلاً "vocab")
+    را به محض بسته شدن برمی‌گرداند، بدون اینکه منتظر بقیهٔ JSON بماند.
+    """
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, key: str):
+        self._key_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+        self._pos: Optional[int] = None
+        self.items: List[Any] = []
+        self.closed = False
+
+    def feed(self, text: str) -> List[Any]:
+        """text کل متن دریافت‌شده تا الان است؛ عناصر تازه را برمی‌گرداند."""
+        new: List[Any] = []
+        if self._pos is None:
+            m = self._key_re.search(text)
+            if not m:
+                return new
+            self._pos = m.end()
+        while not self.closed:
+            i = self._pos
+            while i < len(text) and text[i] in " \t\r\n,":
+                i += 1
+            if i >= len(text):
+                break
+            if text[i] == "]":
+                self.closed = True
+                break
+            try:
+                value, end = self._decoder.raw_decode(text, i)
+            except ValueError:
+                break  # هنوز کامل نشده
+            if end >= len(text) and not isinstance(value, (dict, list, str)):
+                break  # عدد/literal انتهای بافر ممکن است نصفه باشد
+            self.items.append(value)
+            new.append(value)
+            self._pos = end
+        return new
+
+# ---------- Backends ----------
+class GeminiBackend:
+    """
+    یک بار configure می‌شود و مدل‌ها (به ازای هر system prompt) نگه داشته می‌شوند
+    تا کانکشن gRPC بین درخواست‌ها reuse شود.
+    """
+    name = "gemini"
+
+    def __init__(self, api_key: str, model_name: str = LLM_MODEL, proxy_url: str = PROXY_URL):
+        import google.generativeai as genai  # pip install google-generativeai
+        if proxy_url:
+            # gRPC فقط پراکسی HTTP(S) را از env می‌خواند (نه socks)
+            for var in ("grpc_proxy", "https_proxy", "http_proxy"):
+                os.environ.setdefault(var, proxy_url)
+        genai.configure(api_key=api_key)
+        self._genai = genai
+        self._model_name = model_name
+        self._models: Dict[Optional[str], Any] = {}
+
+    def _model(self, system: Optional[str]):
+        model = self._models.get(system)
+        if model is None:
+            model = self._genai.GenerativeModel(self._model_name, system_instruction=system)
+            self._models[system] = model
+        return model
+
+    async def generate(self, prompt: str, system: Optional[str], timeout: float) -> str:
+        resp = await self._model(system).generate_content_async(
+            prompt, request_options={"timeout": timeout}
+        )
+        return (getattr(resp, "text", "") or "").strip()
+
+    async def stream(self, prompt: str, system: Optional[str], timeout: float) -> AsyncIterator[str]:
+        resp = await self._model(system).generate_content_async(
+            prompt, stream=True, request_options={"timeout": timeout}
+        )
+        async for chunk in resp:
+            text = getattr(chunk, "text", "")
+            if text:
+                yield text
+
+class FakeRateLimited(Exception):
+    """429 ساختگی FakeBackend برای تست retry و مدارشکن."""
+    code = 429
+
+class FakeBackend:
+    """
+    بک‌اند آفلاین برای تست و بنچمارک: با تأخیر ساختگی جواب قطعی برمی‌گرداند.
+    در حالت JSON همان قالب JSON داخل prompt را پس می‌دهد (که همیشه معتبر است).
+    """
+    name = "fake"
+
+    def __init__(self, latency: float = LLM_FAKE_LATENCY, rate_limit_rate: float = LLM_FAKE_429_RATE):
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.calls = 0
+
+    async def generate(self, prompt: str, system: Optional[str], timeout: float) -> str:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.rate_limit_rate:
+            raise FakeRateLimited("fake 429")
+        return self._answer(prompt)
+
+    async def stream(self, prompt: str, system: Optional[str], timeout: float) -> AsyncIterator[str]:
+        # همان جواب generate در ۸ تکه و با همان تأخیر کل
+        self.calls += 1
+        if random.random() < self.rate_limit_rate:
+            raise FakeRateLimited("fake 429")
+        text = self._answer(prompt)
+        step = max(1, len(text) // 8)
+        for i in range(0, len(text), step):
+            if self.latency:
+                await asyncio.sleep(self.latency / 8)
+            yield text[i:i + step]
+
+    @staticmethod
+    def _answer(prompt: str) -> str:
+        m = _JSON_RE.search(prompt)
+        if m:
+            return m.group(1)
+        return "CORRECT. (offline fake answer)"
+
+# ---------- Scheduling ----------
+# کلاس اولویت از contextvar خوانده می‌شود تا لازم نباشد در همهٔ توابع services پاس داده شود:
+#   with llm.background(): await refill_lesson_bank()
+INTERACTIVE, BACKGROUND = "interactive", "background"
+_priority: ContextVar[str] = ContextVar("llm_priority", default=INTERACTIVE)
+
+@contextmanager
+def background() -> Iterator[None]:
+    token = _priority.set(BACKGROUND)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+class Shed(Exception):
+    """درخواست پیش از گرفتن نوبت به deadline رسید."""
+
+class StreamInterrupted(Exception):
+    """استریم وسط کار قطع شد (تایم‌اوت/خطا)؛ text متن ناقصی است که تا آن لحظه رسیده بود."""
+
+    def __init__(self, text: str):
+        super().__init__(f"LLM stream interrupted after {len(text)} chars")
+        self.text = text
+
+class PriorityGate:
+    """
+    صف اولویت جلوی LLM: سقف کل + سقف هر کلاس. با آزاد شدن هر جا، اول منتظرهای interactive
+    و بعد background نوبت می‌گیرند؛ منتظری که deadline‌اش بگذرد Shed می‌گیرد.
+    """
+
+    def __init__(self, total: int, caps: Dict[str, int]):
+        self.total = total
+        self.caps = caps
+        self.active = {c: 0 for c in caps}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {c: deque() for c in caps}
+        self.stats = {c: {"admitted": 0, "shed": 0, "wait_seconds": 0.0, "max_wait": 0.0} for c in caps}
+
+    def depth(self, cls: str) -> int:
+        return sum(1 for f in self._waiters[cls] if not f.done())
+
+    def _can_run(self, cls: str) -> bool:
+        return self.active[cls] < self.caps[cls] and sum(self.active.values()) < self.total
+
+    async def acquire(self, cls: str, deadline: Optional[float]) -> None:
+        started = time.monotonic()
+        higher_waiting = cls == BACKGROUND and self.depth(INTERACTIVE)
+        if not self.depth(cls) and not higher_waiting and self._can_run(cls):
+            self.active[cls] += 1
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            self._waiters[cls].append(fut)
+            timeout = None if deadline is None else max(0.0, deadline - started)
+            try:
+                await asyncio.wait_for(fut, timeout)
+            except asyncio.TimeoutError:
+                self.stats[cls]["shed"] += 1
+                raise Shed() from None
+            finally:
+                if not fut.done() or fut.cancelled():
+                    try:
+                        self._waiters[cls].remove(fut)
+                    except ValueError:
+                        pass
+        waited = time.monotonic() - started
+        st = self.stats[cls]
+        st["admitted"] += 1
+        st["wait_seconds"] += waited
+        st["max_wait"] = max(st["max_wait"], waited)
+
+    def release(self, cls: str) -> None:
+        self.active[cls] -= 1
+        for c in (INTERACTIVE, BACKGROUND):
+            waiters = self._waiters[c]
+            while waiters and self._can_run(c):
+                fut = waiters.popleft()
+                if fut.done():
+                    continue
+                self.active[c] += 1
+                fut.set_result(None)
+
+class RetryBudget:
+    """هر درخواست موفق ratio توکن می‌دهد و هر retry یکی می‌گیرد؛ در طوفان 429 retryها تکثیر نمی‌شوند."""
+
+    def __init__(self, ratio: float, cap: float):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+
+    def earn(self) -> None:
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def spend(self) -> bool:
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+class CircuitBreaker:
+    """
+    بعد از threshold شکست پشت‌سرهم باز می‌شود و تا cooldown همه فوراً fallback می‌گیرند؛
+    بعد یک درخواست آزمایشی (half-open) تصمیم می‌گیرد بسته شود یا دوباره باز بماند.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self._opened_at >= self.cooldown:
+            self.state = "half-open"
+        if self.state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.state, self.failures, self._probing = "closed", 0, False
+
+    def cancel_probe(self) -> None:
+        """درخواست آزمایشی بدون نتیجه تمام شد (shed/قطع)؛ درخواست بعدی می‌تواند آزمایش کند."""
+        self._probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        self._probing = False
+        if self.state == "half-open" or self.failures >= self.threshold:
+            if self.state != "open":
+                self.opened += 1
+                logger.warning("LLM circuit breaker opened after %d failures", self.failures)
+            self.state = "open"
+            self._opened_at = time.monotonic()
+
+def is_rate_limited(exc: BaseException) -> bool:
+    # google.api_core: ResourceExhausted / TooManyRequests (هر دو code=429)
+    return getattr(exc, "code", None) == 429 or type(exc).__name__ in ("ResourceExhausted", "TooManyRequests")
+
+# ---------- Client ----------
+def _flight_key(prompt: str, system: Optional[str], json_mode: bool, priority: str) -> str:
+    h = hashlib.sha1()
+    for part in (system or "", prompt, "json" if json_mode else "text", priority):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+class LLMClient:
+    """
+    درخواست‌های همزمانِ یکسان (system, prompt, json_mode) single-flight می‌شوند:
+    فقط یکی به مدل می‌رود و بقیه منتظر همان نتیجه می‌مانند.
+    جلوی مدل PriorityGate (interactive/background)، retry با backoff روی 429 در حد RetryBudget
+    و CircuitBreaker است؛ هر جا جواب به‌موقع نرسد None برمی‌گردد و صدازننده fallback می‌دهد.
+    """
+
+    def __init__(self, backend, max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = REQUEST_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.gate = PriorityGate(max_concurrency, {
+            INTERACTIVE: min(max_concurrency, LLM_INTERACTIVE_CONCURRENCY or max_concurrency),
+            BACKGROUND: min(max_concurrency, LLM_BACKGROUND_CONCURRENCY),
+        })
+        self.deadlines = {INTERACTIVE: LLM_INTERACTIVE_DEADLINE or None, BACKGROUND: None}
+        self.budget = RetryBudget(LLM_RETRY_BUDGET_RATIO, cap=LLM_RETRY_BUDGET_CAP)
+        self.breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, int] = {
+            "calls": 0, "coalesced": 0, "streams": 0,
+            "rate_limited": 0, "retries": 0, "failed": 0, "short_circuited": 0, "deadline_shed": 0,
+        }
+
+    def _deadline(self, priority: str) -> Optional[float]:
+        budget = self.deadlines.get(priority)
+        return time.monotonic() + budget if budget else None
+
+    async def ask(self, prompt: str, system: Optional[str] = None, json_mode: bool = False) -> Optional[str]:
+        if self.backend is None:
+            return None
+        priority = _priority.get()
+        key = _flight_key(prompt, system, json_mode, priority)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._ask(prompt, system, json_mode, priority, self._deadline(priority)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key, None) if self._inflight.get(key) is t else None)
+            self.stats["calls"] += 1
+        else:
+            self.stats["coalesced"] += 1
+        # shield: لغو شدن یک منتظر، فراخوانی مشترک را برای بقیه لغو نکند
+        return await asyncio.shield(task)
+
+    async def _admit(self, priority: str, deadline: Optional[float]) -> bool:
+        if not self.breaker.allow():
+            self.stats["short_circuited"] += 1
+            return False
+        try:
+            await self.gate.acquire(priority, deadline)
+        except Shed:
+            self.stats["deadline_shed"] += 1
+            self.breaker.cancel_probe()
+            return False
+        return True
+
+    async def _ask(self, prompt: str, system: Optional[str], json_mode: bool,
+                   priority: str, deadline: Optional[float]) -> Optional[str]:
+        if not await self._admit(priority, deadline):
+            return None
+        probe = self.breaker.state == "half-open"
+        try:
+            text = await self._generate_with_retries(prompt, system, deadline)
+        finally:
+            self.gate.release(priority)
+            # shed در deadline، لغو یا خطای پیش‌بینی‌نشده هم نباید درخواست آزمایشی را قفل نگه دارد
+            if probe:
+                self.breaker.cancel_probe()
+        if not text:
+            return None
+        return extract_json(text) if json_mode else text
+
+    async def _generate_with_retries(self, prompt: str, system: Optional[str],
+                                     deadline: Optional[float]) -> Optional[str]:
+        for attempt in range(LLM_RETRY_MAX + 1):
+            timeout = self.timeout if deadline is None else min(self.timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                self.stats["deadline_shed"] += 1
+                return None
+            try:
+                text = await asyncio.wait_for(self.backend.generate(prompt, system, timeout), timeout=timeout)
+            except Exception as e:
+                if is_rate_limited(e):
+                    self.stats["rate_limited"] += 1
+                    backoff = random.uniform(0, LLM_RETRY_BASE * 2 ** attempt)  # full jitter
+                    fits = deadline is None or time.monotonic() + backoff < deadline
+                    if attempt < LLM_RETRY_MAX and fits and self.budget.spend():
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(backoff)
+                        continue
+                    logger.warning("LLM rate limited; giving up after %d attempts", attempt + 1)
+                elif isinstance(e, asyncio.TimeoutError):
+                    logger.warning("LLM call timed out after %.1fs", timeout)
+                else:
+                    logger.exception("LLM call failed")
+                self.stats["failed"] += 1
+                self.breaker.failure()
+                return None
+            self.breaker.success()
+            self.budget.earn()
+            return text
+        return None
+
+    def queue_stats(self) -> Dict[str, Dict[str, float]]:
+        return {
+            cls: {**st, "depth": self.gate.depth(cls), "active": self.gate.active[cls],
+                  "avg_wait": st["wait_seconds"] / st["admitted"] if st["admitted"] else 0.0}
+            for cls, st in self.gate.stats.items()
+        }
+
+    async def stream(self, prompt: str, system: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        متن تجمعی (نه فقط تکهٔ تازه) را با رسیدن هر chunk yield می‌کند. single-flight و retry ندارد.
+        بدون backend یا نوبت (مدارشکن/deadline) چیزی yield نمی‌شود؛ خطا/تایم‌اوت وسط استریم لاگ و
+        به شکل StreamInterrupted بالا داده می‌شود تا متن ناقص با جواب کامل اشتباه گرفته نشود.
+        """
+        if self.backend is None:
+            return
+        priority = _priority.get()
+        if not await self._admit(priority, self._deadline(priority)):
+            return
+        probe = self.breaker.state == "half-open"
+        text = ""
+        self.stats["streams"] += 1
+        try:
+            async with asyncio.timeout(self.timeout):
+                async for chunk in self.backend.stream(prompt, system, self.timeout):
+                    text += chunk
+                    yield text
+            self.breaker.success()
+        except TimeoutError as e:
+            self.breaker.failure()
+            logger.warning("LLM stream timed out after %.1fs (%d chars received)", self.timeout, len(text))
+            raise StreamInterrupted(text) from e
+        except Exception as e:
+            self.breaker.failure()
+            self.stats["rate_limited" if is_rate_limited(e) else "failed"] += 1
+            logger.exception("LLM stream failed")
+            raise StreamInterrupted(text) from e
+        finally:
+            if probe:
+                self.breaker.cancel_probe()
+            self.gate.release(priority)
+
+def _make_backend():
+    if LLM_BACKEND == "fake":
+        return FakeBackend()
+    api_key = GEMINI_API_KEY.strip()
+    if not api_key:
+        return None
+    try:
+        return GeminiBackend(api_key)
+    except ModuleNotFoundError:
+        return None
+
+_client: Optional[LLMClient] = None
+
+def get_client() -> LLMClient:
+    global _client
+    if _client is None:
+        _client = LLMClient(_make_backend())
+    return _client
+
+def set_client(client: LLMClient) -> None:
+    """برای تست/بنچمارک: جایگزینی کلاینت سراسری (مثلاً با FakeBackend)."""
+    global _client
+    _client = client
@@ -0,0 +1,144 @@
+# loadtest.py
+# تست بار end-to-end در یک پروسه: Bot API ساختگی (fake_telegram) + Application کامل main.py + LLM ساختگی.
+# تأخیر هر آپدیت = از ورود به update_queue تا اولین sendMessage ربات به همان چت.
+#   python loadtest.py --users 200 --rounds 10 --slow-users 20 --llm-latency 5
+#   UPDATE_CONCURRENCY=1 python loadtest.py ...     ← پردازش ترتیبی قبلی، برای مقایسه
+# کاربران «کند» مدام پرسش‌وپاسخ می‌فرستند (هر جواب llm-latency ثانیه استریم می‌شود) و بقیه /start؛
+# p50/p99 کاربران /start نشان می‌دهد یک فراخوانی کند LLM بقیه را معطل می‌کند یا نه.
+# به Mongo واقعی (MONGO_URI) نیاز دارد؛ پیش‌فرض DB_NAME=english_coach_loadtest.
+from __future__ import annotations
+import argparse, asyncio, itertools, os, threading, time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+QA_BUTTON = "❓ پرسش‌وپاسخ"
+SLOW_WORDS = ["tense", "article", "modal", "passive", "gerund", "phrasal", "clause", "idiom", "stress", "plural"]
+
+def _configure(args) -> None:
+    # config.py متغیرها را موقع import می‌خواند
+    os.environ.setdefault("BOT_TOKEN", "123456:loadtest")
+    os.environ.setdefault("DB_NAME", "english_coach_loadtest")
+    os.environ.setdefault("ADMISSION_ENABLED", "0")
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["LLM_FAKE_LATENCY"] = str(args.llm_latency)
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.api_port}"
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+async def _run(args) -> None:
+    from telegram import Update
+    import fake_telegram
+    from main import build_application
+
+    server = fake_telegram.make_server("127.0.0.1", args.api_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    loop = asyncio.get_running_loop()
+    sent: Dict[int, List[float]] = defaultdict(list)           # chat → زمان هر sendMessage
+    waiters: Dict[int, Tuple[int, asyncio.Future]] = {}
+    lost = 0
+
+    def _record(chat_id: int, ts: float) -> None:
+        sent[chat_id].append(ts)
+        waiter = waiters.get(chat_id)
+        if waiter is not None and len(sent[chat_id]) >= waiter[0]:
+            del waiters[chat_id]
+            if not waiter[1].done():
+                waiter[1].set_result(None)
+
+    def on_call(method: str, params: dict) -> None:
+        if method == "sendMessage":
+            loop.call_soon_threadsafe(_record, int(params.get("chat_id") or 0), time.perf_counter())
+
+    fake_telegram._FakeApi.on_call = on_call
+
+    app = build_application(with_updater=False, background_jobs=False)
+    update_ids = itertools.count(1)
+
+    async def send(user_id: int, text: str, replies: int = 1) -> Optional[float]:
+        """تا رسیدن هر replies پیام این آپدیت صبر می‌کند تا پیام‌های دیرِ آن به آپدیت بعدی نسبت داده نشوند."""
+        nonlocal lost
+        base = len(sent[user_id])
+        fut = loop.create_future()
+        waiters[user_id] = (base + replies, fut)
+        t0 = time.perf_counter()
+        await app.update_queue.put(Update.de_json(fake_telegram.make_update(next(update_ids), user_id, text), app.bot))
+        try:
+            await asyncio.wait_for(fut, args.timeout)
+        except asyncio.TimeoutError:
+            waiters.pop(user_id, None)
+            lost += 1
+            return None
+        return sent[user_id][base] - t0
+
+    stop = asyncio.Event()
+    slow_done = 0
+
+    async def slow_user(user_id: int) -> None:
+        nonlocal slow_done
+        for n in itertools.count():
+            if stop.is_set():
+                return
+            await send(user_id, QA_BUTTON)
+            # سؤال یکتا تا از کش پرسش‌وپاسخ جواب نگیرد
+            topic = SLOW_WORDS[(user_id + n) % len(SLOW_WORDS)]
+            await send(user_id, f"Explain {topic} case u{user_id}n{n} v{user_id}m{n} w{user_id}k{n}")
+            slow_done += 1
+
+    fast_latencies: List[float] = []
+
+    async def fast_user(user_id: int) -> None:
+        for _ in range(args.rounds):
+            latency = await send(user_id, "/start", replies=2)  # معرفی + راهنمای قدم بعد
+            if latency is not None:
+                fast_latencies.append(latency)
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        slow = [asyncio.create_task(slow_user(1_000 + i)) for i in range(args.slow_users)]
+        await asyncio.sleep(args.warmup)  # فراخوانی‌های کند LLM در جریان باشند
+        t0 = time.perf_counter()
+        await asyncio.gather(*(fast_user(100_000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await asyncio.gather(*slow, return_exceptions=True)
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        server.shutdown()
+
+    ms = lambda v: v * 1000
+    n = len(fast_latencies)
+    print(
+        f"concurrency={app.update_processor.max_concurrent_updates} slow_users={args.slow_users} "
+        f"llm_latency={args.llm_latency}s\n"
+        f"/start: {n} updates in {elapsed:.2f}s → {n / elapsed:.0f} upd/s "
+        f"p50={ms(_percentile(fast_latencies, 0.5)):.1f}ms p99={ms(_percentile(fast_latencies, 0.99)):.1f}ms "
+        f"max={ms(max(fast_latencies, default=0.0)):.1f}ms\n"
+        f"slow Q&A questions sent during the run: {slow_done}, replies lost: {lost}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="In-process end-to-end load test against the fake Bot API")
+    parser.add_argument("--users", type=int, default=200, help="کاربرانی که /start می‌فرستند")
+    parser.add_argument("--rounds", type=int, default=10, help="/start پشت‌سرهم برای هر کاربر")
+    parser.add_argument("--slow-users", type=int, default=20, help="کاربرانی که مدام پرسش‌وپاسخ LLM می‌فرستند")
+    parser.add_argument("--llm-latency", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="بعدش پاسخ گم‌شده حساب می‌شود")
+    parser.add_argument("--api-port", type=int, default=8089)
+    args = parser.parse_args()
+    _configure(args)
+    asyncio.run(_run(args))
+
+if __name__ == "__main__":
+    main()
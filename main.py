@@ -1,4 +1,5 @@
 # main.py
+import asyncio
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -6,15 +7,56 @@ from telegram.ext import (
     ConversationHandler,
     filters,
     JobQueue,
+    TypeHandler,
+)
+from telegram import Update
+from config import (
+    BOT_TOKEN, LESSON_BANK_REFRESH_MINUTES, REVIEW_SESSION_TIMEOUT, USER_CACHE_CHANGE_STREAM,
+    REVIEW_SWEEP_MINUTES, TELEGRAM_API_URL, MEDIA_PREWARM_MINUTES, UPDATE_CONCURRENCY,
 )
-from config import BOT_TOKEN
 import handlers
+import reminders
+import services
+from prefetch import prefetcher
+from qa_cache import qa_cache
+from admission import admission
+from persistence import MongoPersistence
+from update_processor import PerUserUpdateProcessor
 
-def main():
-    app = Application.builder()\
+_background_tasks = []
+
+async def post_init(_app: Application) -> None:
+    await services.ensure_indexes()
+    await services.event_buffer.start()
+    await prefetcher.start()
+    await qa_cache.load()
+    if USER_CACHE_CHANGE_STREAM:
+        _background_tasks.append(asyncio.create_task(services.watch_user_changes()))
+
+async def post_shutdown(_app: Application) -> None:
+    for t in _background_tasks:
+        t.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await prefetcher.stop()
+    await services.event_buffer.stop()
+
+def build_application(with_updater: bool = True, background_jobs: bool = True) -> Application:
+    """
+    اپلیکیشن با همهٔ هندلرها. webhook.py همین را بدون updater (آپدیت‌ها از dispatcher می‌آیند)
+    و فقط روی یک worker با jobهای پس‌زمینه می‌سازد. آپدیت‌های کاربران مختلف همزمان پردازش
+    می‌شوند و آپدیت‌های هر کاربر به ترتیب (PerUserUpdateProcessor).
+    """
+    builder = Application.builder()\
         .token(BOT_TOKEN)\
+        .base_url(f"{TELEGRAM_API_URL}/bot")\
         .job_queue(JobQueue())\
-        .build()
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))\
+        .post_init(post_init)\
+        .post_shutdown(post_shutdown)\
+        .persistence(MongoPersistence())
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # --- Register conversation ---
     reg_conv = ConversationHandler(
@@ -29,7 +71,7 @@ def main():
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="register_conv",
-        persistent=False,
+        persistent=True,
     )
 
     # --- Edit conversation ---
@@ -41,7 +83,7 @@ def main():
         },
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="edit_conv",
-        persistent=False,
+        persistent=True,
     )
 
     # --- Q&A conversation ---
@@ -50,7 +92,7 @@ def main():
         states={handlers.ASK_QUESTION: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.qa_answer)]},
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="qa_conv",
-        persistent=False,
+        persistent=True,
     )
 
     # --- Lesson conversation ---
@@ -59,16 +101,20 @@ def main():
         states={handlers.ASK_EXERCISE: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.lesson_answer)]},
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="lesson_conv",
-        persistent=False,
+        persistent=True,
     )
 
     # --- Review conversation ---
     review_conv = ConversationHandler(
         entry_points=[MessageHandler(filters.Regex("^🔁 مرور$"), handlers.review_start)],
-        states={handlers.REVIEW_ITEM: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.review_answer)]},
-        fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
+        states={
+            handlers.REVIEW_ITEM: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.review_answer)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, handlers.review_timeout)],
+        },
+        fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.review_cancel)],
         name="review_conv",
-        persistent=False,
+        persistent=True,
+        conversation_timeout=REVIEW_SESSION_TIMEOUT,
     )
 
     # --- Settings conversation ---
@@ -77,7 +123,7 @@ def main():
         states={handlers.SETTINGS_FIELD: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.settings_handle)]},
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="settings_conv",
-        persistent=False,
+        persistent=True,
     )
 
     # --- Placement conversation ---
@@ -86,9 +132,12 @@ def main():
         states={handlers.PLACEMENT_Q: [MessageHandler(filters.TEXT & ~filters.Regex("^❌ لغو$"), handlers.placement_answer)]},
         fallbacks=[MessageHandler(filters.Regex("^❌ لغو$"), handlers.cancel)],
         name="placement_conv",
-        persistent=False,
+        persistent=True,
     )
 
+    # --- Admission control (قبل از همهٔ هندلرها) ---
+    app.add_handler(TypeHandler(Update, admission.check), group=-1)
+
     # --- Commands ---
     app.add_handler(CommandHandler("start", handlers.start))
     app.add_handler(CommandHandler("help", handlers.help_command))
@@ -97,6 +146,7 @@ def main():
     app.add_handler(CommandHandler("progress", handlers.progress))
     app.add_handler(CommandHandler("settings", handlers.settings))
     app.add_handler(CommandHandler("placement", handlers.placement_start))
+    app.add_handler(CommandHandler("stats", handlers.admin_stats))
 
     # --- Menus & flows ---
     app.add_handler(reg_conv)
@@ -111,9 +161,29 @@ def main():
     app.add_handler(MessageHandler(filters.Regex("^📖 مشاهده اطلاعات$"), handlers.view_info))
     app.add_handler(MessageHandler(filters.Regex("^📊 پیشرفت$"), handlers.progress))
 
+    # --- Background jobs ---
+    if background_jobs:
+        app.job_queue.run_repeating(reminders.reminder_tick, interval=reminders.TICK_SECONDS, first=5, name="reminders")
+        app.job_queue.run_repeating(
+            reminders.review_sweep_job, interval=REVIEW_SWEEP_MINUTES * 60, first=60, name="review_sweep"
+        )
+        app.job_queue.run_repeating(
+            handlers.refresh_lesson_bank_job,
+            interval=LESSON_BANK_REFRESH_MINUTES * 60,
+            first=30,
+            name="lesson_bank_refresh",
+        )
+        if MEDIA_PREWARM_MINUTES:
+            app.job_queue.run_repeating(
+                handlers.prewarm_media_job, interval=MEDIA_PREWARM_MINUTES * 60, first=120, name="media_prewarm"
+            )
+
     # --- Error handler ---
     app.add_error_handler(handlers.error_handler)
+    return app
 
+def main():
+    app = build_application()
     print("🤖 Bot is running...")
     app.run_polling()
 
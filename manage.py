@@ -0,0 +1,79 @@
+# manage.py
+# دستورات نگهداری دیتابیس؛ مثال:  python manage.py backfill-progress
+import argparse
+import asyncio
+
+import llm
+import services
+
+async def _backfill_progress(_args) -> None:
+    await services.ensure_indexes()
+    n = await services.backfill_progress()
+    print(f"✅ progress rollups rebuilt for {n} users")
+
+async def _migrate_review_ids(_args) -> None:
+    report = await services.migrate_review_ids()
+    print(f"✅ reviews: users={report['users']} renamed={report['renamed']} merged={report['merged']}")
+    await services.ensure_indexes()  # حالا ایندکس unique (user_id, item_id) ساخته می‌شود
+
+async def _migrate_reminder_times(_args) -> None:
+    report = await services.migrate_reminder_times()
+    print(f"✅ reminder_time: normalized={report['normalized']} disabled={report['disabled']}")
+
+async def _warm_qa_cache(_args) -> None:
+    from qa_cache import qa_cache
+    await services.ensure_indexes()
+    await qa_cache.load()
+    with llm.background():
+        n = await qa_cache.warm()
+    print(f"✅ qa cache: {n} new answers ({len(qa_cache)} total)")
+
+async def _seed_placement_bank(_args) -> None:
+    await services.ensure_indexes()
+    with llm.background():
+        added = await services.seed_placement_bank()
+    print("✅ placement items added: " + ", ".join(f"{b}={n}" for b, n in added.items()))
+
+async def _bench_reviews(args) -> None:
+    import bench
+    print(await bench.bench_reviews(docs=args.docs, ops=args.ops))
+
+async def _bench_progress(args) -> None:
+    import bench
+    print(await bench.bench_progress(events=args.events, users=args.users, ops=args.ops))
+
+COMMANDS = {
+    "backfill-progress": (_backfill_progress, "rebuild per-user progress rollups from events/lessons"),
+    "bench-progress": (_bench_progress, "benchmark /progress: events aggregation vs progress rollup (bench DB)"),
+    "bench-reviews": (_bench_reviews, "benchmark review answers: find+update vs atomic pipeline (bench DB)"),
+    "migrate-reminder-times": (_migrate_reminder_times, "rewrite legacy reminder_time values like 8:30 as 08:30"),
+    "migrate-review-ids": (_migrate_review_ids, "switch reviews to stable item ids and merge duplicates"),
+    "seed-placement-bank": (_seed_placement_bank, "import cached placement sets and fill coverage gaps"),
+    "warm-qa-cache": (_warm_qa_cache, "pre-answer the most frequent qa_asked questions"),
+}
+
+# آرگومان‌های دستوراتی که دارند
+ARGS = {
+    "bench-progress": [
+        ("--events", dict(type=int, default=1_000_000)),
+        ("--users", dict(type=int, default=1_000)),
+        ("--ops", dict(type=int, default=500, help="/progress reads per path")),
+    ],
+    "bench-reviews": [
+        ("--docs", dict(type=int, default=1_000_000)),
+        ("--ops", dict(type=int, default=2_000, help="review answers per path")),
+    ],
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="English coach maintenance commands")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, (_fn, help_text) in COMMANDS.items():
+        cmd = sub.add_parser(name, help=help_text)
+        for flag, kwargs in ARGS.get(name, []):
+            cmd.add_argument(flag, **kwargs)
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command][0](args))
+
+if __name__ == "__main__":
+    main()
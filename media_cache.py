@@ -0,0 +1,163 @@
+# media_cache.py
+from __future__ import annotations
+import hashlib, logging, time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Union
+
+from telegram import Bot, InputFile, Message
+from telegram.error import BadRequest, TelegramError
+
+from config import MEDIA_CACHE_SIZE
+from fanout import telegram_limiter
+from services import get_media_file_id, save_media_file_id, drop_media_file_id, touch_media
+
+logger = logging.getLogger(__name__)
+
+TOUCH_EVERY = 24 * 3600  # last_used در Mongo حداکثر روزی یک بار برای هر کلید به‌روز می‌شود
+
+def media_key(source: Union[str, bytes]) -> str:
+    """URL خودش کلید است؛ برای محتوای خام digest."""
+    if isinstance(source, bytes):
+        return "sha256:" + hashlib.sha256(source).hexdigest()
+    return source
+
+# BadRequest هم برای file_id نامعتبر است هم برای chat not found / caption خراب؛ فقط اولی کلید را پاک می‌کند
+_STALE_ID_ERRORS = ("wrong file identifier", "wrong remote file identifier", "file reference", "file_reference")
+
+def _is_stale_file_id(err: BadRequest) -> bool:
+    message = (err.message or "").lower()
+    return any(marker in message for marker in _STALE_ID_ERRORS)
+
+def _file_id(msg: Message) -> Optional[str]:
+    media = msg.audio or msg.voice or msg.document
+    return media.file_id if media else None
+
+class MediaCache:
+    """
+    media_url (یا digest محتوا) → file_id تلگرام. اولین ارسال موفق از URL، file_id را ذخیره می‌کند
+    و ارسال‌های بعدی بدون دانلود دوباره از همان file_id می‌روند. حافظه LRU است و Mongo با TTL
+    روی last_used مدیای بلااستفاده را پاک می‌کند.
+    """
+
+    def __init__(self, max_size: int = MEDIA_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, str]" = OrderedDict()
+        self._touched: Dict[str, float] = {}
+        self.stats: Dict[str, float] = {
+            "cached_sends": 0, "cached_seconds": 0.0, "url_sends": 0, "url_seconds": 0.0,
+            "failed": 0, "stale_ids": 0, "prewarmed": 0, "evictions": 0,
+        }
+
+    def avg_ms(self, kind: str) -> float:
+        n = self.stats[f"{kind}_sends"]
+        return 1000 * self.stats[f"{kind}_seconds"] / n if n else 0.0
+
+    def _remember(self, key: str, file_id: str) -> None:
+        self._ids[key] = file_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            old, _ = self._ids.popitem(last=False)
+            self._touched.pop(old, None)
+            self.stats["evictions"] += 1
+
+    async def file_id(self, key: str) -> Optional[str]:
+        file_id = self._ids.get(key)
+        if file_id is not None:
+            self._ids.move_to_end(key)
+            return file_id
+        try:
+            file_id = await get_media_file_id(key)
+        except Exception:
+            logger.warning("Media cache lookup failed", exc_info=True)
+            return None
+        if file_id:
+            self._remember(key, file_id)
+            self._touched[key] = time.monotonic()  # تازه از Mongo خوانده شد؛ لازم نیست فوراً touch شود
+        return file_id
+
+    async def _touch(self, key: str) -> None:
+        now = time.monotonic()
+        if now - self._touched.get(key, 0.0) < TOUCH_EVERY:
+            return
+        self._touched[key] = now
+        try:
+            await touch_media([key])
+        except Exception:
+            logger.warning("Media cache touch failed", exc_info=True)
+
+    async def _forget(self, key: str) -> None:
+        self._ids.pop(key, None)
+        self._touched.pop(key, None)
+        try:
+            await drop_media_file_id(key)
+        except Exception:
+            logger.warning("Dropping stale file_id failed", exc_info=True)
+
+    async def send_audio(self, bot: Bot, chat_id: int, source: Union[str, bytes], **kwargs) -> Optional[Message]:
+        """ارسال صوت با file_id کش‌شده، وگرنه از URL/محتوا؛ خطا لاگ می‌شود و None برمی‌گردد."""
+        key = media_key(source)
+        file_id = await self.file_id(key)
+        if file_id:
+            t0 = time.perf_counter()
+            try:
+                msg = await bot.send_audio(chat_id=chat_id, audio=file_id, **kwargs)
+            except BadRequest as e:
+                if not _is_stale_file_id(e):
+                    self.stats["failed"] += 1
+                    logger.warning("Sending cached audio to %s failed: %s", chat_id, e.message)
+                    return None
+                # file_id دیگر معتبر نیست (مثلاً توکن ربات عوض شده)؛ از منبع اصلی دوباره
+                self.stats["stale_ids"] += 1
+                await self._forget(key)
+            except TelegramError:
+                self.stats["failed"] += 1
+                logger.warning("Sending cached audio to %s failed", chat_id, exc_info=True)
+                return None
+            else:
+                self.stats["cached_sends"] += 1
+                self.stats["cached_seconds"] += time.perf_counter() - t0
+                await self._touch(key)
+                return msg
+
+        audio = InputFile(source, filename="audio.mp3") if isinstance(source, bytes) else source
+        t0 = time.perf_counter()
+        try:
+            msg = await bot.send_audio(chat_id=chat_id, audio=audio, **kwargs)
+        except TelegramError:
+            self.stats["failed"] += 1
+            logger.warning("Sending audio %s to %s failed", key[:100], chat_id, exc_info=True)
+            return None
+        self.stats["url_sends"] += 1
+        self.stats["url_seconds"] += time.perf_counter() - t0
+        new_id = _file_id(msg)
+        if new_id:
+            self._remember(key, new_id)
+            self._touched[key] = time.monotonic()
+            try:
+                await save_media_file_id(key, new_id)
+            except Exception:
+                logger.warning("Saving file_id failed", exc_info=True)
+        return msg
+
+    async def prewarm(self, bot: Bot, chat_id: int, urls: Iterable[str]) -> int:
+        """
+        برای آدرس‌هایی که file_id ندارند یک بار (بی‌صدا) در chat_id آپلود و پیام را پاک می‌کند.
+        زیر همان سقف ارسال سراسری fan-out.
+        """
+        warmed = 0
+        for url in urls:
+            if await self.file_id(media_key(url)):
+                continue
+            await telegram_limiter.acquire()
+            msg = await self.send_audio(bot, chat_id, url, disable_notification=True)
+            if msg is None:
+                continue
+            warmed += 1
+            try:
+                await msg.delete()
+            except TelegramError:
+                pass
+        self.stats["prewarmed"] += warmed
+        return warmed
+
+media_cache = MediaCache()
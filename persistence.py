@@ -0,0 +1,139 @@
+# persistence.py
+from __future__ import annotations
+import asyncio, json, logging
+from typing import Any, Dict, Optional, Tuple
+
+from pymongo import DeleteOne, ReplaceOne
+from telegram.ext import BasePersistence, PersistenceInput
+
+from config import PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_FLUSH_DELAY
+from services import db
+
+logger = logging.getLogger(__name__)
+
+conv_col = db["conversations"]
+user_data_col = db["user_data"]
+
+_DELETED = object()
+
+ConversationKey = Tuple[Any, ...]
+
+def _conv_id(name: str, key: ConversationKey) -> str:
+    return f"{name}:{json.dumps(list(key))}"
+
+class MongoPersistence(BasePersistence):
+    """
+    وضعیت ConversationHandlerها و user_data روی Mongo تا deploy/crash جلسهٔ کسی را از بین نبرد.
+    update_* فقط ورودی را dirty علامت می‌زند؛ همهٔ تغییرات یک دور update_persistence
+    با یک bulk_write برای هر کالکشن (write-behind) ثبت می‌شوند. flush() در shutdown بقیه را می‌نویسد.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL,
+                 flush_delay: float = PERSISTENCE_FLUSH_DELAY):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.flush_delay = flush_delay
+        self._dirty_convs: Dict[str, Tuple[str, ConversationKey, Any]] = {}
+        self._dirty_users: Dict[int, Any] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {"flushes": 0, "writes": 0, "errors": 0}
+
+    # ---- load ----
+    async def get_conversations(self, name: str) -> Dict[ConversationKey, object]:
+        # فقط گفتگوهای باز ذخیره می‌شوند (END → حذف)، پس این کالکشن کوچک می‌ماند
+        return {
+            tuple(doc["key"]): doc["state"]
+            async for doc in conv_col.find({"name": name}, {"_id": 0, "key": 1, "state": 1})
+        }
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {doc["_id"]: doc.get("data") or {} async for doc in user_data_col.find({})}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    # ---- write-behind ----
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        self._dirty_convs[_conv_id(name, key)] = (name, key, new_state)
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        self._dirty_users[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._dirty_users[user_id] = _DELETED
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        # update_persistence همهٔ update_*ها را با هم صدا می‌زند؛ کمی صبر تا همه در یک دسته بیایند
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        await self._write()
+
+    async def _write(self) -> None:
+        convs, self._dirty_convs = self._dirty_convs, {}
+        users, self._dirty_users = self._dirty_users, {}
+        conv_ops = [
+            DeleteOne({"_id": _id}) if state is None else
+            ReplaceOne({"_id": _id}, {"_id": _id, "name": name, "key": list(key), "state": state}, upsert=True)
+            for _id, (name, key, state) in convs.items()
+        ]
+        user_ops = [
+            DeleteOne({"_id": uid}) if data is _DELETED else
+            ReplaceOne({"_id": uid}, {"_id": uid, "data": data}, upsert=True)
+            for uid, data in users.items()
+        ]
+        try:
+            if conv_ops:
+                await conv_col.bulk_write(conv_ops, ordered=False)
+            if user_ops:
+                await user_data_col.bulk_write(user_ops, ordered=False)
+        except Exception:
+            self.stats["errors"] += 1
+            logger.exception("Persistence flush failed; %d entries will be retried", len(conv_ops) + len(user_ops))
+            # دادهٔ جدیدتر (اگر در این فاصله آمده) اولویت دارد
+            self._dirty_convs = {**convs, **self._dirty_convs}
+            self._dirty_users = {**users, **self._dirty_users}
+            return
+        if conv_ops or user_ops:
+            self.stats["flushes"] += 1
+            self.stats["writes"] += len(conv_ops) + len(user_ops)
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            await self._flush_task
+        await self._write()
+
+    # ---- unused stores ----
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
@@ -0,0 +1,88 @@
+# prefetch.py
+from __future__ import annotations
+import asyncio, logging
+from datetime import timedelta
+from typing import Dict, List, Optional, Set
+
+import llm
+from config import PREFETCH_WORKERS, PREFETCH_QUEUE_SIZE, PREFETCH_TTL_HOURS
+from services import (
+    generate_micro_lesson_llm, lesson_profile_key, normalize_level,
+    set_pending_lesson, take_pending_lesson,
+)
+
+logger = logging.getLogger(__name__)
+
+class LessonPrefetcher:
+    """
+    درس بعدی کاربر را در پس‌زمینه (با تعداد worker محدود) می‌سازد و روی سند کاربر
+    به‌عنوان pending_lesson ذخیره می‌کند تا lesson_start بعدی فوری جواب بدهد.
+    """
+
+    def __init__(self, workers: int = PREFETCH_WORKERS, queue_size: int = PREFETCH_QUEUE_SIZE,
+                 max_age: timedelta = timedelta(hours=PREFETCH_TTL_HOURS)):
+        self.workers = workers
+        self.max_age = max_age
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._queued: Set[int] = set()
+        self._tasks: List[asyncio.Task] = []
+        self.stats: Dict[str, int] = {
+            "hit": 0, "miss": 0, "stale": 0,
+            "scheduled": 0, "dropped": 0, "generated": 0, "failed": 0,
+        }
+
+    async def start(self) -> None:
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(), name=f"prefetch-{i}"))
+
+    async def stop(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def schedule(self, user: dict) -> None:
+        """بدون انتظار؛ اگر کاربر در صف است یا صف پر است کاری نمی‌کند."""
+        uid = user["user_id"]
+        if uid in self._queued:
+            return
+        try:
+            self._queue.put_nowait(user)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return
+        self._queued.add(uid)
+        self.stats["scheduled"] += 1
+
+    async def take(self, user: dict) -> Optional[dict]:
+        lesson, status = await take_pending_lesson(user, self.max_age)
+        self.stats[status] += 1
+        return lesson
+
+    def hit_rate(self) -> float:
+        served = self.stats["hit"] + self.stats["miss"] + self.stats["stale"]
+        return self.stats["hit"] / served if served else 0.0
+
+    async def _worker(self) -> None:
+        while True:
+            user = await self._queue.get()
+            try:
+                with llm.background():
+                    await self._prefetch(user)
+            except Exception:
+                self.stats["failed"] += 1
+                logger.exception("Lesson prefetch failed for user %s", user.get("user_id"))
+            finally:
+                self._queued.discard(user["user_id"])
+                self._queue.task_done()
+
+    async def _prefetch(self, user: dict) -> None:
+        level = normalize_level(user.get("cefr") or user.get("level"))
+        j = await generate_micro_lesson_llm(level, user.get("goal", "General"), user.get("weaknesses", []))
+        if not j:
+            self.stats["failed"] += 1
+            return
+        await set_pending_lesson(user["user_id"], lesson_profile_key(user), j)
+        self.stats["generated"] += 1
+
+prefetcher = LessonPrefetcher()
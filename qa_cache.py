@@ -0,0 +1,215 @@
+# qa_cache.py
+from __future__ import annotations
+import hashlib, logging, random, re
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from config import QA_CACHE_SIZE, QA_CACHE_THRESHOLD, QA_CACHE_WARM_TOP, QA_CACHE_MIN_TOKENS
+from services import ask_gemini, load_qa_answers, save_qa_answer, top_asked_questions
+
+logger = logging.getLogger(__name__)
+
+QA_PROMPT = "Answer this English learning question in simple terms: {question}"
+
+# فقط تعارف و قالب سؤال؛ کلمات نقشی (a/the، is/was، do/does، can/could/will/would، which/that،
+# حروف اضافه) خودشان موضوع سؤال‌های گرامری‌اند و باید در امضا بمانند
+_STOPWORDS = frozenset("""
+please pls plz tell explain explanation question about regarding i me my you your we
+""".split())
+# کلمات نقشی: سؤال کش‌شده فقط در کلمات محتوایی می‌تواند با سؤال جدید فرق داشته باشد؛
+# «a or the» با «a or an» یا «do vs does» با «can vs could» سؤال دیگری است
+_FUNCTION_WORDS = frozenset("""
+a an the and or not no is are am was were be been being do does did have has had
+can could may might must shall should will would which that who whom whose this these those
+some any much many few little to of in on at for since by with from into than as
+""".split())
+# قالب ابتدای سؤال («what is …»، «can you explain …») موضوع را عوض نمی‌کند
+_FRAMES = ("can you", "could you", "would you", "will you", "please", "pls", "plz", "tell me", "explain",
+           "what is", "what are", "what's", "whats")
+_CONTRACTIONS = {"what's": "what is", "whats": "what is", "don't": "do not", "doesn't": "does not",
+                 "isn't": "is not", "can't": "can not", "i'm": "i am"}
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+def normalize_question(text: str) -> FrozenSet[str]:
+    """مجموعهٔ کلمات سؤال (حروف کوچک، بدون قالب ابتدایی، علائم و تعارف، جمع ساده → مفرد)."""
+    text = (text or "").lower().strip()
+    stripped = True
+    while stripped:
+        stripped = False
+        for frame in _FRAMES:
+            if text.startswith(frame + " "):
+                text, stripped = text[len(frame) + 1:].lstrip(), True
+    words: List[str] = []
+    for w in _WORD_RE.findall(text):
+        words.extend(_CONTRACTIONS.get(w, w).split())
+    tokens = set()
+    for w in words:
+        w = w.strip("'")
+        if not w or w in _STOPWORDS:
+            continue
+        if len(w) > 4 and w.endswith("s") and not w.endswith("ss"):
+            w = w[:-1]
+        tokens.add(w)
+    return frozenset(tokens)
+
+def question_key(tokens: FrozenSet[str]) -> str:
+    return hashlib.sha1(" ".join(sorted(tokens)).encode("utf-8")).hexdigest()
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+class MinHashLSH:
+    """
+    ایندکس MinHash/LSH آفلاین: امضای num_perm تایی در bands باند خرد می‌شود و
+    هر سؤال فقط با سؤال‌هایی مقایسه می‌شود که حداقل در یک باند هم‌سطل باشند.
+    """
+    _PRIME = (1 << 61) - 1
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        assert num_perm % bands == 0
+        rnd = random.Random(seed)
+        self.rows = num_perm // bands
+        self.bands = bands
+        self._perms = [(rnd.randrange(1, self._PRIME), rnd.randrange(0, self._PRIME)) for _ in range(num_perm)]
+        self._buckets: List[Dict[Tuple[int, ...], Set[str]]] = [{} for _ in range(bands)]
+        self._bands_of: Dict[str, List[Tuple[int, ...]]] = {}
+
+    def _signature(self, tokens: FrozenSet[str]) -> List[int]:
+        hashes = [int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "big") for t in tokens]
+        return [min((a * h + b) % self._PRIME for h in hashes) for a, b in self._perms]
+
+    def _split(self, tokens: FrozenSet[str]) -> List[Tuple[int, ...]]:
+        sig = self._signature(tokens)
+        return [tuple(sig[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+    def add(self, key: str, tokens: FrozenSet[str]) -> None:
+        if key in self._bands_of or not tokens:
+            return
+        bands = self._split(tokens)
+        for i, band in enumerate(bands):
+            self._buckets[i].setdefault(band, set()).add(key)
+        self._bands_of[key] = bands
+
+    def remove(self, key: str) -> None:
+        for i, band in enumerate(self._bands_of.pop(key, [])):
+            bucket = self._buckets[i].get(band)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[i][band]
+
+    def candidates(self, tokens: FrozenSet[str]) -> Set[str]:
+        if not tokens:
+            return set()
+        out: Set[str] = set()
+        for i, band in enumerate(self._split(tokens)):
+            out |= self._buckets[i].get(band, set())
+        return out
+
+class QACache:
+    """
+    کش پاسخ پرسش‌وپاسخ: سؤال‌های تقریباً تکراری (Jaccard ≥ threshold روی کلمات نرمال‌شده)
+    از حافظه جواب می‌گیرند. پاسخ‌ها در qa_cache (Mongo) هم ذخیره می‌شوند تا بعد از ری‌استارت بمانند.
+    """
+
+    def __init__(self, max_size: int = QA_CACHE_SIZE, threshold: float = QA_CACHE_THRESHOLD,
+                 min_tokens: int = QA_CACHE_MIN_TOKENS):
+        self.max_size = max_size
+        self.threshold = threshold
+        self.min_tokens = max(1, min_tokens)
+        self._index = MinHashLSH()
+        self._entries: "OrderedDict[str, Tuple[FrozenSet[str], str]]" = OrderedDict()
+        self._llm_seconds = 0.0   # میانگین متحرک زمان پاسخ LLM؛ برای تخمین زمان صرفه‌جویی‌شده
+        self.stats: Dict[str, float] = {"hits": 0, "misses": 0, "stored": 0, "evictions": 0, "saved_seconds": 0.0}
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _tokens(self, question: str) -> Optional[FrozenSet[str]]:
+        """امضای سؤال؛ None اگر آن‌قدر کوتاه است که شباهت Jaccard رویش معنا ندارد."""
+        tokens = normalize_question(question)
+        return tokens if len(tokens) >= self.min_tokens else None
+
+    def lookup(self, question: str) -> Optional[str]:
+        tokens = self._tokens(question)
+        if tokens is None:
+            return None
+        best_key, best = None, 0.0
+        for key in self._index.candidates(tokens):
+            other = self._entries[key][0]
+            if (tokens ^ other) & _FUNCTION_WORDS:
+                continue
+            score = jaccard(tokens, other)
+            if score > best:
+                best_key, best = key, score
+        if best_key is None or best < self.threshold:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][1]
+
+    def put(self, question: str, answer: str) -> Optional[str]:
+        tokens = self._tokens(question)
+        if tokens is None or self.max_size <= 0:
+            return None
+        key = question_key(tokens)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        else:
+            self._index.add(key, tokens)
+        self._entries[key] = (tokens, answer)
+        while len(self._entries) > self.max_size:
+            old, _ = self._entries.popitem(last=False)
+            self._index.remove(old)
+            self.stats["evictions"] += 1
+        return key
+
+    async def load(self) -> None:
+        if self.max_size <= 0:
+            return
+        for doc in reversed(await load_qa_answers(self.max_size)):
+            self.put(doc["q"], doc["answer"])
+        logger.info("Q&A cache loaded %d answers", len(self))
+
+    def cached(self, question: str) -> Optional[str]:
+        """lookup همراه با آمار hit/miss؛ روی miss صدازننده باید بعداً remember() را صدا بزند."""
+        cached = self.lookup(question) if self.max_size > 0 else None
+        if cached is not None:
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += self._llm_seconds
+            return cached
+        self.stats["misses"] += 1
+        return None
+
+    async def remember(self, question: str, answer: str, llm_seconds: float) -> None:
+        self._llm_seconds = llm_seconds if not self._llm_seconds else 0.8 * self._llm_seconds + 0.2 * llm_seconds
+        await self._store(question, answer)
+
+    async def _store(self, question: str, answer: str) -> None:
+        key = self.put(question, answer)
+        if key is None:
+            return
+        self.stats["stored"] += 1
+        try:
+            await save_qa_answer(key, question, answer)
+        except Exception:
+            logger.exception("Saving Q&A answer failed")
+
+    async def warm(self, top: int = QA_CACHE_WARM_TOP) -> int:
+        """پرتکرارترین سؤال‌های qa_asked را (اگر مشابهشان در کش نیست) از قبل جواب می‌دهد."""
+        added = 0
+        for question in await top_asked_questions(top):
+            if self._tokens(question) is None or self.lookup(question) is not None:
+                continue
+            answer = await ask_gemini(QA_PROMPT.format(question=question))
+            if answer:
+                await self._store(question, answer)
+                added += 1
+        return added
+
+qa_cache = QACache()
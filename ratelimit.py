@@ -0,0 +1,61 @@
+# ratelimit.py
+from __future__ import annotations
+import asyncio, time
+
+class TokenBucket:
+    """
+    Token bucket ساده: rate توکن در ثانیه، حداکثر capacity توکن ذخیره.
+    acquire() منتظر می‌ماند؛ try_acquire() فوراً True/False برمی‌گرداند.
+    pause(seconds) کل سطل را برای مدتی قفل می‌کند (مثلاً بعد از RetryAfter تلگرام).
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        start = max(self._updated, self._paused_until)
+        if now > start:
+            self._tokens = min(self.capacity, self._tokens + (now - start) * self.rate)
+        self._updated = max(now, self._updated)
+
+    def try_acquire(self, tokens: float = 1.0) -> bool:
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+        self._refill(now)
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens: float = 1.0) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def wait_time(self, tokens: float = 1.0) -> float:
+        """چند ثانیه تا در دسترس بودن tokens (بدون برداشتن)."""
+        now = time.monotonic()
+        self._refill(now)
+        missing = max(0.0, tokens - self._tokens)
+        return max(0.0, self._paused_until - now) + missing / self.rate
+
+    def refund(self, tokens: float = 1.0) -> None:
+        self._tokens = min(self.capacity, self._tokens + tokens)
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
@@ -0,0 +1,71 @@
+# reminders.py
+from __future__ import annotations
+import logging, time
+from datetime import datetime, timedelta, UTC
+from typing import Dict
+
+from telegram.ext import CallbackContext
+
+from config import FANOUT_BATCH_SIZE, REVIEW_SWEEP_MINUTES
+from fanout import fan_out
+from services import (
+    acquire_lease, iter_due_reminder_users,
+    claim_review_sweep_range, sweep_new_due, due_review_counts, drop_blocked_users,
+)
+
+logger = logging.getLogger(__name__)
+
+REMINDER_TEXT = "🕒 وقت درسه! روی /lesson بزن 😊"
+TICK_SECONDS = 30  # کمتر از یک دقیقه تا هیچ دقیقه‌ای جا نماند؛ lease از اجرای دوباره جلوگیری می‌کند
+
+async def reminder_tick(context: CallbackContext) -> None:
+    """
+    هر TICK_SECONDS اجرا می‌شود. برنامه از روی users (reminder_enabled/tz/reminder_time) خوانده
+    می‌شود، پس با ری‌استارت از بین نمی‌رود؛ و با lease دقیقه‌ای فقط یک worker هر دقیقه را می‌فرستد.
+    """
+    minute = datetime.now(UTC).replace(second=0, microsecond=0)
+    if not await acquire_lease(f"reminders:{minute:%Y-%m-%dT%H:%M}", ttl=timedelta(hours=1)):
+        return
+    # ارسال ممکن است از یک دقیقه بیشتر طول بکشد؛ tickهای بعدی نباید منتظر بمانند
+    context.application.create_task(_send_minute(context, minute), name=f"reminders-{minute:%H:%M}")
+
+async def _send_minute(context: CallbackContext, minute: datetime) -> None:
+    label = f"reminders {minute:%H:%M}"
+    stats = await fan_out(context.bot, iter_due_reminder_users(minute, FANOUT_BATCH_SIZE), REMINDER_TEXT, label=label)
+    if stats["batches"]:
+        logger.info("%s done: sent=%d failed=%d blocked=%d in %.1fs", label,
+                    stats["sent"], stats["failed"], stats["blocked"], stats["seconds"])
+
+# ---- Due-review push ----
+async def review_sweep_job(context: CallbackContext) -> None:
+    """
+    هر REVIEW_SWEEP_MINUTES: فقط آیتم‌هایی که از آخرین sweep موعددار شده‌اند (range scan از watermark)
+    پیدا می‌شوند و به هر کاربر یک اعلان با تعداد کل آیتم‌های موعددارش ارسال می‌شود.
+    """
+    now = datetime.now(UTC)
+    claimed = await claim_review_sweep_range(now, first_lookback=timedelta(minutes=REVIEW_SWEEP_MINUTES))
+    if not claimed:
+        return
+    start, end = claimed
+    t0 = time.monotonic()
+    new_due, scanned = await sweep_new_due(start, end)
+    recipients = await drop_blocked_users(list(new_due)) if new_due else []
+    counts = await due_review_counts(recipients, now) if recipients else {}
+    logger.info("Review sweep (%s, %s]: scanned %d reviews, %d users (%d blocked), %.3fs",
+                f"{start:%H:%M:%S}", f"{end:%H:%M:%S}", scanned, len(new_due), len(new_due) - len(recipients),
+                time.monotonic() - t0)
+    if counts:
+        context.application.create_task(_push_due(context, counts), name="review-push")
+
+async def _push_due(context: CallbackContext, counts: Dict[int, int]) -> None:
+    user_ids = list(counts)
+
+    async def batches():
+        for i in range(0, len(user_ids), FANOUT_BATCH_SIZE):
+            yield user_ids[i:i + FANOUT_BATCH_SIZE]
+
+    await fan_out(
+        context.bot, batches(),
+        lambda uid: f"📬 {counts[uid]} کارت مرور موعددار داری! «🔁 مرور» رو بزن.",
+        label="review push",
+    )
@@ -1,13 +1,39 @@
 # services.py
 from __future__ import annotations
-import os, json, re
-from typing import Any, Dict, List, Optional, Tuple
-from datetime import datetime, timedelta, UTC
-from pymongo import MongoClient, ASCENDING, ReturnDocument
-from config import MONGO_URI, DB_NAME
+import asyncio, copy, hashlib, json, logging, os, random, re, socket, time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from datetime import date, datetime, timedelta, UTC
+from pymongo import ASCENDING, ReturnDocument, DeleteMany, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from motor.motor_asyncio import AsyncIOMotorClient
+from config import (
+    MONGO_URI, DB_NAME, MONGO_MAX_POOL_SIZE,
+    LESSON_BANK_PER_BUCKET, LESSON_BANK_TTL_DAYS, LESSON_BANK_MAX_BUCKETS, LESSON_SEEN_MAX,
+    PROGRESS_KEEP_DAYS,
+    EVENT_BUFFER_MAX, EVENT_BATCH_SIZE, EVENT_FLUSH_SECONDS, EVENT_BUFFER_POLICY,
+    USER_CACHE_SIZE, USER_CACHE_TTL, DEFAULT_TIMEZONE,
+    QA_CACHE_TTL_DAYS,
+    PLACEMENT_TEST_SIZE, PLACEMENT_BANK_TARGET, PLACEMENT_MIN_PER_TYPE,
+    PLACEMENT_MIN_RESPONSES, PLACEMENT_MIN_DISCRIMINATION, MEDIA_CACHE_TTL_DAYS,
+)
+import llm
+
+logger = logging.getLogger(__name__)
+
+# event loop فقط ارجاع ضعیف به taskها نگه می‌دارد؛ taskهای پس‌زمینه تا پایان اینجا می‌مانند
+_background_tasks: Set[asyncio.Task] = set()
+
+def spawn(coro: Any, name: Optional[str] = None) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
 
 # ---------- DB ----------
-mongo_client = MongoClient(MONGO_URI)
+# Motor (async driver) → هیچ کوئری‌ای event loop ربات را بلاک نمی‌کند.
+mongo_client = AsyncIOMotorClient(MONGO_URI, maxPoolSize=MONGO_MAX_POOL_SIZE, tz_aware=True)
 db = mongo_client[DB_NAME]
 
 users_col   = db["users"]
@@ -15,45 +41,403 @@ lessons_col = db["lessons"]
 reviews_col = db["reviews"]
 events_col  = db["events"]
 gen_col     = db["generated_cache"]  # cache for LLM outputs
+bank_col    = db["lesson_bank"]      # pre-generated micro-lessons
+progress_col = db["progress"]        # per-user rollups (daily counters + streak)
+locks_col   = db["locks"]            # leases for jobs that must run on exactly one worker
+state_col   = db["job_state"]        # watermarks of periodic jobs
+qa_col      = db["qa_cache"]         # answered free-form questions (see qa_cache.py)
+placement_col = db["placement_items"]  # validated placement questions + per-item response stats
+ratelimit_col = db["rate_limits"]      # token buckets shared between workers (see admission.py)
+media_col   = db["media_cache"]      # media url/digest → Telegram file_id (see media_cache.py)
 
 # ---------- Indexes ----------
-users_col.create_index([("user_id", ASCENDING)], unique=True)
-users_col.create_index([("level", ASCENDING)])
-users_col.create_index([("cefr", ASCENDING)])
-lessons_col.create_index([("user_id", ASCENDING), ("created_at", ASCENDING)])
-reviews_col.create_index([("user_id", ASCENDING), ("next_due", ASCENDING)])
-events_col.create_index([("user_id", ASCENDING), ("ts", ASCENDING)])
-gen_col.create_index([("key", ASCENDING)], unique=True)
+async def ensure_indexes() -> None:
+    """در post_init اپلیکیشن صدا زده می‌شود (Motor بیرون از event loop کار نمی‌کند)."""
+    await users_col.create_index([("user_id", ASCENDING)], unique=True)
+    await users_col.create_index([("level", ASCENDING)])
+    await users_col.create_index([("cefr", ASCENDING)])
+    await users_col.create_index([("reminder_enabled", ASCENDING), ("tz", ASCENDING), ("reminder_time", ASCENDING)])
+    await locks_col.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    await lessons_col.create_index([("user_id", ASCENDING), ("created_at", ASCENDING)])
+    await reviews_col.create_index([("user_id", ASCENDING), ("next_due", ASCENDING)])
+    await reviews_col.create_index([("next_due", ASCENDING), ("user_id", ASCENDING)])
+    try:
+        await reviews_col.create_index([("user_id", ASCENDING), ("item_id", ASCENDING)], unique=True)
+    except OperationFailure:
+        logger.warning("reviews has duplicate (user_id, item_id) pairs; run `python manage.py migrate-review-ids`")
+    await events_col.create_index([("user_id", ASCENDING), ("ts", ASCENDING)])
+    await gen_col.create_index([("key", ASCENDING)], unique=True)
+    await bank_col.create_index([("level", ASCENDING), ("goal", ASCENDING), ("tag", ASCENDING)])
+    await progress_col.create_index([("user_id", ASCENDING)], unique=True)
+    await bank_col.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    await ratelimit_col.create_index([("expires_at", ASCENDING)], expireAfterSeconds=0)
+    await media_col.create_index([("last_used", ASCENDING)], expireAfterSeconds=MEDIA_CACHE_TTL_DAYS * 86400)
+    await placement_col.create_index([("band", ASCENDING), ("rand", ASCENDING)])
+    await placement_col.create_index([("band", ASCENDING), ("type", ASCENDING)])
+    await qa_col.create_index([("created_at", ASCENDING)], expireAfterSeconds=QA_CACHE_TTL_DAYS * 86400)
 
 # ---------- Users ----------
-def get_user(user_id: int) -> Optional[dict]:
-    return users_col.find_one({"user_id": user_id})
+class UserCache:
+    """
+    LRU + TTL برای سند کاربران. همهٔ نوشتن‌ها روی users_col از همین ماژول رد می‌شوند و
+    کلید را invalidate/به‌روز می‌کنند؛ برای چند worker، watch_user_changes با change stream
+    invalidation را بین پروسه‌ها پخش می‌کند.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[int, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self._by_oid: Dict[Any, int] = {}
+        self._writes = 0  # هر invalidate یک واحد؛ اگر وسط یک miss عوض شد، نتیجه cache نمی‌شود
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
 
-def save_user(user_id: int, doc: Dict[str, Any]) -> dict:
+    def get(self, user_id: int) -> Tuple[bool, Optional[dict]]:
+        entry = self._data.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.stats["misses"] += 1
+            return False, None
+        self._data.move_to_end(user_id)
+        self.stats["hits"] += 1
+        # کپی عمیق: progress/prefs تودرتو نباید بین کش و فراخوان‌ها مشترک باشند
+        return True, copy.deepcopy(entry[1])
+
+    def put(self, user_id: int, doc: Optional[dict], token: Optional[int] = None) -> None:
+        if self.max_size <= 0 or (token is not None and token != self._writes):
+            return
+        doc = copy.deepcopy(doc)
+        self._data[user_id] = (time.monotonic() + self.ttl, doc)
+        self._data.move_to_end(user_id)
+        if doc is not None and "_id" in doc:
+            self._by_oid[doc["_id"]] = user_id
+        while len(self._data) > self.max_size:
+            _uid, (_exp, old) = self._data.popitem(last=False)
+            if old is not None:
+                self._by_oid.pop(old.get("_id"), None)
+            self.stats["evictions"] += 1
+
+    def token(self) -> int:
+        return self._writes
+
+    def invalidate(self, user_id: int) -> None:
+        self._writes += 1
+        _exp, old = self._data.pop(user_id, (None, None))
+        if old is not None:
+            self._by_oid.pop(old.get("_id"), None)
+        self.stats["invalidations"] += 1
+
+    def invalidate_oid(self, oid: Any) -> None:
+        user_id = self._by_oid.get(oid)
+        if user_id is not None:
+            self.invalidate(user_id)
+
+user_cache = UserCache()
+
+async def watch_user_changes() -> None:
+    """اختیاری (USER_CACHE_CHANGE_STREAM=1)؛ نیاز به replica set دارد."""
+    try:
+        async with users_col.watch([{"$project": {"documentKey": 1}}]) as stream:
+            async for change in stream:
+                user_cache.invalidate_oid(change["documentKey"]["_id"])
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("users change stream stopped; cross-process cache invalidation disabled")
+
+async def get_user(user_id: int) -> Optional[dict]:
+    hit, doc = user_cache.get(user_id)
+    if hit:
+        return doc
+    token = user_cache.token()
+    doc = await users_col.find_one({"user_id": user_id})
+    user_cache.put(user_id, doc, token)  # put کپی خودش را نگه می‌دارد
+    return doc
+
+async def save_user(user_id: int, doc: Dict[str, Any]) -> dict:
     now = datetime.now(UTC)
     doc["user_id"] = user_id
     doc.setdefault("created_at", now)
     doc.setdefault("updated_at", now)
-    return users_col.find_one_and_update(
+    saved = await users_col.find_one_and_update(
         {"user_id": user_id},
         {"$setOnInsert": doc},
         upsert=True,
         return_document=ReturnDocument.AFTER
     )
+    user_cache.invalidate(user_id)
+    user_cache.put(user_id, saved)
+    return saved
 
-def update_user_field(user_id: int, field: str, value: Any) -> None:
-    users_col.update_one(
+async def update_user_field(user_id: int, field: str, value: Any) -> None:
+    await users_col.update_one(
         {"user_id": user_id},
         {"$set": {field: value, "updated_at": datetime.now(UTC)}},
         upsert=True
     )
+    user_cache.invalidate(user_id)
 
-def update_user(user_id: int, updates: dict) -> None:
+async def update_user(user_id: int, updates: dict) -> None:
     updates["updated_at"] = datetime.now(UTC)
-    users_col.update_one({"user_id": user_id}, {"$set": updates}, upsert=True)
+    await users_col.update_one({"user_id": user_id}, {"$set": updates}, upsert=True)
+    user_cache.invalidate(user_id)
+
+class UserPatch:
+    """
+    Unit-of-work برای users: تغییرات فیلدها در طول یک هندلر جمع و با یک update_one
+    (یا برای چند کاربر با commit_user_patches و یک bulk_write) ثبت می‌شوند.
+
+        async with UserPatch(uid) as p:
+            p.set("cefr", cefr).set("level", cefr)
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._set: Dict[str, Any] = {}
+        self._unset: Dict[str, str] = {}
+
+    def set(self, field: str, value: Any) -> "UserPatch":
+        self._unset.pop(field, None)
+        self._set[field] = value
+        return self
+
+    def update(self, fields: Dict[str, Any]) -> "UserPatch":
+        for field, value in fields.items():
+            self.set(field, value)
+        return self
+
+    def unset(self, field: str) -> "UserPatch":
+        self._set.pop(field, None)
+        self._unset[field] = ""
+        return self
+
+    def __bool__(self) -> bool:
+        return bool(self._set or self._unset)
+
+    def to_update(self) -> dict:
+        update: Dict[str, Any] = {"$set": {**self._set, "updated_at": datetime.now(UTC)}}
+        if self._unset:
+            update["$unset"] = dict(self._unset)
+        return update
+
+    async def commit(self) -> None:
+        if not self:
+            return
+        await users_col.update_one({"user_id": self.user_id}, self.to_update(), upsert=True)
+        user_cache.invalidate(self.user_id)
+        self._set.clear()
+        self._unset.clear()
+
+    async def __aenter__(self) -> "UserPatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            await self.commit()
+
+async def commit_user_patches(patches: List[UserPatch]) -> int:
+    patches = [p for p in patches if p]
+    if not patches:
+        return 0
+    res = await users_col.bulk_write([
+        UpdateOne({"user_id": p.user_id}, p.to_update(), upsert=True) for p in patches
+    ], ordered=False)
+    for p in patches:
+        user_cache.invalidate(p.user_id)
+    return res.modified_count + res.upserted_count
+
+# ---------- Leases ----------
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def acquire_lease(name: str, ttl: timedelta) -> bool:
+    """
+    قفل یک‌باره روی Mongo: فقط اولین worker که name را درج کند برنده است
+    (مثلاً reminders:2024-05-01T20:00). سند با TTL index خودش پاک می‌شود.
+    """
+    try:
+        await locks_col.insert_one({"_id": name, "owner": WORKER_ID, "expires_at": datetime.now(UTC) + ttl})
+        return True
+    except DuplicateKeyError:
+        return False
+
+async def take_shared_token(key: str, rate: float, capacity: float, tokens: float = 1.0) -> bool:
+    """
+    Token bucket اتمیک روی Mongo (یک update pipeline): refill بر اساس زمان، بعد برداشتن tokens اگر بود.
+    سند بیکار با TTL پاک می‌شود (= سطل پر).
+    """
+    now = time.time()
+    level = {"$min": [capacity, {"$add": [
+        {"$ifNull": ["$tokens", capacity]},
+        {"$multiply": [{"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated", now]}]}]}, rate]},
+    ]}]}
+    doc = await ratelimit_col.find_one_and_update(
+        {"_id": key},
+        [
+            {"$set": {"level": level}},
+            {"$set": {
+                "allowed": {"$gte": ["$level", tokens]},
+                "tokens": {"$cond": [{"$gte": ["$level", tokens]}, {"$subtract": ["$level", tokens]}, "$level"]},
+                "updated": now,
+                "expires_at": datetime.now(UTC) + timedelta(seconds=capacity / rate + 60),
+            }},
+            {"$unset": "level"},
+        ],
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        projection={"allowed": 1},
+    )
+    return bool(doc and doc.get("allowed"))
+
+# ---------- Reminders ----------
+async def iter_due_reminder_users(now: datetime, batch_size: int = 500) -> AsyncIterator[List[int]]:
+    """
+    کاربرانی که ساعت محلی یادآورشان همین دقیقه است، به‌صورت دسته‌های batch_size از cursor.
+    به ازای هر منطقهٔ زمانیِ در حال استفاده یک کوئری روی ایندکس (reminder_enabled, tz, reminder_time).
+    """
+    tzs = {tz or DEFAULT_TIMEZONE for tz in await users_col.distinct("tz", {"reminder_enabled": True})}
+    batch: List[int] = []
+    for tz in tzs | {DEFAULT_TIMEZONE}:
+        try:
+            local = now.astimezone(ZoneInfo(tz))
+        except (ZoneInfoNotFoundError, ValueError):
+            logger.warning("Unknown reminder timezone %r", tz)
+            continue
+        query = {
+            "reminder_enabled": True,
+            "tz": {"$in": [None, tz]} if tz == DEFAULT_TIMEZONE else tz,
+            "reminder_time": local.strftime("%H:%M"),
+            "blocked": {"$ne": True},
+        }
+        async for u in users_col.find(query, {"_id": 0, "user_id": 1}, batch_size=batch_size):
+            batch.append(u["user_id"])
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+_HHMM_RE = re.compile(r"^\d{2}:\d{2}$")
+
+def normalize_reminder_time(value: Any) -> Optional[str]:
+    """'8:30' / ' 08:5 ' → '08:30' / '08:05'؛ ساعت نامعتبر → None."""
+    try:
+        hh, mm = map(int, str(value).strip().split(":"))
+    except ValueError:
+        return None
+    if not (0 <= hh < 24 and 0 <= mm < 60):
+        return None
+    return f"{hh:02d}:{mm:02d}"
+
+async def migrate_reminder_times(batch_size: int = 500) -> Dict[str, int]:
+    """
+    reminder_timeهای ذخیره‌شده با نسخهٔ قدیمی (مثل '8:30') را به HH:MM صفردار می‌برد تا
+    iter_due_reminder_users که دقیقاً با strftime('%H:%M') مقایسه می‌کند پیدایشان کند.
+    مقدار خراب یادآور را خاموش می‌کند.
+    """
+    report = {"normalized": 0, "disabled": 0}
+    ops: List[UpdateOne] = []
+    touched: List[int] = []
+
+    async def flush() -> None:
+        if ops:
+            await users_col.bulk_write(ops, ordered=False)
+        for uid in touched:
+            user_cache.invalidate(uid)
+        ops.clear()
+        touched.clear()
+
+    cur = users_col.find(
+        {"reminder_time": {"$type": "string", "$not": _HHMM_RE}}, {"_id": 1, "user_id": 1, "reminder_time": 1}
+    )
+    async for u in cur:
+        fixed = normalize_reminder_time(u["reminder_time"])
+        if fixed is None:
+            update = {"$set": {"reminder_time": None, "reminder_enabled": False}}
+            report["disabled"] += 1
+        else:
+            update = {"$set": {"reminder_time": fixed}}
+            report["normalized"] += 1
+        ops.append(UpdateOne({"_id": u["_id"]}, update))
+        touched.append(u["user_id"])
+        if len(ops) >= batch_size:
+            await flush()
+    await flush()
+    return report
+
+# ---------- Due-review sweep ----------
+REVIEW_SWEEP_KEY = "review_sweep"
+
+async def claim_review_sweep_range(now: datetime, first_lookback: timedelta) -> Optional[Tuple[datetime, datetime]]:
+    """
+    بازهٔ (watermark, now] را با compare-and-set روی job_state برای این worker رزرو می‌کند؛
+    اگر worker دیگری زودتر watermark را جلو برده باشد → None.
+    """
+    state = await state_col.find_one({"_id": REVIEW_SWEEP_KEY})
+    if state is None:
+        start = now - first_lookback
+        try:
+            await state_col.insert_one({"_id": REVIEW_SWEEP_KEY, "watermark": now})
+        except DuplicateKeyError:
+            return None
+        return start, now
+    start = state["watermark"]
+    if start >= now:
+        return None
+    res = await state_col.update_one(
+        {"_id": REVIEW_SWEEP_KEY, "watermark": start}, {"$set": {"watermark": now}}
+    )
+    return (start, now) if res.modified_count else None
+
+async def sweep_new_due(start: datetime, end: datetime) -> Tuple[Dict[int, int], int]:
+    """
+    Range scan روی ایندکس (next_due, user_id) فقط برای آیتم‌هایی که در (start, end] موعددار شده‌اند.
+    کوئری covered است (سندی خوانده نمی‌شود). خروجی: ({user_id: تعداد آیتم تازه}, تعداد ورودی اسکن‌شده).
+    """
+    cur = reviews_col.find(
+        {"next_due": {"$gt": start, "$lte": end}}, {"_id": 0, "user_id": 1, "next_due": 1}
+    ).hint([("next_due", ASCENDING), ("user_id", ASCENDING)]).batch_size(5000)
+    users: Dict[int, int] = {}
+    scanned = 0
+    async for r in cur:
+        scanned += 1
+        users[r["user_id"]] = users.get(r["user_id"], 0) + 1
+    return users, scanned
+
+async def due_review_counts(user_ids: List[int], now: datetime, chunk: int = 1000) -> Dict[int, int]:
+    """تعداد کل آیتم‌های موعددار هر کاربر (ایندکس user_id, next_due)."""
+    counts: Dict[int, int] = {}
+    for i in range(0, len(user_ids), chunk):
+        pipeline = [
+            {"$match": {"user_id": {"$in": user_ids[i:i + chunk]}, "next_due": {"$lte": now}}},
+            {"$group": {"_id": "$user_id", "n": {"$sum": 1}}},
+        ]
+        async for r in reviews_col.aggregate(pipeline):
+            counts[r["_id"]] = r["n"]
+    return counts
+
+async def mark_users_blocked(user_ids: List[int]) -> None:
+    """
+    کاربرانی که ربات را بلاک کرده‌اند (Forbidden) تا /start بعدی از یادآور و اعلان مرور خارج می‌شوند؛
+    reminder_enabled دست نمی‌خورد تا بعد از آنبلاک، یادآور قبلی‌شان برگردد.
+    """
+    await commit_user_patches([UserPatch(uid).set("blocked", True) for uid in user_ids])
+
+async def unmark_user_blocked(user_id: int) -> None:
+    await UserPatch(user_id).unset("blocked").commit()
+
+async def drop_blocked_users(user_ids: List[int], chunk: int = 1000) -> List[int]:
+    """user_ids منهای کاربرانی که blocked علامت خورده‌اند."""
+    blocked: Set[int] = set()
+    for i in range(0, len(user_ids), chunk):
+        cur = users_col.find({"user_id": {"$in": user_ids[i:i + chunk]}, "blocked": True}, {"_id": 0, "user_id": 1})
+        blocked.update([u["user_id"] async for u in cur])
+    return [uid for uid in user_ids if uid not in blocked]
 
 # ---------- Lessons ----------
-def save_lesson(user_id: int, content: str, exercise: str, json_payload: Optional[dict]=None) -> dict:
+async def save_lesson(user_id: int, content: str, exercise: str, json_payload: Optional[dict]=None) -> dict:
     doc = {
         "user_id": user_id,
         "content": content,
@@ -61,48 +445,252 @@ def save_lesson(user_id: int, content: str, exercise: str, json_payload: Optiona
         "json": json_payload,
         "created_at": datetime.now(UTC),
     }
-    lessons_col.insert_one(doc)
+    await lessons_col.insert_one(doc)
+    await progress_col.update_one({"user_id": user_id}, {"$inc": {"lessons_done": 1}}, upsert=True)
     return doc
 
 # ---------- Events / Logs ----------
-def log_event(user_id: int, name: str, data: Dict[str, Any]) -> None:
-    events_col.insert_one({
+class EventBuffer:
+    """
+    Write-behind برای events: log_event فوراً برمی‌گردد و رویدادها دسته‌ای
+    (insert_many(ordered=False) + یک bulk_write مرتب برای rollupها) بر اساس اندازه یا زمان flush می‌شوند.
+    policy: "drop" (صف پر → رویداد دور ریخته می‌شود) یا "block" (منتظر جا می‌ماند).
+    """
+
+    def __init__(self, max_size: int = EVENT_BUFFER_MAX, batch_size: int = EVENT_BATCH_SIZE,
+                 flush_interval: float = EVENT_FLUSH_SECONDS, policy: str = EVENT_BUFFER_POLICY):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, int] = {
+            "events": 0, "flushes": 0, "dropped": 0, "errors": 0, "max_batch": 0,
+        }
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def avg_batch(self) -> float:
+        return self.stats["events"] / self.stats["flushes"] if self.stats["flushes"] else 0.0
+
+    async def start(self) -> None:
+        if not self.running:
+            self._task = asyncio.create_task(self._run(), name="event-buffer")
+
+    async def stop(self) -> None:
+        """صف را تا آخر flush می‌کند (در post_shutdown صدا زده می‌شود)."""
+        if self.running:
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+
+    async def put(self, doc: dict) -> None:
+        if not self.running:
+            await self._write([doc])
+            return
+        if self.policy == "block":
+            await self._queue.put(doc)
+            return
+        try:
+            self._queue.put_nowait(doc)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            closing = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if doc is None:
+                    closing = True
+                    break
+                batch.append(doc)
+            await self._write(batch)
+            if closing:
+                return
+
+    async def _write(self, batch: List[dict]) -> None:
+        rollups: Dict[Tuple[int, str], Dict[str, int]] = {}
+        for e in batch:
+            counts = rollups.setdefault((e["user_id"], e["ts"].date().isoformat()), {})
+            counts[e["name"]] = counts.get(e["name"], 0) + 1
+        try:
+            await events_col.insert_many(batch, ordered=False)
+            # استریک از last_active_day فعلی سند حساب می‌شود؛ روزهای یک کاربر (دسته‌ای که از نیمه‌شب
+            # می‌گذرد یا عقب‌ماندهٔ بعد از قطعی Mongo) باید به ترتیب اعمال شوند
+            await progress_col.bulk_write([
+                UpdateOne({"user_id": uid}, _progress_rollup_pipeline(day, rollups[(uid, day)]), upsert=True)
+                for uid, day in sorted(rollups)
+            ], ordered=True)
+        except Exception:
+            self.stats["errors"] += 1
+            logger.exception("Failed to flush %d events", len(batch))
+            return
+        self.stats["flushes"] += 1
+        self.stats["events"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+
+event_buffer = EventBuffer()
+
+async def log_event(user_id: int, name: str, data: Dict[str, Any]) -> None:
+    await event_buffer.put({
         "user_id": user_id,
         "name": name,
         "data": data or {},
         "ts": datetime.now(UTC)
     })
 
+# ---------- Q&A answers ----------
+async def load_qa_answers(limit: int) -> List[dict]:
+    """تازه‌ترین پاسخ‌های ذخیره‌شده برای پر کردن ایندکس حافظه‌ای qa_cache."""
+    cur = qa_col.find({}, {"_id": 1, "q": 1, "answer": 1}).sort("created_at", -1).limit(limit)
+    return await cur.to_list(length=limit)
+
+async def save_qa_answer(key: str, question: str, answer: str) -> None:
+    await qa_col.update_one(
+        {"_id": key},
+        {"$set": {"q": question, "answer": answer, "created_at": datetime.now(UTC)}},
+        upsert=True,
+    )
+
+async def top_asked_questions(limit: int) -> List[str]:
+    """پرتکرارترین سؤال‌های qa_asked (بدون حساسیت به حروف بزرگ/کوچک)."""
+    pipeline = [
+        {"$match": {"name": "qa_asked", "data.q": {"$type": "string"}}},
+        {"$group": {"_id": {"$toLower": {"$trim": {"input": "$data.q"}}}, "q": {"$first": "$data.q"}, "n": {"$sum": 1}}},
+        {"$sort": {"n": -1}},
+        {"$limit": limit},
+    ]
+    return [doc["q"] async for doc in events_col.aggregate(pipeline, allowDiskUse=True)]
+
+# ---------- Media file_id cache ----------
+async def get_media_file_id(key: str) -> Optional[str]:
+    doc = await media_col.find_one({"_id": key}, {"file_id": 1})
+    return doc["file_id"] if doc else None
+
+async def save_media_file_id(key: str, file_id: str) -> None:
+    now = datetime.now(UTC)
+    await media_col.update_one(
+        {"_id": key},
+        {"$set": {"file_id": file_id, "last_used": now}, "$setOnInsert": {"created_at": now}},
+        upsert=True,
+    )
+
+async def touch_media(keys: List[str]) -> None:
+    """last_used را جلو می‌برد تا TTL فقط مدیای واقعاً بلااستفاده را پاک کند."""
+    if keys:
+        await media_col.update_many({"_id": {"$in": keys}}, {"$set": {"last_used": datetime.now(UTC)}})
+
+async def drop_media_file_id(key: str) -> None:
+    await media_col.delete_one({"_id": key})
+
+async def bank_media_urls(limit: int = 500) -> List[str]:
+    """آدرس‌های صوتی درس‌های بانک و آیتم‌های تعیین‌سطح (برای prewarm)."""
+    urls: List[str] = []
+    async for doc in bank_col.find({"json.exercises.media_url": {"$nin": ["", None]}},
+                                   {"json.exercises.media_url": 1}).limit(limit):
+        urls += [ex.get("media_url") for ex in (doc.get("json") or {}).get("exercises") or []]
+    async for doc in placement_col.find({"media_url": {"$nin": ["", None]}}, {"media_url": 1}).limit(limit):
+        urls.append(doc.get("media_url"))
+    return list(dict.fromkeys(u for u in urls if u))[:limit]
+
+# ---------- Progress rollups ----------
+# به‌جای اسکن events در هر /progress، log_event شمارنده‌های روزانه و استریک را
+# روی یک سند (progress) به‌روز نگه می‌دارد. فقط PROGRESS_KEEP_DAYS روز آخر نگه داشته می‌شود.
+def _progress_rollup_pipeline(day: str, counts: Dict[str, int]) -> List[dict]:
+    d = date.fromisoformat(day)
+    prev = (d - timedelta(days=1)).isoformat()
+    cutoff = (d - timedelta(days=PROGRESS_KEEP_DAYS - 1)).isoformat()
+    streak = {"$ifNull": ["$current_streak", 0]}
+    update: Dict[str, Any] = {
+        "current_streak": {"$switch": {
+            "branches": [
+                {"case": {"$gte": ["$last_active_day", day]}, "then": streak},
+                {"case": {"$eq": ["$last_active_day", prev]}, "then": {"$add": [streak, 1]}},
+            ],
+            "default": 1,
+        }},
+        "last_active_day": {"$max": ["$last_active_day", day]},
+    }
+    for name, n in counts.items():
+        update[f"days.{day}.{name}"] = {"$add": [{"$ifNull": [f"$days.{day}.{name}", 0]}, n]}
+    return [
+        {"$set": update},
+        {"$set": {"days": {"$arrayToObject": {"$filter": {
+            "input": {"$objectToArray": "$days"}, "as": "d", "cond": {"$gte": ["$$d.k", cutoff]},
+        }}}}},
+    ]
+
+async def backfill_progress(batch_size: int = 500) -> int:
+    """rollupها را برای کاربران موجود از روی events/lessons می‌سازد (بازنویسی کامل). تعداد کاربران."""
+    today = datetime.now(UTC).date()
+    cutoff = (today - timedelta(days=PROGRESS_KEEP_DAYS - 1)).isoformat()
+    lessons = {r["_id"]: r["n"] async for r in lessons_col.aggregate(
+        [{"$group": {"_id": "$user_id", "n": {"$sum": 1}}}]
+    )}
+    pipeline = [
+        {"$group": {
+            "_id": {"u": "$user_id", "d": {"$dateToString": {"format": "%Y-%m-%d", "date": "$ts"}}, "n": "$name"},
+            "cnt": {"$sum": 1},
+        }},
+        {"$group": {"_id": "$_id.u", "rows": {"$push": {"d": "$_id.d", "n": "$_id.n", "cnt": "$cnt"}}}},
+    ]
+    ops, total = [], 0
+    async for r in events_col.aggregate(pipeline, allowDiskUse=True):
+        uid = r["_id"]
+        active = sorted({row["d"] for row in r["rows"]}, reverse=True)
+        streak = 1
+        while streak < len(active) and \
+                date.fromisoformat(active[streak - 1]) - date.fromisoformat(active[streak]) == timedelta(days=1):
+            streak += 1
+        days: Dict[str, Dict[str, int]] = {}
+        for row in r["rows"]:
+            if row["d"] >= cutoff:
+                days.setdefault(row["d"], {})[row["n"]] = row["cnt"]
+        ops.append(ReplaceOne({"user_id": uid}, {
+            "user_id": uid, "lessons_done": lessons.pop(uid, 0), "days": days,
+            "last_active_day": active[0], "current_streak": streak,
+        }, upsert=True))
+        if len(ops) >= batch_size:
+            total += len(ops)
+            await progress_col.bulk_write(ops, ordered=False)
+            ops = []
+    # کاربرانی که درس دارند ولی رویدادی ندارند
+    for uid, n in lessons.items():
+        ops.append(ReplaceOne({"user_id": uid}, {"user_id": uid, "lessons_done": n, "days": {}}, upsert=True))
+    if ops:
+        total += len(ops)
+        await progress_col.bulk_write(ops, ordered=False)
+    return total
+
 # ---------- LLM (Gemini) ----------
-def ask_gemini(prompt: str, system: Optional[str]=None, json_mode: bool=False) -> Optional[str]:
+async def ask_gemini(prompt: str, system: Optional[str]=None, json_mode: bool=False) -> Optional[str]:
     """
-    Wrapper ساده برای Gemini (sync). اگر API key یا پکیج نبود → None.
+    Wrapper async روی llm.LLMClient (مدل یک بار ساخته می‌شود، همزمانی و تایم‌اوت محدود است).
+    اگر API key یا پکیج نبود یا خطا/تایم‌اوت رخ داد → None.
     """
-    api_key = os.getenv("GEMINI_API_KEY", "").strip()
-    if not api_key:
-        return None
-    try:
-        import google.generativeai as genai  # pip install google-generativeai
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel("gemini-1.5-flash")
-
-        parts = []
-        if system:
-            parts.append({"role": "system", "parts": [system]})
-        parts.append({"role": "user", "parts": [prompt]})
-
-        resp = model.generate_content(parts)
-        text = (getattr(resp, "text", "") or "").strip()
-        if not text:
-            return None
-        if json_mode:
-            m = re.search(r"(\{.*\}|\[.*\])", text, re.S)
-            return m.group(1) if m else text
-        return text
-    except ModuleNotFoundError:
-        return None
-    except Exception:
-        return None
+    return await llm.get_client().ask(prompt, system=system, json_mode=json_mode)
+
+def stream_gemini(prompt: str, system: Optional[str]=None) -> AsyncIterator[str]:
+    """
+    نسخهٔ استریم ask_gemini: متن تجمعی با رسیدن هر تکه؛ بدون backend هیچ چیزی yield نمی‌شود.
+    قطع شدن وسط استریم → llm.StreamInterrupted.
+    """
+    return llm.get_client().stream(prompt, system=system)
 
 # ---------- CEFR Mapping ----------
 def score_to_cefr(score: int, total: int) -> str:
@@ -130,17 +718,203 @@ def _validate_questions(payload: dict) -> List[dict]:
         out.append(it)
     return out[:10]
 
-def generate_placement_questions(level_hint: str = "Beginner") -> List[dict]:
-    cache_key = f"placement:{level_hint.lower()}"
-    cached = gen_col.find_one({"key": cache_key})
-    if cached and cached.get("expires_at") and cached["expires_at"] > datetime.now(UTC):
-        return cached["value"]
+# ---------- Placement item bank ----------
+# به‌جای یک ست ثابت برای هر سطح، آیتم‌های معتبر و یکتا در placement_items جمع می‌شوند؛ هر آزمون
+# با نمونه‌گیری ایندکسی (band, rand) کشیده می‌شود و LLM فقط کمبود پوشش نوع/تعداد را پر می‌کند.
+PLACEMENT_TYPES = ("mcq", "fill", "dialog", "listening", "reading")
+_BAND_OF = {"A1": "beginner", "A2": "beginner", "B1": "intermediate", "B2": "intermediate",
+            "C1": "advanced", "C2": "advanced"}
+
+def placement_band(level_hint: Optional[str]) -> str:
+    """سطح آزاد کاربر (A2، Beginner، intermediate، ...) → beginner|intermediate|advanced."""
+    hint = (level_hint or "").strip()
+    band = _BAND_OF.get(hint.upper())
+    if band:
+        return band
+    low = hint.lower()
+    for name in ("advanced", "intermediate"):
+        if name[:5] in low:
+            return name
+    return "beginner"
+
+def placement_item_id(item: dict) -> str:
+    """شناسهٔ پایدار از متن نرمال‌شدهٔ سؤال؛ سؤال تکراری (حتی با فاصله/علائم متفاوت) یک آیتم است."""
+    text = " | ".join(normalize_answer(item.get(k)) for k in ("type", "q", "transcript"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+async def add_placement_items(band: str, items: List[dict]) -> int:
+    """آیتم‌های _validate_questions را با dedup (upsert روی _id) در بانک می‌گذارد؛ تعداد آیتم‌های تازه."""
+    now = datetime.now(UTC)
+    ops = []
+    for it in _validate_questions({"questions": items}):
+        if (it.get("type") or "").lower() not in PLACEMENT_TYPES or not it.get("q"):
+            continue
+        doc = {k: it.get(k) for k in ("q", "type", "options", "answer_index", "answer_text",
+                                       "tag", "media_url", "transcript") if it.get(k) not in (None, "", [])}
+        doc.update({"type": doc["type"].lower(), "band": band, "rand": random.random(), "created_at": now,
+                    "stats": {"n": 0, "correct": 0, "sum": 0.0, "sum_sq": 0.0, "sum_correct": 0.0}})
+        ops.append(UpdateOne({"_id": placement_item_id(it)}, {"$setOnInsert": doc}, upsert=True))
+    if not ops:
+        return 0
+    res = await placement_col.bulk_write(ops, ordered=False)
+    return res.upserted_count
+
+def item_statistics(stats: dict) -> Tuple[Optional[float], Optional[float]]:
+    """
+    (difficulty, discrimination): نسبت پاسخ درست و همبستگی point-biserial آیتم با «نمرهٔ بقیهٔ آزمون».
+    از جمع‌های افزایشی n, correct, sum, sum_sq, sum_correct محاسبه می‌شود.
+    """
+    n, c = stats.get("n", 0), stats.get("correct", 0)
+    if not n:
+        return None, None
+    p = c / n
+    if c in (0, n):
+        return p, None
+    mean = stats["sum"] / n
+    var = stats["sum_sq"] / n - mean * mean
+    if var <= 1e-12:
+        return p, None
+    mean_correct = stats["sum_correct"] / c
+    return p, (mean_correct - mean) / var ** 0.5 * (p / (1 - p)) ** 0.5
+
+def _usable_item(item: dict) -> bool:
+    # فقط آیتمی کنار می‌رود که بعد از PLACEMENT_MIN_RESPONSES پاسخ، تمایزش تعریف‌شده و کمتر از
+    # PLACEMENT_MIN_DISCRIMINATION باشد. تمایز تعریف‌نشده (همه درست/همه غلط، یا نمرهٔ بقیهٔ آزمون
+    # ثابت) یعنی هنوز اطلاعاتی نداریم، نه اینکه آیتم بد است.
+    stats = item.get("stats") or {}
+    if stats.get("n", 0) < PLACEMENT_MIN_RESPONSES:
+        return True
+    _p, disc = item_statistics(stats)
+    return disc is None or disc >= PLACEMENT_MIN_DISCRIMINATION
+
+async def record_placement_results(results: List[Tuple[str, bool]]) -> None:
+    """
+    پایان یک آزمون: برای هر آیتم، نمرهٔ بقیهٔ آزمون (بدون خود آیتم، ۰..۱) به جمع‌های آماری‌اش اضافه می‌شود.
+    آیتم‌های fallback در بانک نیستند و بی‌صدا نادیده گرفته می‌شوند.
+    """
+    if len(results) < 2:
+        return
+    score = sum(1 for _id, ok in results if ok)
+    ops = []
+    for item_id, ok in results:
+        rest = (score - (1 if ok else 0)) / (len(results) - 1)
+        inc = {"stats.n": 1, "stats.sum": rest, "stats.sum_sq": rest * rest}
+        if ok:
+            inc.update({"stats.correct": 1, "stats.sum_correct": rest})
+        ops.append(UpdateOne({"_id": item_id}, {"$inc": inc}))
+    await placement_col.bulk_write(ops, ordered=False)
+
+async def _sample_band(band: str, limit: int) -> List[dict]:
+    # نمونه‌گیری تصادفی روی ایندکس (band, rand): از یک نقطهٔ تصادفی جلو برو و اگر کم آمد از ابتدا
+    r = random.random()
+    out = await placement_col.find({"band": band, "rand": {"$gte": r}}).sort("rand", ASCENDING).limit(limit)\
+        .to_list(length=limit)
+    if len(out) < limit:
+        out += await placement_col.find({"band": band, "rand": {"$lt": r}}).sort("rand", ASCENDING)\
+            .limit(limit - len(out)).to_list(length=limit - len(out))
+    return out
+
+def _compose_test(candidates: List[dict], size: int) -> List[dict]:
+    """یکی از هر نوع (listening/reading/...)، بعد تگ‌های تکراری‌نشده، بعد بقیه."""
+    picked: List[dict] = []
+    ids: Set[str] = set()
+    tags: Set[str] = set()
+
+    def take(it: dict) -> None:
+        picked.append(it)
+        ids.add(it["_id"])
+        tags.add(it.get("tag") or "")
+
+    for t in PLACEMENT_TYPES:
+        it = next((c for c in candidates if c.get("type") == t and c["_id"] not in ids), None)
+        if it and len(picked) < size:
+            take(it)
+    for it in candidates:
+        if len(picked) < size and it["_id"] not in ids and (it.get("tag") or "") not in tags:
+            take(it)
+    for it in candidates:
+        if len(picked) < size and it["_id"] not in ids:
+            take(it)
+    random.shuffle(picked)
+    return picked
+
+async def placement_coverage(band: str) -> Dict[str, int]:
+    rows = placement_col.aggregate([{"$match": {"band": band}}, {"$group": {"_id": "$type", "n": {"$sum": 1}}}])
+    return {row["_id"]: row["n"] async for row in rows}
+
+def _coverage_gaps(coverage: Dict[str, int]) -> List[str]:
+    return [t for t in PLACEMENT_TYPES if coverage.get(t, 0) < PLACEMENT_MIN_PER_TYPE]
+
+async def fill_placement_gaps(band: str) -> int:
+    """اگر بانک این band کم است یا نوعی کم‌پوشش است، یک بار LLM را برای همان کمبود صدا می‌زند."""
+    coverage = await placement_coverage(band)
+    gaps = _coverage_gaps(coverage)
+    if sum(coverage.values()) >= PLACEMENT_BANK_TARGET and not gaps:
+        return 0
+    return await add_placement_items(band, await _generate_placement_llm(band, gaps))
+
+_filling: Dict[str, asyncio.Task] = {}
 
+def _fill_once(band: str) -> asyncio.Task:
+    task = _filling.get(band)
+    if task is None or task.done():
+        task = asyncio.create_task(fill_placement_gaps(band))
+        _filling[band] = task
+        task.add_done_callback(lambda t: _filling.pop(band, None) if _filling.get(band) is t else None)
+    return task
+
+async def _background_fill(band: str) -> None:
+    if not await acquire_lease(f"placement-fill:{band}", timedelta(minutes=2)):
+        return
+    try:
+        with llm.background():
+            await _fill_once(band)
+    except Exception:
+        logger.exception("Filling placement bank for %s failed", band)
+
+async def seed_placement_bank() -> Dict[str, int]:
+    """ست‌های قدیمی placement:* در gen_col را به بانک می‌برد و کمبود هر band را پر می‌کند."""
+    added: Dict[str, int] = {}
+    async for doc in gen_col.find({"key": {"$regex": "^placement:"}}, {"key": 1, "value": 1}):
+        band = placement_band(doc["key"].split(":", 1)[1])
+        added[band] = added.get(band, 0) + await add_placement_items(band, doc.get("value") or [])
+    for band in ("beginner", "intermediate", "advanced"):
+        added[band] = added.get(band, 0) + await fill_placement_gaps(band)
+    return added
+
+async def generate_placement_questions(level_hint: str = "Beginner") -> List[dict]:
+    """
+    یک آزمون PLACEMENT_TEST_SIZE سؤالی از بانک. بانک خالی → یک بار منتظر تولید می‌مانیم؛
+    بانک کم‌پوشش → آزمون از همین موجودی و پر کردن کمبود در پس‌زمینه.
+    """
+    band = placement_band(level_hint)
+    candidates = [it for it in await _sample_band(band, PLACEMENT_TEST_SIZE * 4) if _usable_item(it)]
+    if len(candidates) < PLACEMENT_TEST_SIZE:
+        try:
+            await asyncio.shield(_fill_once(band))
+        except Exception:
+            logger.exception("Filling placement bank for %s failed", band)
+        candidates = [it for it in await _sample_band(band, PLACEMENT_TEST_SIZE * 4) if _usable_item(it)]
+    elif band not in _filling and random.random() < 0.05:
+        # بررسی پوشش گاه‌به‌گاه، نه در هر آزمون
+        spawn(_background_fill(band), name=f"placement-fill-{band}")
+    if len(candidates) < PLACEMENT_TEST_SIZE // 2:
+        return _fallback_placement_questions()
+    test = _compose_test(candidates, PLACEMENT_TEST_SIZE)
+    for it in test:
+        it["item_id"] = it.pop("_id")
+        it.pop("stats", None)
+        it.pop("created_at", None)
+        it.pop("rand", None)
+    return test
+
+async def _generate_placement_llm(level_hint: str, focus_types: Optional[List[str]] = None) -> List[dict]:
     sys = (
         "You are an expert English placement-test writer. "
         "Create short, level-discriminating questions mixing grammar/vocab/listening/reading. "
         "Keep questions concise and culturally neutral. Questions in EN."
     )
+    focus = f"\nFocus mostly on these question types: {', '.join(focus_types)}." if focus_types else ""
     prompt = f"""
 Return STRICT JSON:
 {{
@@ -149,26 +923,18 @@ Return STRICT JSON:
  ]
 }}
 Target level hint: {level_hint}.
-Include 7–8 questions, at least one listening (short transcript) and one reading.
-For MCQ include 'answer_index'; for non-MCQ include 'answer_text'.
+Include 8–10 questions, at least one listening (short transcript) and one reading.
+For MCQ include 'answer_index'; for non-MCQ include 'answer_text'.{focus}
 """
-    raw = ask_gemini(prompt, system=sys, json_mode=True)
-
-    if raw:
-        try:
-            payload = json.loads(raw)
-            qs = _validate_questions(payload)
-            if qs:
-                gen_col.find_one_and_update(
-                    {"key": cache_key},
-                    {"$set": {"key": cache_key, "value": qs, "expires_at": datetime.now(UTC)+timedelta(hours=12)}},
-                    upsert=True
-                )
-                return qs
-        except (ValueError, TypeError):
-            pass
+    raw = await ask_gemini(prompt, system=sys, json_mode=True)
+    if not raw:
+        return []
+    try:
+        return _validate_questions(json.loads(raw))
+    except (ValueError, TypeError, AttributeError):
+        return []
 
-    # --- fallback ---
+def _fallback_placement_questions() -> List[dict]:
     return [
         {"q": "Choose the correct article: ___ apple a day keeps the doctor away.",
          "type": "mcq", "options": ["A", "An", "The", "—"], "answer_index": 1, "tag": "grammar:articles"},
@@ -189,7 +955,7 @@ For MCQ include 'answer_index'; for non-MCQ include 'answer_text'.
     ]
 
 # ---------- Micro-lesson JSON ----------
-def generate_micro_lesson_json(level: str, goal: str, weaknesses: Optional[List[str]]=None) -> dict:
+def micro_lesson_prompt(level: str, goal: str, weaknesses: Optional[List[str]]=None) -> Tuple[str, str]:
     weak = ", ".join(weaknesses or [])
     sys = "You are a friendly English teacher. Return compact JSON for a micro-lesson. All content in English."
     prompt = f"""
@@ -213,13 +979,28 @@ Return STRICT JSON with keys:
 }}
 Keep it short and {level}-appropriate for goal "{goal}".
 """
-    raw = ask_gemini(prompt, system=sys, json_mode=True)
+    return sys, prompt
+
+def parse_micro_lesson(raw: Optional[str]) -> Optional[dict]:
     if raw:
         try:
-            return json.loads(raw)
+            j = json.loads(llm.extract_json(raw))
+            if isinstance(j, dict):
+                return j
         except (ValueError, TypeError):
             pass
-    # fallback
+    return None
+
+async def generate_micro_lesson_llm(level: str, goal: str, weaknesses: Optional[List[str]]=None) -> Optional[dict]:
+    sys, prompt = micro_lesson_prompt(level, goal, weaknesses)
+    return parse_micro_lesson(await ask_gemini(prompt, system=sys, json_mode=True))
+
+async def generate_micro_lesson_json(level: str, goal: str, weaknesses: Optional[List[str]]=None) -> dict:
+    j = await generate_micro_lesson_llm(level, goal, weaknesses)
+    return j or fallback_micro_lesson(level, goal, weaknesses)
+
+def fallback_micro_lesson(level: str, goal: str, weaknesses: Optional[List[str]]=None) -> dict:
+    weak = ", ".join(weaknesses or [])
     return {
         "meta": {"level": level, "goal": goal, "weaknesses": weak, "version": "1.0"},
         "vocab": [
@@ -236,79 +1017,373 @@ Keep it short and {level}-appropriate for goal "{goal}".
         "tips": ["Practice speaking out loud.", "Keep sentences short and clear."]
     }
 
+# ---------- Lesson bank ----------
+# درس‌ها از قبل (در job پس‌زمینه) برای هر باکت (level, goal, tag) ساخته می‌شوند؛
+# lesson_start فقط در صورت نبودِ درسِ دیده‌نشده سراغ تولید زنده می‌رود.
+GENERAL_TAG = "general"
+
+_GOAL_KEYWORDS = {
+    "work":   ("work", "job", "business", "career", "office", "کار", "شغل"),
+    "travel": ("travel", "trip", "tour", "سفر", "مهاجرت"),
+    "exam":   ("exam", "ielts", "toefl", "test", "آزمون", "امتحان"),
+    "study":  ("study", "university", "academic", "school", "تحصیل", "دانشگاه"),
+    "fun":    ("fun", "hobby", "movie", "music", "تفریح", "سرگرمی"),
+}
+
+def normalize_goal(goal: Optional[str]) -> str:
+    g = (goal or "").strip().lower()
+    for key, words in _GOAL_KEYWORDS.items():
+        if any(w in g for w in words):
+            return key
+    return "general"
+
+def normalize_level(level: Optional[str]) -> str:
+    return (level or "A1").strip().upper()
+
+def _bank_tags(weaknesses: Optional[List[str]]) -> List[str]:
+    return [t for t in (weaknesses or []) if t] + [GENERAL_TAG]
+
+def _unseen_bank_filter(user: dict, level: str, goal: str) -> dict:
+    return {
+        "level": normalize_level(level),
+        "goal": normalize_goal(goal),
+        "tag": {"$in": _bank_tags(user.get("weaknesses") or [])},
+        "_id": {"$nin": user.get("seen_lessons") or []},
+        "expires_at": {"$gt": datetime.now(UTC)},
+    }
+
+async def has_unseen_bank_lesson(user: dict, level: str, goal: str) -> bool:
+    return await bank_col.find_one(_unseen_bank_filter(user, level, goal), {"_id": 1}) is not None
+
+async def pick_bank_lesson(user: dict, level: str, goal: str) -> Tuple[Optional[dict], bool]:
+    """
+    یک درس دیده‌نشده از بانک برمی‌گرداند (اولویت با تگ‌های ضعف کاربر) و آن را
+    در seen_lessons کاربر ثبت می‌کند. خروجی: (درس یا None, بعد از این هنوز درس دیده‌نشده هست؟)
+    """
+    weaknesses = user.get("weaknesses") or []
+    cur = bank_col.find(_unseen_bank_filter(user, level, goal), {"json": 1, "tag": 1}).limit(LESSON_BANK_PER_BUCKET * 2)
+    candidates = await cur.to_list(length=None)
+    if not candidates:
+        return None, False
+    preferred = [c for c in candidates if c["tag"] in weaknesses] or candidates
+    doc = random.choice(preferred)
+    await users_col.update_one(
+        {"user_id": user["user_id"]},
+        {"$push": {"seen_lessons": {"$each": [doc["_id"]], "$slice": -LESSON_SEEN_MAX}}}
+    )
+    user_cache.invalidate(user["user_id"])
+    return doc["json"], len(candidates) > 1
+
+async def _lesson_bank_buckets() -> List[Tuple[str, str, str]]:
+    """باکت‌های پرتقاضا بر اساس پروفایل کاربران (level/goal/weakness)."""
+    pipeline = [
+        {"$project": {"level": {"$ifNull": ["$cefr", "$level"]}, "goal": 1, "weaknesses": 1}},
+        {"$unwind": {"path": "$weaknesses", "preserveNullAndEmptyArrays": True}},
+        {"$group": {"_id": {"level": "$level", "goal": "$goal", "tag": "$weaknesses"}, "n": {"$sum": 1}}},
+        {"$sort": {"n": -1}},
+    ]
+    demand: Dict[Tuple[str, str, str], int] = {}
+    async for r in users_col.aggregate(pipeline):
+        k = r["_id"]
+        level, goal = normalize_level(k.get("level")), normalize_goal(k.get("goal"))
+        for tag in {k.get("tag") or GENERAL_TAG, GENERAL_TAG}:
+            demand[(level, goal, tag)] = demand.get((level, goal, tag), 0) + r["n"]
+    ranked = sorted(demand.items(), key=lambda kv: kv[1], reverse=True)
+    return [b for b, _ in ranked[:LESSON_BANK_MAX_BUCKETS]]
+
+async def refill_lesson_bank(per_bucket: int = LESSON_BANK_PER_BUCKET) -> int:
+    """باکت‌های کم‌موجودی را تا per_bucket درس پر می‌کند. تعداد درس‌های ساخته‌شده را برمی‌گرداند."""
+    created = 0
+    now = datetime.now(UTC)
+    for level, goal, tag in await _lesson_bank_buckets():
+        have = await bank_col.count_documents(
+            {"level": level, "goal": goal, "tag": tag, "expires_at": {"$gt": now}}
+        )
+        for _ in range(per_bucket - have):
+            j = await generate_micro_lesson_llm(level, goal, [] if tag == GENERAL_TAG else [tag])
+            if not j:
+                return created  # LLM در دسترس نیست؛ دور بعد
+            await bank_col.insert_one({
+                "level": level, "goal": goal, "tag": tag, "json": j,
+                "created_at": datetime.now(UTC),
+                "expires_at": datetime.now(UTC) + timedelta(days=LESSON_BANK_TTL_DAYS),
+            })
+            created += 1
+    return created
+
+# ---------- Pending (prefetched) lesson ----------
+def lesson_profile_key(user: dict) -> str:
+    """اثر انگشت پروفایل؛ اگر cefr/goal/ضعف‌ها عوض شود درس prefetch‌شده کهنه حساب می‌شود."""
+    level = normalize_level(user.get("cefr") or user.get("level"))
+    weak = ",".join(sorted(user.get("weaknesses") or []))
+    return f"{level}|{normalize_goal(user.get('goal'))}|{weak}"
+
+async def set_pending_lesson(user_id: int, key: str, lesson: dict) -> None:
+    await users_col.update_one(
+        {"user_id": user_id},
+        {"$set": {"pending_lesson": {"key": key, "json": lesson, "created_at": datetime.now(UTC)}}}
+    )
+    user_cache.invalidate(user_id)
+
+async def take_pending_lesson(user: dict, max_age: timedelta) -> Tuple[Optional[dict], str]:
+    """
+    درس prefetch‌شده را (به‌صورت اتمیک) برمی‌دارد.
+    خروجی: (lesson, status) که status یکی از hit / miss / stale است.
+    """
+    pending = user.get("pending_lesson")
+    if not pending:
+        return None, "miss"
+    doc = await users_col.find_one_and_update(
+        {"user_id": user["user_id"], "pending_lesson": {"$exists": True}},
+        {"$unset": {"pending_lesson": ""}},
+        projection={"pending_lesson": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    user_cache.invalidate(user["user_id"])
+    pending = (doc or {}).get("pending_lesson")
+    if not pending:
+        return None, "miss"
+    created_at = pending.get("created_at")
+    fresh = created_at is not None and datetime.now(UTC) - created_at <= max_age
+    if pending.get("key") != lesson_profile_key(user) or not fresh:
+        return None, "stale"
+    return pending.get("json"), "hit"
+
+# ---------- Grading ----------
+# تمرین‌های ساختاریافته (mcq / fill / dialog / ...) به‌صورت محلی تصحیح می‌شوند؛
+# فقط پاسخ‌های باز (بدون answer_index/answer_text) به LLM می‌روند.
+_CONTRACTIONS = {
+    "i'm": "i am", "you're": "you are", "he's": "he is", "she's": "she is", "it's": "it is",
+    "we're": "we are", "they're": "they are", "that's": "that is", "there's": "there is",
+    "i've": "i have", "you've": "you have", "we've": "we have", "they've": "they have",
+    "i'll": "i will", "you'll": "you will", "he'll": "he will", "she'll": "she will",
+    "we'll": "we will", "they'll": "they will", "i'd": "i would", "you'd": "you would",
+    "isn't": "is not", "aren't": "are not", "wasn't": "was not", "weren't": "were not",
+    "don't": "do not", "doesn't": "does not", "didn't": "did not", "haven't": "have not",
+    "hasn't": "has not", "hadn't": "had not", "won't": "will not", "wouldn't": "would not",
+    "can't": "can not", "cannot": "can not", "couldn't": "could not", "shouldn't": "should not",
+    "mustn't": "must not", "let's": "let us",
+}
+_LETTER_RE = re.compile(r"^\(?([a-z])\s*[).:]?$")              # «b»، «b)»، «(b)»، «b.»
+_LABEL_RE = re.compile(r"^\(?([a-z])\s*[).:]\s*(.+)$", re.S)    # دکمهٔ کیبورد: «B) went»
+_VERDICT_RE = re.compile(r"\b(INCORRECT|CORRECT|WRONG)\b", re.I)
+TYPO_MIN_LEN = 7  # جابه‌جایی حروف در کلمه‌های کوتاه‌تر اغلب کلمهٔ دیگری می‌سازد (tired/tried، quite/quiet)
+
+def normalize_answer(s: Optional[str]) -> str:
+    s = (s or "").lower().replace("\u2019", "'").replace("`", "'")
+    s = re.sub(r"[^a-z0-9' ]+", " ", s)
+    words = [_CONTRACTIONS.get(w, w) for w in s.split()]
+    return " ".join(" ".join(words).replace("'", "").split())
+
+def _is_transposition(a: str, b: str) -> bool:
+    """a و b فقط در جابه‌جایی دو حرف مجاور فرق دارند (recieve ↔ receive)."""
+    if len(a) != len(b):
+        return False
+    diff = [i for i, (ca, cb) in enumerate(zip(a, b)) if ca != cb]
+    return len(diff) == 2 and diff[1] == diff[0] + 1 and a[diff[0]] == b[diff[1]] and a[diff[1]] == b[diff[0]]
+
+def answers_match(given: str, expected: str) -> bool:
+    """
+    برابری بعد از نرمال‌سازی. حذف/افزودن/تعویض یک حرف معمولاً شکل دیگری از همان کلمه است
+    (studied/studies، spoke/spoken، advice/advise) که تمرین دقیقاً همان را می‌سنجد؛ پس پاسخ
+    تک‌کلمه‌ای باید دقیق باشد و در پاسخ چندکلمه‌ای فقط یک جابه‌جایی دو حرف مجاور در یک کلمهٔ
+    بلند غلط تایپی حساب می‌شود.
+    """
+    g, e = normalize_answer(given), normalize_answer(expected)
+    if not g or not e:
+        return False
+    if g == e:
+        return True
+    gw, ew = g.split(), e.split()
+    if len(ew) < 2 or len(gw) != len(ew):
+        return False
+    typos = [(a, b) for a, b in zip(gw, ew) if a != b]
+    return len(typos) == 1 and len(typos[0][1]) >= TYPO_MIN_LEN and _is_transposition(*typos[0])
+
+def _expected_texts(answer_text: str) -> List[str]:
+    return [a for a in re.split(r"\s*[/|]\s*", answer_text or "") if a.strip()]
+
+def select_option(answer: str, options: List[str]) -> Optional[int]:
+    """اندیس گزینهٔ انتخاب‌شده (حرف A/B/... یا متن گزینه)؛ اگر قابل تشخیص نبود → None."""
+    text = (answer or "").strip()
+    for i, opt in enumerate(options):
+        if normalize_answer(text) == normalize_answer(opt):
+            return i
+    m = _LETTER_RE.match(text.lower())
+    if m:
+        pos = ord(m.group(1)) - 97
+        if 0 <= pos < len(options):
+            return pos
+    m = _LABEL_RE.match(text.lower())
+    if m:
+        pos = ord(m.group(1)) - 97
+        if 0 <= pos < len(options) and normalize_answer(m.group(2)) == normalize_answer(options[pos]):
+            return pos
+    for i, opt in enumerate(options):
+        if answers_match(text, opt):
+            return i
+    return None
+
+def grade_answer(exercise: Optional[dict], answer: str) -> Optional[bool]:
+    """
+    تصحیح قطعی تمرین ساختاریافته. None یعنی تمرین باز است و باید به LLM سپرده شود.
+    """
+    ex = exercise or {}
+    options = ex.get("options") or []
+    if options and ex.get("answer_index") is not None:
+        return select_option(answer, options) == ex["answer_index"]
+    expected = _expected_texts(ex.get("answer_text") or "")
+    if expected:
+        return any(answers_match(answer, e) for e in expected)
+    return None
+
+def parse_llm_verdict(feedback: str) -> bool:
+    """اولین CORRECT/WRONG/INCORRECT در پاسخ LLM؛ INCORRECT درست حساب نمی‌شود."""
+    m = _VERDICT_RE.search(feedback or "")
+    return bool(m) and m.group(1).upper() == "CORRECT"
+
 # ---------- SRS (SM2-lite) ----------
 DEFAULT_EASE = 2.5
 MIN_EASE = 1.3
 
-def _sm2_next(interval: int, ease: float, was_correct: bool) -> Tuple[int, float]:
+def _sm2_pipeline(was_correct: bool, now: datetime) -> List[dict]:
+    """
+    SM2-lite به‌صورت update pipeline تا محاسبه روی سرور و در یک رفت‌وبرگشت اتمیک انجام شود:
+      درست → ease = max(MIN, ease+0.1)، interval = 1 اگر 0 بود وگرنه round(interval*ease)
+      غلط  → ease = max(MIN, ease-0.2)، interval = 1
+    ($round مثل round پایتون half-to-even است.)
+    """
+    ease = {"$ifNull": ["$ease", DEFAULT_EASE]}
+    interval = {"$ifNull": ["$interval", 0]}
     if was_correct:
-        ease = max(MIN_EASE, ease + 0.1)
-        interval = 1 if interval == 0 else int(round(interval * ease))
+        new_ease = {"$max": [MIN_EASE, {"$add": [ease, 0.1]}]}
+        new_interval = {"$cond": [
+            {"$eq": [interval, 0]}, 1,
+            {"$toInt": {"$round": [{"$multiply": [interval, "$ease"]}, 0]}},
+        ]}
+        counter = "stats.correct"
     else:
-        ease = max(MIN_EASE, ease - 0.2)
-        interval = 1
-    return interval, ease
+        new_ease = {"$max": [MIN_EASE, {"$subtract": [ease, 0.2]}]}
+        new_interval = 1
+        counter = "stats.wrong"
+    return [
+        {"$set": {"ease": new_ease}},
+        {"$set": {"interval": new_interval}},
+        {"$set": {
+            "next_due": {"$add": [now, {"$multiply": ["$interval", 86_400_000]}]},
+            "updated_at": now,
+            counter: {"$add": [{"$ifNull": [f"${counter}", 0]}, 1]},
+        }},
+    ]
+
+def review_item_id(exercise: str) -> str:
+    """شناسهٔ پایدار (content-addressed)؛ برخلاف hash() پایتون بین پروسه‌ها ثابت است."""
+    norm = " ".join((exercise or "").lower().split())
+    return "ex_" + hashlib.sha1(norm.encode("utf-8")).hexdigest()[:16]
 
-def seed_review_item(user_id: int, exercise: str, item_id: Optional[str]=None) -> dict:
+async def seed_review_item(user_id: int, exercise: str, item_id: Optional[str]=None,
+                     payload: Optional[dict]=None) -> dict:
     if not item_id:
-        item_id = f"ex_{abs(hash(exercise))}"
+        item_id = review_item_id(exercise)
     now = datetime.now(UTC)
-    return reviews_col.find_one_and_update(
+    return await reviews_col.find_one_and_update(
         {"user_id": user_id, "item_id": item_id},
         {"$setOnInsert": {
-            "user_id": user_id, "item_id": item_id, "exercise": exercise,
+            "user_id": user_id, "item_id": item_id, "exercise": exercise, "payload": payload,
             "interval": 0, "ease": DEFAULT_EASE, "next_due": now,
             "created_at": now, "updated_at": now, "stats": {"correct": 0, "wrong": 0}
         }},
         upsert=True, return_document=ReturnDocument.AFTER
     )
 
-def get_due_reviews(user_id: int, limit: int=1) -> List[dict]:
+async def get_due_reviews(user_id: int, limit: int=1) -> List[dict]:
     now = datetime.now(UTC)
     cur = reviews_col.find({"user_id": user_id, "next_due": {"$lte": now}})\
                      .sort("next_due", ASCENDING).limit(limit)
-    return list(cur)
+    return await cur.to_list(length=limit)
 
-def update_review_result(user_id: int, item_id: str, was_correct: bool) -> Optional[dict]:
-    doc = reviews_col.find_one({"user_id": user_id, "item_id": item_id})
-    if not doc:
-        return None
-    interval = doc.get("interval", 0)
-    ease     = doc.get("ease", DEFAULT_EASE)
-    interval, ease = _sm2_next(interval, ease, was_correct)
-    next_due = datetime.now(UTC) + timedelta(days=interval)
-    inc = {"stats.correct": 1} if was_correct else {"stats.wrong": 1}
-    reviews_col.update_one({"_id": doc["_id"]}, {
-        "$set": {"interval": interval, "ease": ease, "next_due": next_due, "updated_at": datetime.now(UTC)},
-        "$inc": inc
-    })
-    return {"interval": interval, "ease": ease, "next_due": next_due}
+async def update_review_result(user_id: int, item_id: str, was_correct: bool) -> Optional[dict]:
+    return await reviews_col.find_one_and_update(
+        {"user_id": user_id, "item_id": item_id},
+        _sm2_pipeline(was_correct, datetime.now(UTC)),
+        projection={"_id": 0, "interval": 1, "ease": 1, "next_due": 1},
+        return_document=ReturnDocument.AFTER,
+    )
 
-def progress_summary(user_id: int) -> dict:
-    lessons_done = lessons_col.count_documents({"user_id": user_id})
-    since = datetime.now(UTC) - timedelta(days=7)
-    pipeline = [
-        {"$match": {"user_id": user_id, "ts": {"$gte": since}}},
-        {"$group": {"_id": "$name", "cnt": {"$sum": 1}}}
-    ]
-    events = {e["_id"]: e["cnt"] for e in events_col.aggregate(pipeline)}
-    return {
-        "lessons_done": lessons_done,
-        "reviews_correct_7d": events.get("review_answered_correct", 0),
-        "reviews_wrong_7d": events.get("review_answered_wrong", 0),
-        "streak_days": _compute_streak(user_id)
-    }
+async def apply_review_results(user_id: int, results: List[Tuple[str, bool]]) -> int:
+    """نتایج یک جلسهٔ مرور را با یک bulk_write (هر آیتم یک UpdateOne اتمیک SM-2) ثبت می‌کند."""
+    now = datetime.now(UTC)
+    res = await reviews_col.bulk_write([
+        UpdateOne({"user_id": user_id, "item_id": item_id}, _sm2_pipeline(was_correct, now))
+        for item_id, was_correct in results
+    ], ordered=False)
+    return res.modified_count
 
-def _compute_streak(user_id: int) -> int:
-    pipeline = [
-        {"$match": {"user_id": user_id}},
-        {"$project": {"d": {"$dateToString": {"format": "%Y-%m-%d", "date": "$ts"}}}},
-        {"$group": {"_id": "$d"}},
-        {"$sort": {"_id": -1}}
-    ]
-    days = [r["_id"] for r in events_col.aggregate(pipeline)]
+_EPOCH = datetime(1970, 1, 1, tzinfo=UTC)
+
+def _review_count(doc: dict) -> int:
+    stats = doc.get("stats") or {}
+    return stats.get("correct", 0) + stats.get("wrong", 0)
+
+async def migrate_review_ids(batch_size: int = 500) -> Dict[str, int]:
+    """
+    item_idهای قدیمی (hash تصادفی پایتون) را به review_item_id تبدیل و تکراری‌های هر کاربر را ادغام می‌کند.
+    از هر گروه، آیتمی که بیشترین مرور (و بعد جدیدترین updated_at) را دارد با وضعیت SM-2 خودش
+    می‌ماند و آمار correct/wrong بقیه به آن اضافه می‌شود.
+    """
+    report = {"users": 0, "renamed": 0, "merged": 0}
+    ops: List[Any] = []
+
+    async def flush_user(docs: List[dict]) -> None:
+        groups: Dict[str, List[dict]] = {}
+        for d in docs:
+            groups.setdefault(review_item_id(d.get("exercise", "")), []).append(d)
+        for new_id, group in groups.items():
+            group.sort(key=lambda d: (_review_count(d), d.get("updated_at") or d.get("created_at") or _EPOCH),
+                       reverse=True)
+            keep, losers = group[0], group[1:]
+            if not losers and keep["item_id"] == new_id:
+                continue
+            if losers:
+                ops.append(DeleteMany({"_id": {"$in": [d["_id"] for d in losers]}}))
+                report["merged"] += len(losers)
+            stats = {
+                "correct": sum((d.get("stats") or {}).get("correct", 0) for d in group),
+                "wrong": sum((d.get("stats") or {}).get("wrong", 0) for d in group),
+            }
+            ops.append(UpdateOne({"_id": keep["_id"]}, {"$set": {"item_id": new_id, "stats": stats}}))
+            report["renamed"] += keep["item_id"] != new_id
+
+    cur = reviews_col.find(
+        {}, {"user_id": 1, "item_id": 1, "exercise": 1, "stats": 1, "updated_at": 1, "created_at": 1}
+    ).sort([("user_id", ASCENDING), ("next_due", ASCENDING)])
+    current, docs = None, []
+    async for d in cur:
+        if d["user_id"] != current and docs:
+            await flush_user(docs)
+            report["users"] += 1
+            docs = []
+        current = d["user_id"]
+        docs.append(d)
+        if len(ops) >= batch_size:
+            # ترتیب حذف‌ها قبل از تغییر نام برای ایندکس unique مهم است
+            await reviews_col.bulk_write(ops, ordered=True)
+            ops = []
+    if docs:
+        await flush_user(docs)
+        report["users"] += 1
+    if ops:
+        await reviews_col.bulk_write(ops, ordered=True)
+    return report
+
+async def progress_summary(user_id: int) -> dict:
+    doc = await progress_col.find_one({"user_id": user_id}) or {}
     today = datetime.now(UTC).date()
-    streak = 0
-    while (today - timedelta(days=streak)).isoformat() in days:
-        streak += 1
-    return streak
+    since = (today - timedelta(days=6)).isoformat()
+    week = [counts for d, counts in (doc.get("days") or {}).items() if d >= since]
+    return {
+        "lessons_done": doc.get("lessons_done", 0),
+        "reviews_correct_7d": sum(c.get("review_answered_correct", 0) for c in week),
+        "reviews_wrong_7d": sum(c.get("review_answered_wrong", 0) for c in week),
+        "streak_days": doc.get("current_streak", 0) if doc.get("last_active_day") == today.isoformat() else 0,
+    }
@@ -0,0 +1,71 @@
+# streaming.py
+from __future__ import annotations
+import asyncio, logging, time
+from typing import Dict
+
+from telegram import Message
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from config import STREAM_EDIT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LEN = 4096
+
+# زمان تا اولین محتوای قابل‌دیدن در برابر زمان کامل شدن جواب (برای /stats)
+stream_stats: Dict[str, float] = {"streams": 0, "first_visible_seconds": 0.0, "total_seconds": 0.0, "edits": 0}
+
+class ThrottledEditor:
+    """
+    یک پیام placeholder را با رسیدن تکه‌های استریم ویرایش می‌کند؛ حداکثر یک edit در هر
+    STREAM_EDIT_INTERVAL ثانیه (زیر سقف ویرایش تلگرام) و فقط اگر متن عوض شده باشد.
+    finish() متن نهایی را حتماً می‌نشاند.
+    """
+
+    def __init__(self, message: Message, min_interval: float = STREAM_EDIT_INTERVAL):
+        self.message = message
+        self.min_interval = min_interval
+        self._text = message.text or ""
+        self._next_at = 0.0
+        self._started = time.monotonic()
+        self._first_visible: float | None = None
+
+    async def update(self, text: str) -> None:
+        if time.monotonic() < self._next_at:
+            return
+        await self._edit(text)
+
+    async def finish(self, text: str) -> None:
+        wait = self._next_at - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if not await self._edit(text) and self._next_at > time.monotonic():
+            # RetryAfter روی edit نهایی: یک بار دیگر بعد از مهلت
+            await asyncio.sleep(self._next_at - time.monotonic())
+            await self._edit(text)
+        stream_stats["streams"] += 1
+        stream_stats["total_seconds"] += time.monotonic() - self._started
+        stream_stats["first_visible_seconds"] += (self._first_visible or time.monotonic()) - self._started
+
+    async def _edit(self, text: str) -> bool:
+        text = text[:MAX_MESSAGE_LEN]
+        if not text.strip() or text == self._text:
+            return True
+        try:
+            await self.message.edit_text(text)
+        except RetryAfter as e:
+            self._next_at = time.monotonic() + float(e.retry_after)
+            return False
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning("Streaming edit failed: %s", e)
+            return False
+        except TelegramError:
+            logger.warning("Streaming edit failed", exc_info=True)
+            return False
+        self._text = text
+        self._next_at = time.monotonic() + self.min_interval
+        stream_stats["edits"] += 1
+        if self._first_visible is None:
+            self._first_visible = time.monotonic()
+        return True
@@ -0,0 +1,16 @@
+import os, sys
+
+# ماژول‌های پروژه تخت در ریشهٔ مخزن‌اند
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def tg_update():
+    """سازندهٔ Update تلگرام برای پیام متنی کاربر (با entity برای /command)."""
+    from telegram import Update
+    from fake_telegram import make_update
+
+    def build(update_id: int, user_id: int, text: str = "/start") -> Update:
+        return Update.de_json(make_update(update_id, user_id, text), None)
+    return build
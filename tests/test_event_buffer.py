@@ -0,0 +1,35 @@
+import asyncio
+from datetime import datetime, UTC
+
+import services
+
+class _Recorder:
+    def __init__(self):
+        self.calls = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.calls.append(("insert_many", list(docs), ordered))
+
+    async def bulk_write(self, ops, ordered=True):
+        self.calls.append(("bulk_write", list(ops), ordered))
+
+def _rollup_day(op) -> str:
+    return op._doc[0]["$set"]["last_active_day"]["$max"][1]
+
+def test_flush_spanning_midnight_applies_each_users_days_in_order(monkeypatch):
+    events, progress = _Recorder(), _Recorder()
+    monkeypatch.setattr(services, "events_col", events)
+    monkeypatch.setattr(services, "progress_col", progress)
+    # عقب‌ماندهٔ بعد از قطعی: رویداد روز بعد زودتر در دسته آمده
+    batch = [
+        {"user_id": 7, "name": "lesson_started", "data": {}, "ts": datetime(2026, 3, 2, 0, 5, tzinfo=UTC)},
+        {"user_id": 3, "name": "qa_asked", "data": {}, "ts": datetime(2026, 3, 2, 0, 6, tzinfo=UTC)},
+        {"user_id": 7, "name": "qa_asked", "data": {}, "ts": datetime(2026, 3, 1, 23, 59, tzinfo=UTC)},
+    ]
+
+    asyncio.run(services.EventBuffer()._write(batch))
+
+    (_name, ops, ordered), = progress.calls
+    assert ordered is True
+    user7_days = [_rollup_day(op) for op in ops if op._filter == {"user_id": 7}]
+    assert user7_days == ["2026-03-01", "2026-03-02"]
@@ -0,0 +1,57 @@
+import asyncio
+
+import llm
+from grader import BatchGrader
+
+def _with_fake_llm(coro_fn, latency):
+    async def run():
+        previous = llm._client
+        llm.set_client(llm.LLMClient(llm.FakeBackend(latency=latency, rate_limit_rate=0)))
+        try:
+            return await coro_fn()
+        finally:
+            llm.set_client(previous)
+    return asyncio.run(run())
+
+def test_lone_request_skips_the_window():
+    async def run():
+        grader = BatchGrader(window=0.5, max_batch=20)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        await grader.grade("Use since in a sentence.", "I live here since 2010.")
+        return loop.time() - t0, grader
+
+    elapsed, grader = _with_fake_llm(run, latency=0.01)
+    assert elapsed < 0.2
+    assert grader.stats["batches"] == 1 and not grader._running
+
+def test_requests_arriving_during_a_call_are_batched():
+    async def run():
+        grader = BatchGrader(window=0.05, max_batch=20)
+        first = asyncio.create_task(grader.grade("ex 0", "answer 0"))
+        await asyncio.sleep(0.01)  # اولی در حال نمره‌دهی است
+        rest = [asyncio.create_task(grader.grade(f"ex {i}", f"answer {i}")) for i in (1, 2, 3)]
+        verdicts = await asyncio.gather(first, *rest)
+        return grader, verdicts
+
+    grader, verdicts = _with_fake_llm(run, latency=0.2)
+    assert len(verdicts) == 4
+    assert grader.stats["batches"] == 2
+    assert grader.stats["max_batch"] == 3
+    assert not grader._running
+
+def test_unavailable_llm_is_not_a_wrong_answer():
+    async def run():
+        client = llm.get_client()
+        client.breaker = llm.CircuitBreaker(threshold=1, cooldown=60)
+        client.breaker.failure()  # مدارشکن باز → همهٔ فراخوانی‌ها فوراً None
+        grader = BatchGrader(window=0.05, max_batch=20)
+        single = await grader.grade("Use since in a sentence.", "I live here since 2010.")
+        first = asyncio.create_task(grader.grade("ex 0", "answer 0"))
+        await asyncio.sleep(0)
+        batched = await asyncio.gather(first, grader.grade("ex 1", "answer 1"))
+        return single, batched
+
+    single, batched = _with_fake_llm(run, latency=0)
+    assert single == (None, "")
+    assert batched == [(None, ""), (None, "")]
@@ -0,0 +1,39 @@
+import pytest
+
+from services import answers_match, grade_answer, select_option
+
+@pytest.mark.parametrize("given,expected", [
+    ("studies", "studied"), ("write", "wrote"), ("begun", "began"), ("drunk", "drank"),
+    ("spoken", "spoke"), ("advise", "advice"), ("lose", "loose"),
+    ("She studies hard", "She studied hard"), ("I was tried", "I was tired"),
+])
+def test_other_word_forms_are_not_typos(given, expected):
+    assert not answers_match(given, expected)
+
+@pytest.mark.parametrize("given,expected", [
+    ("Studied.", "studied"), ("I'm here", "I am here"), ("  wrote ", "wrote"),
+    ("I will recieve it", "I will receive it"),
+])
+def test_equivalent_answers_match(given, expected):
+    assert answers_match(given, expected)
+
+def test_fill_in_accepts_any_listed_answer_exactly():
+    ex = {"type": "fill", "answer_text": "went / has gone"}
+    assert grade_answer(ex, "went")
+    assert grade_answer(ex, "Has gone")
+    assert not grade_answer(ex, "gone")
+
+OPTIONS = ["dog", "cat", "bird"]
+
+@pytest.mark.parametrize("answer,index", [
+    ("b", 1), ("B)", 1), ("(b)", 1), ("b.", 1), ("c:", 2), ("cat", 1), ("B) cat", 1),
+])
+def test_select_option(answer, index):
+    assert select_option(answer, OPTIONS) == index
+
+@pytest.mark.parametrize("answer", ["a cat", "b because it purrs", "B) bird", "z"])
+def test_select_option_rejects_letter_with_free_text(answer):
+    assert select_option(answer, OPTIONS) is None
+
+def test_select_option_prefers_option_text_over_letter():
+    assert select_option("a", ["an", "a", "the"]) == 1
@@ -0,0 +1,95 @@
+import asyncio, os, time
+
+import llm
+
+class _CountingBackend(llm.FakeBackend):
+    """FakeBackend که بیشترین تعداد فراخوانی همزمان را می‌شمارد."""
+
+    def __init__(self, latency: float):
+        super().__init__(latency=latency, rate_limit_rate=0)
+        self.active = self.max_active = 0
+
+    async def generate(self, prompt, system, timeout):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            return await super().generate(prompt, system, timeout)
+        finally:
+            self.active -= 1
+
+def test_call_exceeding_timeout_gives_up_and_frees_its_slot():
+    async def run():
+        client = llm.LLMClient(_CountingBackend(latency=5), max_concurrency=1, timeout=0.1)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        answer = await client.ask("Explain the present perfect")
+        return client, answer, loop.time() - t0
+
+    client, answer, elapsed = asyncio.run(run())
+    assert answer is None
+    assert elapsed < 1
+    assert client.stats["failed"] == 1
+    assert client.gate.active[llm.INTERACTIVE] == 0 and client.backend.active == 0
+
+def test_in_flight_calls_are_capped():
+    async def run():
+        client = llm.LLMClient(_CountingBackend(latency=0.05), max_concurrency=2)
+        answers = await asyncio.gather(*(client.ask(f"question {i}") for i in range(6)))
+        return client, answers
+
+    client, answers = asyncio.run(run())
+    assert all(answers)
+    assert client.backend.max_active == 2
+    assert client.stats["calls"] == 6
+
+def test_gemini_backend_uses_proxy_and_reuses_models(monkeypatch):
+    for var in ("grpc_proxy", "https_proxy", "http_proxy"):
+        monkeypatch.delenv(var, raising=False)
+    backend = llm.GeminiBackend("test-key", proxy_url="http://proxy.local:3128")
+    assert os.environ["grpc_proxy"] == os.environ["https_proxy"] == "http://proxy.local:3128"
+    assert backend._model("tutor") is backend._model("tutor")
+    assert backend._model("tutor") is not backend._model(None)
+
+class _BrokenStreamBackend(llm.FakeBackend):
+    async def stream(self, prompt, system, timeout):
+        yield "The present perfect "
+        yield "is used"
+        raise ConnectionError("connection reset")
+
+def test_interrupted_stream_raises_with_partial_text():
+    async def run():
+        client = llm.LLMClient(_BrokenStreamBackend(latency=0, rate_limit_rate=0))
+        seen = []
+        try:
+            async for text in client.stream("Explain the present perfect"):
+                seen.append(text)
+        except llm.StreamInterrupted as e:
+            return client, seen, e.text
+        raise AssertionError("stream finished normally")
+
+    client, seen, partial = asyncio.run(run())
+    assert seen[-1] == partial == "The present perfect is used"
+    assert client.breaker.failures == 1
+    assert client.gate.active[llm.INTERACTIVE] == 0
+
+def test_completed_stream_does_not_raise():
+    async def run():
+        client = llm.LLMClient(llm.FakeBackend(latency=0, rate_limit_rate=0))
+        return [t async for t in client.stream("Explain the present perfect")]
+
+    assert asyncio.run(run())[-1] == "CORRECT. (offline fake answer)"
+
+def test_half_open_probe_shed_at_deadline_is_released():
+    async def run():
+        client = llm.LLMClient(llm.FakeBackend(latency=0, rate_limit_rate=0))
+        client.breaker = llm.CircuitBreaker(threshold=1, cooldown=0)
+        client.breaker.failure()  # باز؛ cooldown صفر → درخواست بعدی probe است
+        # deadline همین حالا گذشته: gate فوراً نوبت می‌دهد ولی _generate_with_retries با timeout<=0 shed می‌کند
+        answer = await client._ask("Explain the present perfect", None, False, llm.INTERACTIVE, time.monotonic())
+        return client, answer
+
+    client, answer = asyncio.run(run())
+    assert answer is None
+    assert client.stats["deadline_shed"] == 1
+    assert not client.breaker._probing
+    assert client.breaker.allow()  # درخواست بعدی می‌تواند آزمایش کند
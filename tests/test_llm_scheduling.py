@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+import llm
+
+class _RateLimitedBackend(llm.FakeBackend):
+    """اول fail_times بار 429 می‌دهد، بعد جواب عادی FakeBackend."""
+
+    def __init__(self, fail_times: int):
+        super().__init__(latency=0, rate_limit_rate=0)
+        self.fail_times = fail_times
+
+    async def generate(self, prompt, system, timeout):
+        self.calls += 1
+        if self.calls <= self.fail_times:
+            raise llm.FakeRateLimited("fake 429")
+        return self._answer(prompt)
+
+@pytest.fixture(autouse=True)
+def _fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm, "LLM_RETRY_BASE", 0.001)
+    monkeypatch.setattr(llm, "LLM_RETRY_MAX", 3)
+
+def test_gate_admits_waiting_interactive_before_background():
+    async def run():
+        gate = llm.PriorityGate(1, {llm.INTERACTIVE: 1, llm.BACKGROUND: 1})
+        await gate.acquire(llm.BACKGROUND, None)  # تنها جا پر است
+        order = []
+
+        async def worker(cls, name):
+            await gate.acquire(cls, None)
+            order.append(name)
+            gate.release(cls)
+
+        background = asyncio.create_task(worker(llm.BACKGROUND, "background"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(worker(llm.INTERACTIVE, "interactive"))
+        await asyncio.sleep(0)
+        assert gate.depth(llm.BACKGROUND) == gate.depth(llm.INTERACTIVE) == 1
+        gate.release(llm.BACKGROUND)
+        await asyncio.gather(background, interactive)
+        return order, gate
+
+    order, gate = asyncio.run(run())
+    assert order == ["interactive", "background"]
+    assert gate.active == {llm.INTERACTIVE: 0, llm.BACKGROUND: 0}
+
+def test_waiter_past_its_deadline_is_shed():
+    async def run():
+        gate = llm.PriorityGate(1, {llm.INTERACTIVE: 1, llm.BACKGROUND: 1})
+        await gate.acquire(llm.INTERACTIVE, None)
+        with pytest.raises(llm.Shed):
+            await gate.acquire(llm.INTERACTIVE, llm.time.monotonic() + 0.05)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.stats[llm.INTERACTIVE]["shed"] == 1
+    assert gate.depth(llm.INTERACTIVE) == 0
+
+def test_retry_budget_runs_out_and_refills_from_successes():
+    budget = llm.RetryBudget(ratio=0.5, cap=2)
+    assert budget.spend() and budget.spend()
+    assert not budget.spend()
+    budget.earn()
+    assert not budget.spend()  # نصف توکن کافی نیست
+    budget.earn()
+    assert budget.spend()
+    for _ in range(10):
+        budget.earn()
+    assert budget.tokens == 2  # سقف
+
+def test_429_is_retried_with_backoff_until_success():
+    async def run():
+        client = llm.LLMClient(_RateLimitedBackend(fail_times=2))
+        return client, await client.ask("Explain the present perfect")
+
+    client, answer = asyncio.run(run())
+    assert answer == "CORRECT. (offline fake answer)"
+    assert client.backend.calls == 3
+    assert client.stats["rate_limited"] == 2 and client.stats["retries"] == 2
+    assert client.breaker.state == "closed" and client.breaker.failures == 0
+
+def test_429_gives_up_when_retry_budget_is_exhausted():
+    async def run():
+        client = llm.LLMClient(_RateLimitedBackend(fail_times=100))
+        client.budget = llm.RetryBudget(ratio=0.1, cap=1)
+        return client, await client.ask("Explain the present perfect")
+
+    client, answer = asyncio.run(run())
+    assert answer is None
+    assert client.backend.calls == 2  # تلاش اول + تنها retry بودجه
+    assert client.stats["retries"] == 1 and client.stats["failed"] == 1
+    assert client.breaker.failures == 1
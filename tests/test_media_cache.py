@@ -0,0 +1,57 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+import media_cache
+from media_cache import MediaCache
+
+URL = "https://cdn.example.com/audio/greetings.mp3"
+
+class _Bot:
+    def __init__(self, cached_error=None):
+        self.cached_error = cached_error
+        self.sent = []
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        self.sent.append(audio)
+        if audio == "FILE_ID" and self.cached_error:
+            raise BadRequest(self.cached_error)
+        return SimpleNamespace(audio=SimpleNamespace(file_id="NEW_ID"), voice=None, document=None)
+
+@pytest.fixture
+def cache(monkeypatch):
+    dropped = []
+
+    async def drop(key):
+        dropped.append(key)
+
+    async def noop(*_args):
+        return None
+
+    monkeypatch.setattr(media_cache, "drop_media_file_id", drop)
+    monkeypatch.setattr(media_cache, "save_media_file_id", noop)
+    monkeypatch.setattr(media_cache, "touch_media", noop)
+    c = MediaCache(max_size=10)
+    c._remember(URL, "FILE_ID")
+    c._touched[URL] = time.monotonic()
+    c.dropped = dropped
+    return c
+
+def test_stale_file_id_is_forgotten_and_resent_from_source(cache):
+    bot = _Bot("Wrong file identifier/http url specified")
+    msg = asyncio.run(cache.send_audio(bot, 1, URL))
+    assert msg is not None
+    assert bot.sent == ["FILE_ID", URL]
+    assert cache.dropped == [URL] and cache.stats["stale_ids"] == 1
+    assert asyncio.run(cache.file_id(URL)) == "NEW_ID"
+
+@pytest.mark.parametrize("error", ["Chat not found", "Can't parse entities: unsupported start tag"])
+def test_other_bad_requests_keep_the_mapping(cache, error):
+    bot = _Bot(error)
+    assert asyncio.run(cache.send_audio(bot, 1, URL)) is None
+    assert bot.sent == ["FILE_ID"]  # بدون آپلود دوباره از منبع
+    assert cache.dropped == [] and cache.stats["failed"] == 1
+    assert asyncio.run(cache.file_id(URL)) == "FILE_ID"
@@ -0,0 +1,31 @@
+from config import PLACEMENT_MIN_RESPONSES
+from services import _usable_item
+
+def _item(responses):
+    """responses: [(درست؟, نمرهٔ بقیهٔ آزمون ۰..۱)] → سند آیتم با جمع‌های آماری."""
+    stats = {"n": 0, "correct": 0, "sum": 0.0, "sum_sq": 0.0, "sum_correct": 0.0}
+    for ok, rest in responses:
+        stats["n"] += 1
+        stats["correct"] += ok
+        stats["sum"] += rest
+        stats["sum_sq"] += rest * rest
+        stats["sum_correct"] += rest if ok else 0.0
+    return {"stats": stats}
+
+N = PLACEMENT_MIN_RESPONSES
+
+def test_new_items_are_usable():
+    assert _usable_item({"stats": {}})
+    assert _usable_item(_item([(False, 0.9)] * (N - 1)))
+
+def test_item_everyone_answered_correctly_stays_usable():
+    assert _usable_item(_item([(True, 0.2), (True, 0.8)] * N))
+
+def test_item_with_constant_rest_scores_stays_usable():
+    assert _usable_item(_item([(True, 0.5), (False, 0.5)] * N))
+
+def test_discriminating_item_is_usable_and_inverted_one_is_retired():
+    strong_know_it = [(True, 0.9), (False, 0.2)] * N
+    weak_know_it = [(True, 0.2), (False, 0.9)] * N
+    assert _usable_item(_item(strong_know_it))
+    assert not _usable_item(_item(weak_know_it))
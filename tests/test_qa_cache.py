@@ -0,0 +1,42 @@
+import pytest
+
+from qa_cache import QACache, normalize_question
+
+CACHED = [
+    "What is the difference between can and could?",
+    "can vs could",
+    "Should I use a or the before university?",
+]
+
+def _cache():
+    cache = QACache(max_size=100, threshold=0.7, min_tokens=3)
+    for q in CACHED:
+        assert cache.put(q, f"answer: {q}") is not None
+    return cache
+
+@pytest.mark.parametrize("question", [
+    "difference between will and would",
+    "What is the difference between will and would?",
+    "do vs does",
+    "Should I use a or an before university?",
+])
+def test_near_miss_grammar_questions_are_not_served_from_cache(question):
+    assert _cache().lookup(question) is None
+
+@pytest.mark.parametrize("question", [
+    "Please explain the difference between can and could",
+    "Can you tell me the difference between can and could?",
+    "what's the difference between can and could",
+])
+def test_rephrased_question_still_hits(question):
+    assert _cache().lookup(question) == f"answer: {CACHED[0]}"
+
+def test_function_words_stay_in_signature():
+    assert normalize_question("which or that?") == frozenset({"which", "or", "that"})
+    assert normalize_question("will vs would") != normalize_question("can vs could")
+
+@pytest.mark.parametrize("question", ["", "?!", "please explain", "tenses?"])
+def test_too_short_questions_are_neither_cached_nor_looked_up(question):
+    cache = _cache()
+    assert cache.put(question, "x") is None
+    assert cache.lookup(question) is None
@@ -0,0 +1,10 @@
+import pytest
+
+from services import normalize_reminder_time
+
+@pytest.mark.parametrize("raw,expected", [
+    ("8:30", "08:30"), ("08:30", "08:30"), (" 8:5 ", "08:05"), ("0:00", "00:00"),
+    ("24:00", None), ("8", None), ("8:30pm", None), (None, None),
+])
+def test_normalize_reminder_time(raw, expected):
+    assert normalize_reminder_time(raw) == expected
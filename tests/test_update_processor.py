@@ -0,0 +1,42 @@
+import asyncio
+
+from update_processor import PerUserUpdateProcessor
+
+def test_slow_update_does_not_delay_other_users(tg_update):
+    async def run():
+        processor = PerUserUpdateProcessor(8)
+        done = []
+
+        async def handler(name: str, seconds: float):
+            await asyncio.sleep(seconds)
+            done.append(name)
+
+        slow = asyncio.create_task(processor.process_update(tg_update(1, 1), handler("slow llm", 0.5)))
+        await asyncio.sleep(0)
+        t0 = asyncio.get_running_loop().time()
+        await processor.process_update(tg_update(2, 2), handler("start", 0.01))
+        elapsed = asyncio.get_running_loop().time() - t0
+        await slow
+        return done, elapsed
+
+    done, elapsed = asyncio.run(run())
+    assert done == ["start", "slow llm"]
+    assert elapsed < 0.2
+
+def test_updates_of_one_user_run_in_order_one_at_a_time(tg_update):
+    async def run():
+        processor = PerUserUpdateProcessor(8)
+        events = []
+
+        async def handler(i: int):
+            events.append(("start", i))
+            await asyncio.sleep(0.02 if i == 0 else 0)
+            events.append(("end", i))
+
+        await asyncio.gather(*(processor.process_update(tg_update(i, 7), handler(i)) for i in range(3)))
+        return events, processor
+
+    events, processor = asyncio.run(run())
+    assert events == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    assert processor.stats["waited_for_user"] == 2
+    assert not processor._users
@@ -0,0 +1,13 @@
+from services import UserCache
+
+def test_cached_user_doc_is_not_shared_with_callers():
+    cache = UserCache(max_size=10, ttl=60)
+    doc = {"_id": 1, "user_id": 7, "prefs": {"goal": "ielts"}}
+    cache.put(7, doc)
+    doc["prefs"]["goal"] = "changed by caller"
+
+    _hit, first = cache.get(7)
+    assert first["prefs"]["goal"] == "ielts"
+    first["prefs"]["goal"] = "changed again"
+    _hit, second = cache.get(7)
+    assert second["prefs"]["goal"] == "ielts"
@@ -0,0 +1,64 @@
+# update_processor.py
+from __future__ import annotations
+import asyncio
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+def user_key(update: object) -> Optional[int]:
+    """کاربر (یا چت) صاحب آپدیت؛ برای آپدیت‌های بی‌صاحب None."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    آپدیت‌های کاربران مختلف همزمان (تا max_concurrent_updates) پردازش می‌شوند تا یک await کند
+    (Mongo/LLM) بقیه را معطل نکند؛ ولی آپدیت‌های یک کاربر به ترتیب رسیدن و یکی‌یکی، چون
+    ConversationHandler و user_data با همزمانیِ آپدیت‌های یک کاربر race دارند.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._users: Dict[int, List[Any]] = {}  # user → [lock, آپدیت‌های در جریان]
+        self.active = 0
+        self.stats: Dict[str, int] = {"processed": 0, "waited_for_user": 0, "max_active": 0}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.stats["waited_for_user"] += 1
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    async def _run(self, coroutine: Awaitable[Any]) -> None:
+        self.active += 1
+        self.stats["max_active"] = max(self.stats["max_active"], self.active)
+        try:
+            await coroutine
+        finally:
+            self.active -= 1
+            self.stats["processed"] += 1
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
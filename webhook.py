@@ -0,0 +1,139 @@
+# webhook.py
+# حالت webhook چندپروسه‌ای:  python webhook.py --workers 4
+# پروسهٔ اصلی فقط آپدیت‌ها را از تلگرام می‌گیرد و بر اساس user_id به یکی از N worker می‌دهد؛
+# هر worker یک Application کامل (بدون updater) با event loop خودش اجرا می‌کند. چون همهٔ آپدیت‌های
+# یک کاربر به یک worker می‌روند، وضعیت گفتگوی او همیشه همان‌جاست.
+from __future__ import annotations
+import argparse, asyncio, json, logging, queue, signal
+import multiprocessing as mp
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import urlparse
+
+from config import (
+    BOT_TOKEN, TELEGRAM_API_URL,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_WORKERS,
+)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 10_000        # سقف آپدیت‌های در صف هر worker
+ENQUEUE_TIMEOUT = 1.0      # اگر worker عقب است → 503 و تلگرام خودش دوباره می‌فرستد
+
+def partition_key(update: dict) -> int:
+    """user_id فرستنده (message.from، callback_query.from، poll_answer.user، ...)؛ وگرنه chat.id."""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get("from") or value.get("user")
+        if isinstance(user, dict) and "id" in user:
+            return int(user["id"])
+        chat = value.get("chat")
+        if isinstance(chat, dict) and "id" in chat:
+            return int(chat["id"])
+    return int(update.get("update_id", 0))
+
+# ---------- Worker ----------
+def _worker_main(index: int, updates: mp.Queue) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # توقف فقط از طریق sentinel پروسهٔ اصلی
+    logging.basicConfig(level=logging.INFO, format=f"[worker {index}] %(levelname)s %(name)s: %(message)s")
+    asyncio.run(_run_worker(index, updates))
+
+async def _run_worker(index: int, updates: mp.Queue) -> None:
+    from telegram import Update
+    from main import build_application
+
+    # jobهای پس‌زمینه (یادآور، sweep، بانک درس) فقط روی worker 0
+    app = build_application(with_updater=False, background_jobs=index == 0)
+    loop = asyncio.get_running_loop()
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    try:
+        while True:
+            body = await loop.run_in_executor(None, updates.get)
+            if body is None:
+                break
+            await app.update_queue.put(Update.de_json(json.loads(body), app.bot))
+    finally:
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+# ---------- Dispatcher (front) ----------
+def _make_handler(path: str, queues: List[mp.Queue]):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if WEBHOOK_SECRET and self.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+                self.send_error(403)
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                key = partition_key(json.loads(body))
+            except (ValueError, TypeError, AttributeError):
+                self.send_error(400)
+                return
+            try:
+                queues[key % len(queues)].put(body, timeout=ENQUEUE_TIMEOUT)
+            except queue.Full:
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, fmt, *args):
+            logger.debug(fmt, *args)
+
+    return WebhookHandler
+
+async def _set_webhook() -> None:
+    from telegram import Bot
+    async with Bot(BOT_TOKEN, base_url=f"{TELEGRAM_API_URL}/bot") as bot:
+        await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None)
+
+def _raise_interrupt(*_args):
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook dispatcher with per-user worker processes")
+    parser.add_argument("--workers", type=int, default=WEBHOOK_WORKERS)
+    parser.add_argument("--listen", default=WEBHOOK_LISTEN)
+    parser.add_argument("--port", type=int, default=WEBHOOK_PORT)
+    parser.add_argument("--path", default=urlparse(WEBHOOK_URL).path or "/telegram")
+    parser.add_argument("--no-set-webhook", action="store_true", help="setWebhook را صدا نزن (تست محلی)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[dispatcher] %(levelname)s %(name)s: %(message)s")
+
+    ctx = mp.get_context("spawn")
+    queues = [ctx.Queue(maxsize=QUEUE_SIZE) for _ in range(args.workers)]
+    procs = [ctx.Process(target=_worker_main, args=(i, q), name=f"bot-worker-{i}") for i, q in enumerate(queues)]
+    for p in procs:
+        p.start()
+
+    if WEBHOOK_URL and not args.no_set_webhook:
+        asyncio.run(_set_webhook())
+
+    server = ThreadingHTTPServer((args.listen, args.port), _make_handler(args.path, queues))
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    print(f"🤖 Webhook dispatcher on {args.listen}:{args.port}{args.path} → {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join(timeout=30)
+
+if __name__ == "__main__":
+    main()